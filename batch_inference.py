@@ -0,0 +1,179 @@
+"""Offline batch inference over a JSONL request file.
+
+Each input line is a JSON object with "image" (or "image_path"), "prompt" and
+an optional "id"; without an id the line number is used. The prompt may put
+the image with {{image}}, otherwise the image goes first. Results are appended
+to the output JSONL as requests complete, so an interrupted run picks up where
+it stopped: requests that already succeeded are skipped on the next run.
+
+Usage: python batch_inference.py requests.jsonl results.jsonl [--depth 3]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+from multiprocess_inference import InferencePipeline, PIPELINE_DEPTH, build_request_prompt
+
+
+def load_requests(path):
+    """Read request records, giving every record a string id"""
+    requests = []
+    seen = set()
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"Skipping line {line_number}: {e}")
+                continue
+            image = record.get("image") or record.get("image_path")
+            if not image or "prompt" not in record:
+                print(f"Skipping line {line_number}: needs an image and a prompt")
+                continue
+            request_id = str(record.get("id", line_number))
+            if request_id in seen:
+                print(f"Skipping line {line_number}: duplicate id {request_id}")
+                continue
+            seen.add(request_id)
+            requests.append({"id": request_id, "image": image, "prompt": record["prompt"]})
+    return requests
+
+
+def load_completed(path):
+    """Return the ids that already succeeded, dropping a partially written last line.
+
+    Failed requests are run again; their new result is appended after the old one.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            print(f"Dropping incomplete last line of {path}")
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("status") == "ok" and "id" in record:
+            completed.add(str(record["id"]))
+    return completed
+
+
+class ResultWriter:
+    """Appends result records to the output file from the pipeline's callback thread"""
+
+    def __init__(self, path, total):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.all_done = threading.Event()
+        if total == 0:
+            self.all_done.set()
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.done += 1
+            if record["status"] != "ok":
+                self.failed += 1
+            print(f"[{self.done}/{self.total}] {record['id']}: {record['status']}")
+            if self.done == self.total:
+                self.all_done.set()
+
+    def close(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MiniCPM-V-2.6 offline batch inference")
+    parser.add_argument("input", help="JSONL file of requests")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--depth", type=int, default=max(PIPELINE_DEPTH, 3),
+                        help="requests in flight at once (keeps the vision stage ahead of the LLM)")
+    parser.add_argument("--no-group-images", action="store_true",
+                        help="keep input order instead of grouping requests that share an image")
+    args = parser.parse_args()
+
+    requests = load_requests(args.input)
+    completed = load_completed(args.output)
+    pending = [request for request in requests if request["id"] not in completed]
+    print(f"{len(requests)} requests, {len(requests) - len(pending)} already done, {len(pending)} to run")
+    if not args.no_group_images:
+        # 相同图像的请求相邻, 嵌入缓存保证每张图只编码一次
+        pending.sort(key=lambda request: os.path.abspath(request["image"]))
+
+    writer = ResultWriter(args.output, len(pending))
+    state = {}
+    state_lock = threading.Lock()
+
+    def on_event(request_id, kind, payload):
+        with state_lock:
+            entry = state.get(request_id)
+        if entry is None:
+            return
+        if kind == "token":
+            entry["tokens"].append(payload[0])
+        elif kind == "timing":
+            entry["timings"][payload["stage"]] = {k: v for k, v in payload.items() if k != "stage"}
+        elif kind == "error":
+            entry["error"] = payload
+
+    def on_done(request_id, status):
+        with state_lock:
+            entry = state.pop(request_id)
+        record = {
+            "id": request_id,
+            "image": entry["image"],
+            "status": "ok" if status == "DONE" else "error",
+            "response": "".join(entry["tokens"]),
+            "timings": entry["timings"],
+            "latency": time.time() - entry["submitted"],
+        }
+        if "error" in entry:
+            record["error"] = entry["error"]
+        writer.write(record)
+
+    pipeline = InferencePipeline(max_pending=args.depth, stream_tokens=True)
+    pipeline.start()
+    start_time = time.time()
+    try:
+        for request in pending:
+            if not os.path.exists(request["image"]):
+                writer.write({"id": request["id"], "image": request["image"], "status": "error",
+                              "error": f"Image not found: {request['image']}"})
+                continue
+            with state_lock:
+                state[request["id"]] = {"image": request["image"], "tokens": [], "timings": {},
+                                        "submitted": time.time()}
+            pipeline.submit(request["image"], build_request_prompt(request["prompt"]),
+                            request_id=request["id"], on_done=on_done, on_event=on_event)
+        writer.all_done.wait()
+    except KeyboardInterrupt:
+        print("\nInterrupted, completed results are kept in the output file")
+    finally:
+        elapsed = time.time() - start_time
+        # 先停止流水线, 收集线程仍可能在关闭期间回调on_done写入结果
+        pipeline.stop()
+        writer.close()
+        print(f"{writer.done} requests ({writer.failed} failed) in {elapsed:.1f} seconds"
+              + (f", {writer.done / elapsed:.2f} requests/s" if elapsed > 0 else ""))
+    return 1 if writer.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
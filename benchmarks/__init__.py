@@ -0,0 +1 @@
+"""Micro-benchmarks for the host-side parts of the inference pipeline."""
@@ -0,0 +1,90 @@
+"""Compare full JPEG decoding with the reduced-resolution decoding of image_decode.
+
+Each candidate decodes the encoded bytes and resizes to the encoder input, as
+the vision process does. Besides the bundled images, synthetic photos of
+several sizes are encoded in memory.
+
+Usage: python -m benchmarks.bench_decode [--images bill.jpg,man.jpg] [--iterations 20]
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from image_decode import decode_image
+
+SYNTHETIC_SIZES = ((4000, 3000), (8000, 6000))
+
+
+def synthetic_jpeg(width, height, quality=90):
+    """A photo-like JPEG: smooth gradients plus noise, so it compresses like a real picture"""
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[..., 0] = (x + y) / 2
+    img[..., 1] = x
+    img[..., 2] = y
+    img += rng.integers(0, 16, size=img.shape, dtype=np.uint8)
+    ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("JPEG encoding failed")
+    return encoded.tobytes()
+
+
+def full_decode(data, img_size=448):
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.resize(img, (img_size, img_size))
+
+
+def reduced_decode(data, img_size=448):
+    img, _ = decode_image(data, img_size)
+    return cv2.resize(img, (img_size, img_size))
+
+
+def measure(fn, data, iterations):
+    """Return (mean ms, p50 ms, peak traced bytes) of ``fn(data)``"""
+    fn(data)
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(data)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    durations.sort()
+    return 1000 * sum(durations) / len(durations), 1000 * durations[len(durations) // 2], peak
+
+
+def inputs(images):
+    """(name, encoded bytes) for the given files and the synthetic sizes"""
+    for image in images:
+        if os.path.exists(image):
+            with open(image, "rb") as f:
+                yield os.path.splitext(os.path.basename(image))[0], f.read()
+    for width, height in SYNTHETIC_SIZES:
+        yield f"synthetic_{width}x{height}", synthetic_jpeg(width, height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--images", default="bill.jpg,man.jpg")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    for name, data in inputs(args.images.split(",")):
+        img, size = decode_image(data)
+        print(f"{name}: {size[0]}x{size[1]}, {len(data) / 1024:.0f} KB, decoded at {img.shape[1]}x{img.shape[0]}")
+        for label, fn in (("full", full_decode), ("reduced", reduced_decode)):
+            mean_ms, p50_ms, peak = measure(fn, data, args.iterations)
+            print(f"  {label:8s} mean {mean_ms:8.2f} ms  p50 {p50_ms:8.2f} ms  "
+                  f"peak alloc {peak / 1024 / 1024:7.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
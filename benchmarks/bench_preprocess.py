@@ -0,0 +1,64 @@
+"""Compare the original vision preprocessing with ImagePreprocessor.
+
+Usage: python -m benchmarks.bench_preprocess [--image bill.jpg] [--iterations 200]
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from preprocess import ImagePreprocessor
+
+
+def legacy_preprocess(img, img_size=448):
+    """The preprocessing multiprocess_inference.py used before ImagePreprocessor"""
+    img = cv2.resize(img, (img_size, img_size))
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    img = img.astype(np.float32)
+    img = img[np.newaxis, :, :, :]
+    return img.astype(np.float32)
+
+
+def measure(fn, img, iterations):
+    """Return (mean ms, p50 ms, peak traced bytes) of ``fn(img)``"""
+    fn(img)  # warm-up, also allocates the preprocessor's buffers
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn(img)
+        durations.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn(img)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    durations.sort()
+    return 1000 * sum(durations) / len(durations), 1000 * durations[len(durations) // 2], peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image", default="bill.jpg")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--img-size", type=int, default=448)
+    args = parser.parse_args()
+
+    img = cv2.imread(args.image)
+    if img is None:
+        raise SystemExit(f"Cannot read {args.image}")
+    print(f"{args.image}: {img.shape[1]}x{img.shape[0]}, {args.iterations} iterations")
+
+    candidates = [
+        ("legacy float32", lambda im: legacy_preprocess(im, args.img_size)),
+        ("engine float32", ImagePreprocessor(args.img_size, np.float32)),
+        ("engine uint8", ImagePreprocessor(args.img_size, np.uint8)),
+    ]
+    for name, fn in candidates:
+        mean_ms, p50_ms, peak = measure(fn, img, args.iterations)
+        print(f"{name:16s} mean {mean_ms:7.3f} ms  p50 {p50_ms:7.3f} ms  "
+              f"peak alloc {peak / 1024 / 1024:6.2f} MB")
+
+
+if __name__ == "__main__":
+    main()
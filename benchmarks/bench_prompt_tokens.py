@@ -0,0 +1,64 @@
+"""Time prompt token accounting: PromptCounter against the byte estimate and the tokenizer's ID lookups.
+
+Usage: python -m benchmarks.bench_prompt_tokens [--iterations 2000]
+"""
+import argparse
+import time
+
+from prompt_tokens import PromptCounter
+from session_manager import estimate_tokens
+
+SAMPLE_TEXT = ("Hãy mô tả chi tiết hóa đơn này: tên cửa hàng, các món đã mua và tổng số tiền. "
+               "Then summarise it in English in two sentences.")
+SAMPLE_PROMPT = f"""<|im_start|>system
+You are a helpful assistant.<|im_end|>
+<|im_start|>user
+<image_id>0</image_id><image>
+{SAMPLE_TEXT}<|im_end|>
+<|im_start|>assistant
+"""
+
+
+def time_us(fn, iterations):
+    """Mean microseconds per call of ``fn()``"""
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return 1e6 * (time.perf_counter() - start) / iterations
+
+
+def measure(iterations, tokenizer_dir="."):
+    counter = PromptCounter(tokenizer_dir)
+    uncached = PromptCounter(tokenizer_dir, cache_size=0)
+    metrics = {
+        "exact": counter.exact,
+        "estimate_us": time_us(lambda: estimate_tokens(SAMPLE_PROMPT), iterations),
+        "count_prompt_us": time_us(lambda: counter.count_prompt(SAMPLE_PROMPT, 1, [SAMPLE_TEXT]), iterations),
+        "count_prompt_uncached_us": time_us(lambda: uncached.count_prompt(SAMPLE_PROMPT, 1, [SAMPLE_TEXT]),
+                                            iterations),
+        "special_id_table_us": time_us(lambda: counter.special_ids["<slice>"], iterations),
+    }
+    metrics.update({f"sample_{key}_tokens": value
+                    for key, value in counter.count_prompt(SAMPLE_PROMPT, 1, [SAMPLE_TEXT]).items()})
+    try:
+        from transformers import AutoTokenizer
+    except ImportError:
+        return metrics
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir, trust_remote_code=True)
+    metrics["convert_tokens_to_ids_us"] = time_us(lambda: tokenizer.convert_tokens_to_ids("<slice>"), iterations)
+    metrics["slice_start_id_us"] = time_us(lambda: tokenizer.slice_start_id, iterations)
+    metrics["sample_tokenizer_tokens"] = len(tokenizer(SAMPLE_PROMPT)["input_ids"])
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    for key, value in measure(args.iterations).items():
+        print(f"{key:28s} {value:10.3f}" if isinstance(value, float) else f"{key:28s} {value}")
+
+
+if __name__ == "__main__":
+    main()
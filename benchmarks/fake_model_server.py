@@ -0,0 +1,104 @@
+"""HTTP stand-in for the model host, for exercising model_download without the internet.
+
+Serves the files of a directory with HEAD, byte ranges and Hugging Face's
+X-Linked-Etag/X-Linked-Size headers. With --fail-after N every response is
+cut off after N bytes, which exercises chunk retries and resuming.
+
+Usage:
+    python -m benchmarks.fake_model_server --dir model --port 8080
+    MODEL_MIRROR_URL=http://127.0.0.1:8080 streamlit run streamlit_app.py
+"""
+import argparse
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from model_download import sha256_file
+
+
+def make_handler(directory, fail_after=None, ranges=True):
+    hashes = {}
+    lock = threading.Lock()
+
+    class FileHandler(BaseHTTPRequestHandler):
+        def _resolve(self):
+            name = os.path.basename(self.path.split("?")[0])
+            path = os.path.join(directory, name)
+            if not name or not os.path.isfile(path):
+                self.send_error(404)
+                return None, None
+            with lock:
+                if name not in hashes:
+                    hashes[name] = sha256_file(path)
+            return path, hashes[name]
+
+        def _headers(self, status, size, sha256, extra=()):
+            self.send_response(status)
+            self.send_header("Content-Length", str(size))
+            self.send_header("X-Linked-Etag", f'"{sha256}"')
+            if ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            for name, value in extra:
+                self.send_header(name, value)
+            self.end_headers()
+
+        def do_HEAD(self):
+            path, sha256 = self._resolve()
+            if path is not None:
+                self._headers(200, os.path.getsize(path), sha256)
+
+        def do_GET(self):
+            path, sha256 = self._resolve()
+            if path is None:
+                return
+            size = os.path.getsize(path)
+            start, end = 0, size - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if ranges and match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+                self._headers(206, end + 1 - start, sha256, [("Content-Range", f"bytes {start}-{end}/{size}")])
+            else:
+                self._headers(200, size, sha256)
+            remaining = end + 1 - start
+            if fail_after is not None:
+                remaining = min(remaining, fail_after)
+            with open(path, "rb") as f:
+                f.seek(start)
+                while remaining > 0:
+                    data = f.read(min(1024 * 1024, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FileHandler
+
+
+def serve(directory, port=0, host="127.0.0.1", fail_after=None, ranges=True):
+    """Start the stand-in on a daemon thread and return the server; its URL is http://host:server_port"""
+    server = ThreadingHTTPServer((host, port), make_handler(directory, fail_after, ranges))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default="model")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fail-after", type=int, help="cut every response off after this many bytes")
+    parser.add_argument("--no-ranges", action="store_true", help="ignore Range headers")
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 make_handler(args.dir, args.fail_after, not args.no_ranges))
+    print(f"Serving {args.dir} on http://{args.host}:{server.server_address[1]}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
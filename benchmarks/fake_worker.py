@@ -0,0 +1,18 @@
+"""multiprocess_inference.py running on the fake NPU runtimes.
+
+Started by the subprocess round-trip benchmark in place of the real worker;
+the latencies come from FAKE_NPU_CONFIG set by the parent.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+fakes.install(**fakes.config_from_env())
+
+import multiprocess_inference
+
+if __name__ == "__main__":
+    multiprocess_inference.main()
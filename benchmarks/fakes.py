@@ -0,0 +1,229 @@
+"""Stand-ins for the NPU runtimes, with configurable latencies.
+
+``install`` must run before ``multiprocess_inference`` is imported: it
+registers a fake ``rknnlite.api.rknn_lite`` module, routes ``rkllm_binding``
+through ``FakeRKLLMRuntime`` and points the model paths at empty placeholder
+files. Worker processes are forked so they inherit all of it. The fakes do
+no real work, so whatever a benchmark measures on top of the configured
+latencies is the host-side overhead of the pipeline.
+"""
+import ctypes
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+
+import rkllm_binding
+from rkllm_binding import LLMCallState, RKLLMInferMode, RKLLMParam, RKLLMResult
+
+# Environment variable carrying the fake configuration to a worker subprocess
+CONFIG_ENV = "FAKE_NPU_CONFIG"
+# Environment variable carrying the parent's placeholder model directory to a worker subprocess
+MODEL_DIR_ENV = "FAKE_NPU_MODEL_DIR"
+
+DEFAULT_CONFIG = {
+    "vision_seconds": 0.5,      # per encoded tile
+    "vision_load_seconds": 0.0,
+    "llm_load_seconds": 0.0,
+    "prefill_seconds": 0.3,
+    "tokens_per_second": 20.0,  # 0 emits tokens as fast as the callback path allows
+    "response_tokens": 32,
+}
+
+# Placeholder model files and prompt caches of the current install()
+_model_dir = None
+
+_WORDS = ["The ", "image ", "shows ", "a ", "receipt ", "with ", "several ", "items", ", ", "and ", "a ", "total", ". "]
+
+
+class FakeRKNNLite:
+    """RKNNLite with the same calls the vision process makes; returns zero embeddings"""
+
+    NPU_CORE_AUTO = 0
+    NPU_CORE_0 = 1
+    NPU_CORE_1 = 2
+    NPU_CORE_2 = 4
+    NPU_CORE_0_1 = 3
+    NPU_CORE_0_1_2 = 7
+
+    inference_seconds = DEFAULT_CONFIG["vision_seconds"]
+    load_seconds = DEFAULT_CONFIG["vision_load_seconds"]
+    output_shape = (1, 64, 3584)
+
+    def __init__(self, verbose=False):
+        self.core_mask = None
+        self.inferences = 0
+
+    def load_rknn(self, path):
+        time.sleep(self.load_seconds)
+        return 0
+
+    def init_runtime(self, core_mask=NPU_CORE_AUTO):
+        self.core_mask = core_mask
+        return 0
+
+    def inference(self, inputs, data_format=None):
+        time.sleep(self.inference_seconds)
+        self.inferences += 1
+        return [np.zeros(self.output_shape, dtype=np.float32)]
+
+    def release(self):
+        pass
+
+
+class FakeRKLLMRuntime:
+    """Python object with librkllmrt's ``rkllm_*`` functions, for ``rkllm_binding.use_library``.
+
+    ``rkllm_run`` sleeps for the prefill time, then feeds ``response_tokens``
+    tokens to the registered callback at ``tokens_per_second``. Runs in
+    GET_LAST_HIDDEN_LAYER mode with ``save_prompt_cache`` write an empty cache
+    file, so prompt cache handling follows its usual path. The first
+    ``abort_failures`` aborts fail, as they can before the runtime has started.
+    """
+
+    def __init__(self, prefill_seconds=DEFAULT_CONFIG["prefill_seconds"],
+                 tokens_per_second=DEFAULT_CONFIG["tokens_per_second"],
+                 response_tokens=DEFAULT_CONFIG["response_tokens"],
+                 load_seconds=DEFAULT_CONFIG["llm_load_seconds"]):
+        self.prefill_seconds = prefill_seconds
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.load_seconds = load_seconds
+        self.abort_failures = 0
+        self.runs = 0
+        self._callback = None
+        self._aborted = threading.Event()
+        self._running = threading.Event()
+
+    def rkllm_createDefaultParam(self):
+        return RKLLMParam()
+
+    def rkllm_init(self, handle_ref, param_ref, callback):
+        time.sleep(self.load_seconds)
+        handle_ref._obj.value = 1
+        self._callback = callback
+        return 0
+
+    def rkllm_load_lora(self, handle, lora_adapter_ref):
+        return 0
+
+    def rkllm_load_prompt_cache(self, handle, prompt_cache_path):
+        return 0 if os.path.exists(prompt_cache_path) else -1
+
+    def rkllm_release_prompt_cache(self, handle):
+        return 0
+
+    def rkllm_destroy(self, handle):
+        return 0
+
+    def _emit(self, state, text=None, token_id=0):
+        result = RKLLMResult()
+        result.text = text
+        result.token_id = token_id
+        self._callback(ctypes.pointer(result), None, state)
+
+    def rkllm_run(self, handle, input_ref, infer_ref, userdata):
+        infer_param = infer_ref._obj
+        self._aborted.clear()
+        self._running.set()
+        try:
+            self.runs += 1
+            time.sleep(self.prefill_seconds)
+            if infer_param.mode == RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER:
+                if infer_param.prompt_cache_params and infer_param.prompt_cache_params.contents.save_prompt_cache:
+                    open(infer_param.prompt_cache_params.contents.prompt_cache_path, "wb").close()
+                self._emit(LLMCallState.RKLLM_RUN_FINISH)
+                return 0
+            interval = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+            for i in range(self.response_tokens):
+                if self._aborted.is_set():
+                    break
+                if interval:
+                    time.sleep(interval)
+                self._emit(LLMCallState.RKLLM_RUN_NORMAL, _WORDS[i % len(_WORDS)].encode(), i)
+            self._emit(LLMCallState.RKLLM_RUN_FINISH)
+        finally:
+            self._running.clear()
+        return 0
+
+    def rkllm_run_async(self, handle, input_ref, infer_ref, userdata):
+        threading.Thread(target=self.rkllm_run, args=(handle, input_ref, infer_ref, userdata),
+                         daemon=True).start()
+        return 0
+
+    def rkllm_abort(self, handle):
+        if self.abort_failures > 0:
+            self.abort_failures -= 1
+            return -1
+        self._aborted.set()
+        return 0
+
+    def rkllm_is_running(self, handle):
+        # Same convention as rkllm_binding.is_running: 0 while a run is in progress
+        return 0 if self._running.is_set() else 1
+
+
+def config_from_env():
+    """Fake configuration passed down by a parent benchmark, or the defaults"""
+    config = dict(DEFAULT_CONFIG)
+    config.update(json.loads(os.environ.get(CONFIG_ENV, "{}")))
+    return config
+
+
+def install(vision_seconds=DEFAULT_CONFIG["vision_seconds"],
+            vision_load_seconds=DEFAULT_CONFIG["vision_load_seconds"],
+            llm_load_seconds=DEFAULT_CONFIG["llm_load_seconds"],
+            prefill_seconds=DEFAULT_CONFIG["prefill_seconds"],
+            tokens_per_second=DEFAULT_CONFIG["tokens_per_second"],
+            response_tokens=DEFAULT_CONFIG["response_tokens"]):
+    """Replace both NPU runtimes with fakes and return the fake LLM runtime.
+
+    Also exports the configuration in ``FAKE_NPU_CONFIG`` so a worker started
+    through ``benchmarks/fake_worker.py`` uses the same latencies, and keeps
+    prompt caches in a temporary directory instead of ``cache/prompt``. The
+    directory is removed when the process that created it exits; a worker
+    started by a benchmark that already installed the fakes reuses the
+    benchmark's directory, so a terminated worker leaves nothing behind.
+    """
+    if "multiprocess_inference" in sys.modules:
+        raise RuntimeError("benchmarks.fakes.install() must run before multiprocess_inference is imported")
+    multiprocessing.set_start_method("fork", force=True)
+
+    FakeRKNNLite.inference_seconds = vision_seconds
+    FakeRKNNLite.load_seconds = vision_load_seconds
+    for name in ("rknnlite", "rknnlite.api"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    rknn_lite = types.ModuleType("rknnlite.api.rknn_lite")
+    rknn_lite.RKNNLite = FakeRKNNLite
+    sys.modules["rknnlite.api.rknn_lite"] = rknn_lite
+
+    runtime = FakeRKLLMRuntime(prefill_seconds, tokens_per_second, response_tokens, llm_load_seconds)
+    rkllm_binding.use_library(runtime)
+
+    global _model_dir
+    model_dir = os.environ.get(MODEL_DIR_ENV)
+    if not model_dir or not os.path.isdir(model_dir):
+        # 由创建它的进程在退出时删除; fork出的工作进程通过os._exit退出, 不会提前删除
+        _model_dir = tempfile.TemporaryDirectory(prefix="fake_npu_")
+        model_dir = _model_dir.name
+        os.environ[MODEL_DIR_ENV] = model_dir
+    for env, name in (("VISION_ENCODER_PATH", "vision_transformer.rknn"), ("LLM_MODEL_PATH", "qwen.rkllm")):
+        path = os.path.join(model_dir, name)
+        open(path, "wb").close()
+        os.environ[env] = path
+    os.environ["PROMPT_CACHE_DIR"] = os.path.join(model_dir, "prompt")
+    os.environ[CONFIG_ENV] = json.dumps({
+        "vision_seconds": vision_seconds,
+        "vision_load_seconds": vision_load_seconds,
+        "llm_load_seconds": llm_load_seconds,
+        "prefill_seconds": prefill_seconds,
+        "tokens_per_second": tokens_per_second,
+        "response_tokens": response_tokens,
+    })
+    return runtime
@@ -0,0 +1,351 @@
+"""Benchmark suite for the host-side inference pipeline.
+
+By default the NPU runtimes are replaced with fakes (benchmarks/fakes.py) that
+sleep for configurable latencies, so the suite runs on any Linux machine and
+the reported overhead is what the Python side adds. ``--real`` runs the same
+scenarios against the models on an RK3588.
+
+Usage:
+    python -m benchmarks.run_suite --output results.json
+    python -m benchmarks.run_suite --baseline results.json   # exit 1 on regressions
+    python -m benchmarks.run_suite --real --scenarios pipeline,subprocess
+
+Metrics ending in _ms, _us or _s are lower-is-better, metrics ending in
+_per_s are higher-is-better; other values are informational.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from multiprocessing import Process, Queue
+
+SCENARIOS = ["preprocess", "decode", "tokens", "transfer", "callbacks", "pipeline", "subprocess"]
+IMAGES = ["bill.jpg", "man.jpg"]
+EMBEDDING_SHAPE = (1, 64, 3584)
+
+
+def summarize(durations, prefix):
+    """Mean, p50 and p99 of durations in seconds, as milliseconds"""
+    durations = sorted(durations)
+    if not durations:
+        return {}
+    return {
+        f"{prefix}_mean_ms": 1000 * sum(durations) / len(durations),
+        f"{prefix}_p50_ms": 1000 * durations[len(durations) // 2],
+        f"{prefix}_p99_ms": 1000 * durations[min(len(durations) - 1, int(len(durations) * 0.99))],
+    }
+
+
+def bench_preprocess(args):
+    import cv2
+    import numpy as np
+    from benchmarks.bench_preprocess import measure
+    from preprocess import ImagePreprocessor
+
+    metrics = {}
+    for image in IMAGES:
+        img = cv2.imread(image)
+        if img is None:
+            continue
+        name = os.path.splitext(os.path.basename(image))[0]
+        for dtype in (np.float32, np.uint8):
+            mean_ms, p50_ms, peak = measure(ImagePreprocessor(448, dtype), img, args.iterations)
+            label = f"{name}_{np.dtype(dtype).name}"
+            metrics[f"{label}_mean_ms"] = mean_ms
+            metrics[f"{label}_p50_ms"] = p50_ms
+            metrics[f"{label}_peak_bytes"] = peak
+    return metrics
+
+
+def bench_decode(args):
+    """Full vs reduced-resolution decoding plus resize, on the bundled and synthetic JPEGs"""
+    from benchmarks.bench_decode import full_decode, inputs, measure, reduced_decode
+
+    metrics = {}
+    for name, data in inputs(IMAGES):
+        for label, fn in (("full", full_decode), ("reduced", reduced_decode)):
+            mean_ms, p50_ms, peak = measure(fn, data, max(1, args.iterations // 5))
+            metrics[f"{name}_{label}_mean_ms"] = mean_ms
+            metrics[f"{name}_{label}_p50_ms"] = p50_ms
+            metrics[f"{name}_{label}_peak_bytes"] = peak
+    return metrics
+
+
+def bench_tokens(args):
+    """Prompt token accounting per request, see benchmarks/bench_prompt_tokens.py"""
+    from benchmarks.bench_prompt_tokens import measure
+    return measure(args.iterations * 10)
+
+
+def _transfer_consumer(requests, acks, ring):
+    import numpy as np
+    while True:
+        item = requests.get()
+        if item is None:
+            break
+        if ring is not None:
+            array = ring.read(item)
+            checksum = float(np.asarray(array[0, 0, :8]).sum())
+            ring.release(item)
+        else:
+            checksum = float(item[0, 0, :8].sum())
+        acks.put(checksum)
+
+
+def bench_transfer(args):
+    """Round trip of one image embedding to another process: shared-memory ring vs pickled queue"""
+    import numpy as np
+    from shm_transport import EmbeddingRing
+
+    embedding = np.random.rand(*EMBEDDING_SHAPE).astype(np.float32)
+    metrics = {"embedding_bytes": embedding.nbytes}
+    for name in ("ring", "queue"):
+        ring = EmbeddingRing(4, 16 * 1024 * 1024) if name == "ring" else None
+        requests, acks = Queue(), Queue()
+        consumer = Process(target=_transfer_consumer, args=(requests, acks, ring))
+        consumer.start()
+        durations = []
+        try:
+            for i in range(args.iterations + 5):
+                start = time.perf_counter()
+                requests.put(ring.write(embedding, request_id=i) if ring is not None else embedding)
+                acks.get()
+                if i >= 5:  # first round trips include process and pipe start-up
+                    durations.append(time.perf_counter() - start)
+        finally:
+            requests.put(None)
+            consumer.join()
+            if ring is not None:
+                ring.close()
+                ring.unlink()
+        metrics.update(summarize(durations, name))
+    return metrics
+
+
+def run_pipeline_requests(count):
+    """Send ``count`` requests through an InferencePipeline, one at a time.
+
+    Returns per-request records with latency, time to first token, token
+    count and the vision timing event.
+    """
+    from multiprocess_inference import InferencePipeline, build_request_prompt
+
+    pipeline = InferencePipeline(max_pending=1, stream_tokens=True)
+    load_start = time.perf_counter()
+    pipeline.start()
+    load_seconds = time.perf_counter() - load_start
+    records = []
+    try:
+        for i in range(count):
+            record = {"tokens": 0, "first_token": None, "vision": None}
+            done = threading.Event()
+
+            def on_event(request_id, kind, payload, record=record):
+                if kind == "token":
+                    if record["first_token"] is None:
+                        record["first_token"] = time.perf_counter()
+                    record["tokens"] += payload[1]
+                elif kind == "timing" and payload["stage"] == "vision":
+                    record["vision"] = payload
+
+            def on_done(request_id, status, record=record, done=done):
+                record["end"] = time.perf_counter()
+                record["status"] = status
+                done.set()
+
+            record["start"] = time.perf_counter()
+            pipeline.submit(IMAGES[i % len(IMAGES)], build_request_prompt("What is in the image?"),
+                            on_done=on_done, on_event=on_event)
+            done.wait()
+            records.append(record)
+    finally:
+        pipeline.stop()
+    return load_seconds, records
+
+
+def bench_callbacks(args):
+    """Token delivery rate with an instant fake runtime: callback -> event queue -> collector"""
+    if args.real:
+        return {"skipped": "needs the fake runtime"}
+    args.fake_runtime.prefill_seconds = 0.0
+    args.fake_runtime.tokens_per_second = 0.0
+    args.fake_runtime.response_tokens = args.callback_tokens
+    try:
+        _, records = run_pipeline_requests(3)
+    finally:
+        args.fake_runtime.prefill_seconds = args.prefill_seconds
+        args.fake_runtime.tokens_per_second = args.tokens_per_second
+        args.fake_runtime.response_tokens = args.response_tokens
+    rates = [record["tokens"] / (record["end"] - record["first_token"]) for record in records
+             if record["first_token"] is not None and record["end"] > record["first_token"]]
+    if not rates:
+        return {"skipped": "no tokens were delivered"}
+    best = max(rates)
+    return {"tokens_per_s": best, "per_token_us": 1e6 / best}
+
+
+def bench_pipeline(args):
+    """Request latency through both worker processes"""
+    load_seconds, records = run_pipeline_requests(args.requests)
+    metrics = {"load_s": load_seconds, "requests": len(records),
+               "errors": sum(record["status"] != "DONE" for record in records)}
+    metrics.update(summarize([record["end"] - record["start"] for record in records], "latency"))
+    metrics.update(summarize([record["first_token"] - record["start"] for record in records
+                              if record["first_token"] is not None], "ttft"))
+    decode = [record["tokens"] / (record["end"] - record["first_token"]) for record in records
+              if record["first_token"] is not None and record["tokens"] > 1 and record["end"] > record["first_token"]]
+    if decode:
+        metrics["decode_tokens_per_s"] = sum(decode) / len(decode)
+    misses = [record["vision"]["seconds"] for record in records
+              if record["vision"] is not None and not record["vision"]["cache_hit"]]
+    metrics.update(summarize(misses, "vision_miss"))
+    if not args.real:
+        # 减去假运行库的固定延迟, 剩下的就是主机侧开销
+        decode_seconds = args.response_tokens / args.tokens_per_second if args.tokens_per_second > 0 else 0.0
+        overheads = []
+        for record in records:
+            expected = args.prefill_seconds + decode_seconds
+            if record["vision"] is not None and not record["vision"]["cache_hit"]:
+                expected += args.vision_seconds
+            overheads.append(record["end"] - record["start"] - expected)
+        metrics.update(summarize(overheads, "overhead"))
+    return metrics
+
+
+def bench_subprocess(args):
+    """Round trips through the Streamlit subprocess manager and its framed pipe protocol"""
+    try:
+        from subprocess_manager import StreamlitSubprocessManager
+    except ImportError as e:
+        return {"skipped": f"subprocess_manager unavailable: {e}"}
+
+    worker = "multiprocess_inference.py" if args.real else os.path.join("benchmarks", "fake_worker.py")
+    manager = StreamlitSubprocessManager(worker_script=worker)
+    start = time.perf_counter()
+    if not manager.start_process():
+        manager.stop_process()
+        return {"skipped": "worker did not start"}
+    metrics = {"startup_s": time.perf_counter() - start}
+    round_trips, ttfts = [], []
+    try:
+        for i in range(args.requests):
+            start = time.perf_counter()
+            first_token = None
+            for _ in manager.stream_question("What is in the image?", IMAGES[i % len(IMAGES)]):
+                if first_token is None:
+                    first_token = time.perf_counter()
+            round_trips.append(time.perf_counter() - start)
+            if first_token is not None:
+                ttfts.append(first_token - start)
+    finally:
+        manager.stop_process()
+    metrics.update(summarize(round_trips, "round_trip"))
+    metrics.update(summarize(ttfts, "ttft"))
+    return metrics
+
+
+BENCHMARKS = {
+    "preprocess": bench_preprocess,
+    "decode": bench_decode,
+    "tokens": bench_tokens,
+    "transfer": bench_transfer,
+    "callbacks": bench_callbacks,
+    "pipeline": bench_pipeline,
+    "subprocess": bench_subprocess,
+}
+
+
+def compare(results, baseline, tolerance):
+    """Return regression messages for metrics that got worse than ``tolerance`` allows"""
+    regressions = []
+    for scenario, metrics in results["scenarios"].items():
+        base_metrics = baseline.get("scenarios", {}).get(scenario, {})
+        for name, value in metrics.items():
+            base = base_metrics.get(name)
+            if not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or base <= 0:
+                continue
+            if name.endswith("_per_s"):
+                worse = value < base * (1 - tolerance)
+            elif name.endswith(("_ms", "_us", "_s")):
+                worse = value > base * (1 + tolerance)
+            else:
+                continue
+            if worse:
+                regressions.append(f"{scenario}.{name}: {value:.3f} vs baseline {base:.3f} "
+                                   f"({100 * (value / base - 1):+.1f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite for the inference pipeline")
+    parser.add_argument("--real", action="store_true", help="use the real NPU runtimes and models")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=8, help="requests per end-to-end scenario")
+    parser.add_argument("--iterations", type=int, default=100, help="iterations per micro-benchmark")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    fake = parser.add_argument_group("fake runtime latencies")
+    fake.add_argument("--vision-seconds", type=float, default=0.5)
+    fake.add_argument("--prefill-seconds", type=float, default=0.3)
+    fake.add_argument("--tokens-per-second", type=float, default=20.0)
+    fake.add_argument("--response-tokens", type=int, default=32)
+    fake.add_argument("--callback-tokens", type=int, default=2000,
+                      help="tokens per request in the callback scenario")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenarios if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    if not args.real:
+        from benchmarks import fakes
+        args.fake_runtime = fakes.install(vision_seconds=args.vision_seconds,
+                                          prefill_seconds=args.prefill_seconds,
+                                          tokens_per_second=args.tokens_per_second,
+                                          response_tokens=args.response_tokens)
+
+    results = {
+        "mode": "real" if args.real else "fake",
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"machine": platform.machine(), "python": platform.python_version(),
+                 "cpus": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("fake_runtime", "output", "baseline")},
+        "scenarios": {},
+    }
+    for name in scenarios:
+        print(f"=== {name} ===", file=sys.stderr)
+        try:
+            metrics = BENCHMARKS[name](args)
+        except Exception as e:
+            metrics = {"skipped": f"{type(e).__name__}: {e}"}
+        results["scenarios"][name] = metrics
+        for key, value in metrics.items():
+            print(f"{name}.{key}: {value:.3f}" if isinstance(value, float) else f"{name}.{key}: {value}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("mode") != results["mode"]:
+            print(f"Warning: baseline was recorded in {baseline.get('mode')} mode", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        print(f"{len(regressions)} regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import numpy as np
+
+
+def hash_image_bytes(data: bytes) -> str:
+    """Return the content key used to address an image's embeddings"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed cache of vision encoder outputs.
+
+    The memory tier is an LRU bounded by the total size of the stored arrays.
+    When ``disk_dir`` is set, every computed embedding is also written there as
+    ``<key>.npy`` and memory-mapped back on a memory miss, so the cache survives
+    restarts of the inference process.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.npy")
+
+    def _insert(self, key: str, embeddings: np.ndarray) -> None:
+        if embeddings.nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = embeddings
+        self._bytes += embeddings.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Look up embeddings by content key, falling back to the disk tier"""
+        with self._lock:
+            embeddings = self._entries.get(key)
+            if embeddings is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embeddings
+
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            try:
+                embeddings = np.load(self._disk_path(key), mmap_mode="r")
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable cached embedding {key}: {e}")
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                    self._insert(key, embeddings)
+                return embeddings
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, embeddings: np.ndarray) -> None:
+        """Store embeddings in memory and, if enabled, on disk"""
+        with self._lock:
+            self._insert(key, embeddings)
+
+        if self.disk_dir and not os.path.exists(self._disk_path(key)):
+            tmp_path = self._disk_path(key) + f".{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, embeddings)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError as e:
+                print(f"Failed to write embedding cache file: {e}")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """Return cached embeddings or compute, store and return them"""
+        embeddings = self.get(key)
+        if embeddings is not None:
+            return embeddings
+        embeddings = compute()
+        if embeddings is not None:
+            self.put(key, embeddings)
+        return embeddings
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
@@ -0,0 +1,80 @@
+import struct
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from image_slicing import get_sliced_grid
+
+# libjpeg can scale by 1/2, 1/4 and 1/8 while decoding (in the DCT), largest first
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+# Start-of-frame markers; C4, C8 and CC share the range but are not frames
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data) -> Optional[Tuple[int, int]]:
+    """(width, height) from a JPEG's frame header, or None if ``data`` is not a JPEG"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker in _SOF_MARKERS:
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+def decode_scale(size: Tuple[int, int], min_size: Tuple[int, int]) -> int:
+    """Largest reduction whose output is still at least ``min_size`` (1 for none)"""
+    width, height = size
+    for scale, _ in REDUCED_FLAGS:
+        if width // scale >= min_size[0] and height // scale >= min_size[1]:
+            return scale
+    return 1
+
+
+def decode_image(data, img_size: int = 448, max_slices: int = 1):
+    """Decode encoded image bytes to BGR at the smallest size the vision encoder can use.
+
+    Every tile is resized to ``img_size`` squared, so a JPEG only has to be
+    decoded large enough that the overview, or with ``max_slices`` > 1 each
+    slice of the MiniCPM-V grid, is still ``img_size`` on both sides. The
+    header is read first and libjpeg's reduced decoding skips the rest, which
+    on a 12 MP photo avoids most of the decode time and the full-size buffer.
+    Other formats are decoded in full.
+
+    Returns (image, original (width, height)), or (None, None) when the
+    data cannot be decoded. The slice grid must be chosen from the original
+    size, see ``image_slicing.slice_image``.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    size = jpeg_size(data)
+    flags = cv2.IMREAD_COLOR
+    if size is not None:
+        grid = get_sliced_grid(size, max_slices, img_size) if max_slices > 1 else None
+        cols, rows = grid or (1, 1)
+        scale = decode_scale(size, (img_size * cols, img_size * rows))
+        flags = next((flag for s, flag in REDUCED_FLAGS if s == scale), cv2.IMREAD_COLOR)
+    img = cv2.imdecode(buffer, flags)
+    if img is None:
+        return None, None
+    if size is None:
+        return img, (img.shape[1], img.shape[0])
+    # EXIF方向可能使解码结果旋转90度, 原始尺寸随之交换
+    width, height = size
+    if (width > height) != (img.shape[1] > img.shape[0]):
+        width, height = height, width
+    return img, (width, height)
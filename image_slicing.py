@@ -0,0 +1,60 @@
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def get_sliced_grid(image_size: Tuple[int, int], max_slice_nums: int,
+                    scale_resolution: int = 448) -> Optional[Tuple[int, int]]:
+    """Pick the (columns, rows) slice grid MiniCPM-V uses for an image.
+
+    ``image_size`` is (width, height). Returns None when the image is small
+    enough to be encoded whole. Same selection as MiniCPM-V's image processor:
+    the number of slices follows the image area, and among the grids with that
+    many cells (give or take one) the one closest to the aspect ratio wins.
+    """
+    width, height = image_size
+    log_ratio = math.log(width / height)
+    ratio = width * height / (scale_resolution * scale_resolution)
+    multiple = min(math.ceil(ratio), max_slice_nums)
+    if multiple <= 1:
+        return None
+
+    candidate_grids = []
+    for split_grids_nums in (multiple - 1, multiple, multiple + 1):
+        if split_grids_nums == 1 or split_grids_nums > max_slice_nums:
+            continue
+        for m in range(1, split_grids_nums + 1):
+            if split_grids_nums % m == 0:
+                candidate_grids.append((m, split_grids_nums // m))
+
+    best_grid = (1, 1)
+    min_error = float("inf")
+    for grid in candidate_grids:
+        error = abs(log_ratio - math.log(grid[0] / grid[1]))
+        if error < min_error:
+            best_grid = grid
+            min_error = error
+    return best_grid
+
+
+def slice_image(img: np.ndarray, max_slice_nums: int, scale_resolution: int = 448,
+                image_size: Optional[Tuple[int, int]] = None) -> List[np.ndarray]:
+    """Return the overview image followed by its slices in row-major order.
+
+    Slices are views into ``img``; each one is later resized to the encoder's
+    input size like the overview. ``image_size`` is the (width, height) the
+    grid is chosen for when ``img`` was decoded at reduced resolution.
+    """
+    height, width = img.shape[:2]
+    grid = get_sliced_grid(image_size or (width, height), max_slice_nums, scale_resolution)
+    tiles = [img]
+    if grid is None:
+        return tiles
+    cols, rows = grid
+    xs = [round(width * i / cols) for i in range(cols + 1)]
+    ys = [round(height * j / rows) for j in range(rows + 1)]
+    for j in range(rows):
+        for i in range(cols):
+            tiles.append(img[ys[j]:ys[j + 1], xs[i]:xs[i + 1]])
+    return tiles
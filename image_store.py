@@ -0,0 +1,88 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+_SHA256_NAME_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def image_content_key(path: str) -> str:
+    """SHA-256 of an image file's content, taken from an ImageStore file name when possible"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if _SHA256_NAME_RE.match(stem):
+        return stem
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """Uploaded images saved under the SHA-256 of their content.
+
+    Identical uploads map to the same file, so saving one again (Streamlit
+    does on every rerun) leaves the file untouched, and concurrent sessions
+    never overwrite each other's image. ``collect`` removes files first
+    saved more than ``max_age`` seconds ago, then the oldest ones until the
+    directory is under ``max_bytes``; it runs after every new file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024, max_age: float = 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def save(self, data: bytes, suffix: str = "") -> str:
+        """Store image bytes and return the file path"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.directory, f"{digest}{suffix.lower()}")
+        with self._lock:
+            if os.path.exists(path):
+                # 已有相同内容的文件; 不修改它, 文件名即内容哈希
+                return path
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            self._collect(keep=path)
+        return path
+
+    def collect(self) -> int:
+        """Remove expired files and trim the directory to ``max_bytes``; returns files removed"""
+        with self._lock:
+            return self._collect()
+
+    def _collect(self, keep: Optional[str] = None) -> int:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.path != keep:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        expired_before = time.time() - self.max_age
+        removed = 0
+        for mtime, size, path in files:
+            if mtime >= expired_before and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
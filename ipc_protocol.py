@@ -0,0 +1,53 @@
+import json
+import threading
+
+# Frame types exchanged between StreamlitSubprocessManager and multiprocess_inference.py.
+# Every frame is one JSON object on its own line; all frames except "ready"
+# carry the "id" of the request they belong to.
+READY = "ready"        # worker -> client: models loaded, requests accepted
+REQUEST = "request"    # client -> worker: {"id", "image", "text", optional "session", optional "timeout" seconds}
+CANCEL = "cancel"      # client -> worker: {"id"}, stop the request; it ends with an error frame
+TOKEN = "token"        # worker -> client: {"id", "text", "tokens"}, several tokens' text per frame
+TIMING = "timing"      # worker -> client: {"id", "stage", "seconds", ...}
+DONE = "done"          # worker -> client: {"id"}
+ERROR = "error"        # worker -> client: {"id", "message"}
+
+# Error message of a request cancelled because its "timeout" passed
+DEADLINE_EXCEEDED = "Deadline exceeded"
+
+# Where the image goes inside a request's "text"; without it the image is put first
+IMAGE_MARKER = "{{image}}"
+
+
+def encode_frame(frame: dict) -> bytes:
+    return (json.dumps(frame, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def read_frames(stream):
+    """Yield frames from a binary stream until EOF"""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            print(f"Ignoring malformed frame {line[:80]!r}: {e}")
+
+
+class FrameWriter:
+    """Thread-safe writer of frames to a binary stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def send(self, frame: dict) -> None:
+        data = encode_frame(frame)
+        with self._lock:
+            self.stream.write(data)
+            self.stream.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self.stream.close()
@@ -0,0 +1,119 @@
+import json
+from typing import Dict, Optional
+
+MiB = 1024 * 1024
+GiB = 1024 * MiB
+
+
+def parse_meminfo(text: str) -> Dict[str, int]:
+    """Parse /proc/meminfo text into field -> bytes"""
+    meminfo = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(":")
+        parts = value.split()
+        if not parts:
+            continue
+        try:
+            amount = int(parts[0])
+        except ValueError:
+            continue
+        meminfo[name.strip()] = amount * 1024 if len(parts) > 1 and parts[1] == "kB" else amount
+    return meminfo
+
+
+def read_meminfo(path: str = "/proc/meminfo") -> Dict[str, int]:
+    """The current /proc/meminfo, or an empty dict where it does not exist"""
+    try:
+        with open(path, "r") as f:
+            return parse_meminfo(f.read())
+    except OSError:
+        return {}
+
+
+def load_model_config(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def kv_cache_bytes_per_token(config: dict, bytes_per_value: int = 2) -> int:
+    """KV cache size of one context token: keys and values for every layer and KV head"""
+    head_dim = config.get("head_dim") or config["hidden_size"] // config["num_attention_heads"]
+    kv_heads = config.get("num_key_value_heads", config["num_attention_heads"])
+    return 2 * config["num_hidden_layers"] * kv_heads * head_dim * bytes_per_value
+
+
+class MemoryPlanner:
+    """Picks the LLM context length from the memory left after everything else is loaded.
+
+    The budget is MemAvailable before the models load, minus the LLM weights,
+    the vision encoder weights times the number of encoder instances, a
+    runtime overhead on both, the host-side caches and a reserve for the OS.
+    What remains is spent on the KV cache, whose size per token follows from
+    the model's config.json. The context length is rounded down to
+    ``context_step`` and capped at ``max_context_len_cap`` and the model's
+    ``max_position_embeddings``.
+
+    Everything is passed in, so plans can be computed for synthetic meminfo.
+    """
+
+    def __init__(self, meminfo: Dict[str, int], config: dict, llm_model_bytes: int, vision_model_bytes: int,
+                 vision_instances: int = 1, cache_bytes: int = 0, os_reserve_bytes: int = GiB,
+                 runtime_overhead: float = 0.1, kv_bytes_per_value: int = 2, min_context_len: int = 1024,
+                 max_context_len_cap: int = 4096, context_step: int = 256, max_new_tokens_cap: int = 1024):
+        self.meminfo = meminfo
+        self.config = config
+        self.llm_model_bytes = llm_model_bytes
+        self.vision_model_bytes = vision_model_bytes
+        self.vision_instances = vision_instances
+        self.cache_bytes = cache_bytes
+        self.os_reserve_bytes = os_reserve_bytes
+        self.runtime_overhead = runtime_overhead
+        self.kv_bytes_per_value = kv_bytes_per_value
+        self.min_context_len = min_context_len
+        self.max_context_len_cap = max_context_len_cap
+        self.context_step = context_step
+        self.max_new_tokens_cap = max_new_tokens_cap
+
+    def available_bytes(self) -> Optional[int]:
+        if "MemAvailable" in self.meminfo:
+            return self.meminfo["MemAvailable"]
+        if "MemFree" in self.meminfo:
+            # 旧内核没有MemAvailable, 用空闲内存加可回收的页缓存估算
+            return self.meminfo["MemFree"] + self.meminfo.get("Cached", 0) + self.meminfo.get("Buffers", 0)
+        return None
+
+    def plan(self) -> dict:
+        """Return the chosen limits and how the budget was split, all sizes in bytes"""
+        per_token = kv_cache_bytes_per_token(self.config, self.kv_bytes_per_value)
+        limit = min(self.max_context_len_cap, self.config.get("max_position_embeddings", self.max_context_len_cap))
+        weights = self.llm_model_bytes + self.vision_model_bytes * self.vision_instances
+        reserved = int(weights * (1 + self.runtime_overhead)) + self.cache_bytes + self.os_reserve_bytes
+        available = self.available_bytes()
+        if available is None:
+            kv_budget = None
+            max_context_len = limit
+        else:
+            kv_budget = available - reserved
+            max_context_len = max(kv_budget, 0) // per_token // self.context_step * self.context_step
+            max_context_len = min(max_context_len, limit)
+        fits = max_context_len >= self.min_context_len
+        if not fits:
+            max_context_len = self.min_context_len
+        return {
+            "max_context_len": max_context_len,
+            "max_new_tokens": min(self.max_new_tokens_cap, max_context_len // 4),
+            "kv_bytes_per_token": per_token,
+            "available_bytes": available,
+            "reserved_bytes": reserved,
+            "kv_budget_bytes": kv_budget,
+            "fits": fits,
+        }
+
+
+def format_plan(plan: dict) -> str:
+    def mib(value):
+        return "unknown" if value is None else f"{value / MiB:.0f} MB"
+    return (f"Memory plan: max_context_len {plan['max_context_len']}, max_new_tokens {plan['max_new_tokens']} "
+            f"(available {mib(plan['available_bytes'])}, reserved {mib(plan['reserved_bytes'])}, "
+            f"KV cache budget {mib(plan['kv_budget_bytes'])} at {plan['kv_bytes_per_token'] / 1024:.0f} KB/token)"
+            + ("" if plan["fits"] else " -- not enough memory, expect swapping or OOM"))
@@ -0,0 +1,169 @@
+import bisect
+import collections
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Sequence
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+class Histogram:
+    """Cumulative bucket counts for the text format plus a window of recent values for quantiles"""
+
+    def __init__(self, buckets: Sequence[float], window: int = 2048):
+        self.buckets = tuple(sorted(buckets))
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Quantile of the recent window, None before the first observation"""
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in label_key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not isinstance(value, int) else str(value)
+
+
+class MetricsRegistry:
+    """Named histograms and counters, keyed by label values.
+
+    Families are declared once with ``histogram``/``counter``; observations
+    from any thread go through ``observe``/``inc``. ``stats`` returns
+    count, mean, p50, p90 and p99 per label set for use from Python, and
+    ``render`` produces the Prometheus text exposition format.
+    """
+
+    def __init__(self, namespace: str = "minicpmv"):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = SECONDS_BUCKETS) -> None:
+        self._families[name] = {"type": "histogram", "help": help_text, "buckets": buckets, "series": {}}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._families[name] = {"type": "counter", "help": help_text, "series": {}}
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        family = self._families[name]
+        key = _label_key(labels)
+        with self._lock:
+            histogram = family["series"].get(key)
+            if histogram is None:
+                histogram = family["series"][key] = Histogram(family["buckets"])
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        family = self._families[name]
+        key = _label_key(labels)
+        with self._lock:
+            family["series"][key] = family["series"].get(key, 0) + amount
+
+    def reset(self) -> None:
+        """Drop every recorded value, keeping the declared families"""
+        with self._lock:
+            for family in self._families.values():
+                family["series"] = {}
+
+    def stats(self) -> Dict[str, dict]:
+        """Per family, per label set ("stage=vision", or "" without labels): a summary or counter value"""
+        result = {}
+        with self._lock:
+            for name, family in self._families.items():
+                series = {}
+                for key, value in family["series"].items():
+                    label = ",".join(f"{k}={v}" for k, v in key)
+                    series[label] = value.summary() if family["type"] == "histogram" else value
+                result[name] = series
+        return result
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, family in self._families.items():
+                full_name = f"{self.namespace}_{name}"
+                lines.append(f"# HELP {full_name} {family['help']}")
+                lines.append(f"# TYPE {full_name} {family['type']}")
+                for key, value in sorted(family["series"].items()):
+                    if family["type"] == "counter":
+                        lines.append(f"{full_name}{_format_labels(key)} {_format_value(value)}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets, value.bucket_counts):
+                        cumulative += count
+                        bucket_labels = _format_labels(key, 'le="%s"' % bound)
+                        lines.append(f"{full_name}_bucket{bucket_labels} {cumulative}")
+                    bucket_labels = _format_labels(key, 'le="+Inf"')
+                    lines.append(f"{full_name}_bucket{bucket_labels} {value.count}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {_format_value(value.sum)}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+def pipeline_metrics() -> MetricsRegistry:
+    """The metric families recorded by InferencePipeline"""
+    registry = MetricsRegistry()
+    registry.histogram("stage_seconds", "Time each request spends in a pipeline stage")
+    registry.histogram("inter_token_seconds", "Time between consecutive generated tokens",
+                       (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.5))
+    registry.histogram("response_tokens", "Tokens generated per request", TOKEN_BUCKETS)
+    registry.counter("requests_total", "Finished requests by status")
+    registry.counter("vision_cache_total", "Vision embedding lookups by result")
+    return registry
+
+
+def start_metrics_server(registry: MetricsRegistry, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve ``registry`` as text on http://host:port/metrics from a daemon thread"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
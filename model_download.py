@@ -0,0 +1,288 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional
+
+CHUNK_BYTES = 32 * 1024 * 1024
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+MANIFEST_NAME = "manifest.json"
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def sha256_file(path: str, on_progress: Optional[Callable[[int], None]] = None) -> str:
+    digest = hashlib.sha256()
+    done = 0
+    buffer = bytearray(HASH_CHUNK_BYTES)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+            done += n
+            if on_progress is not None:
+                on_progress(done)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """SHA-256 of verified files, with the size and mtime they had when hashed.
+
+    A file whose size and mtime still match its entry is trusted without
+    hashing it again; any other file is re-hashed and compared.
+    """
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _save(self) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def record(self, name: str, path: str, sha256: str) -> None:
+        stat = os.stat(path)
+        with self._lock:
+            self.entries[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+            self._save()
+
+    def verify(self, name: str, path: str) -> Optional[bool]:
+        """True if ``path`` matches its entry, False if not, None without an entry or file"""
+        entry = self.entries.get(name)
+        if entry is None or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        # 文件被touch或复制过, 重新计算哈希
+        if sha256_file(path) != entry["sha256"]:
+            return False
+        self.record(name, path, entry["sha256"])
+        return True
+
+
+class RemoteFile:
+    def __init__(self, url: str, size: int, sha256: Optional[str], ranges: bool):
+        self.url = url
+        self.size = size
+        self.sha256 = sha256
+        self.ranges = ranges
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def probe(url: str, timeout: float = 30) -> RemoteFile:
+    """HEAD ``url``, following redirects by hand to keep the Hugging Face LFS headers.
+
+    The first response of a Hugging Face ``resolve`` URL carries the file's
+    SHA-256 (``X-Linked-Etag``) and size before redirecting to the CDN.
+    """
+    opener = urllib.request.build_opener(_NoRedirect)
+    sha256 = None
+    size = None
+    for _ in range(10):
+        request = urllib.request.Request(url, method="HEAD")
+        try:
+            response = opener.open(request, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            if e.code not in (301, 302, 303, 307, 308):
+                raise
+            response = e
+        headers = response.headers
+        response.close()
+        linked_etag = (headers.get("X-Linked-Etag") or "").strip('"')
+        if _SHA256_RE.match(linked_etag):
+            sha256 = linked_etag
+        if headers.get("X-Linked-Size"):
+            size = int(headers["X-Linked-Size"])
+        location = headers.get("Location")
+        if response.status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if headers.get("Content-Length"):
+            size = int(headers["Content-Length"])
+        if size is None:
+            raise RuntimeError(f"Server did not report the size of {url}")
+        return RemoteFile(url, size, sha256, headers.get("Accept-Ranges", "").lower() == "bytes")
+    raise RuntimeError(f"Too many redirects for {url}")
+
+
+class ChunkedDownloader:
+    """Downloads files as parallel byte ranges that survive interruption.
+
+    Data goes to ``<dest>.part``; the indices of finished chunks are kept in
+    ``<dest>.part.json``, so a later call with the same destination only
+    fetches the chunks still missing. When the file is complete it is
+    hashed, checked against the SHA-256 the server announced (if any),
+    renamed into place and recorded in the directory's manifest.
+
+    ``on_progress(name, done_bytes, total_bytes)`` is called from the calling
+    thread about twice a second, never from the worker threads.
+    """
+
+    def __init__(self, workers: int = 4, chunk_bytes: int = CHUNK_BYTES, timeout: float = 30, retries: int = 3):
+        self.workers = workers
+        self.chunk_bytes = chunk_bytes
+        self.timeout = timeout
+        self.retries = retries
+
+    def download(self, urls: List[str], dest: str, on_progress: Optional[Callable[[str, int, int], None]] = None,
+                 manifest: Optional[Manifest] = None) -> str:
+        """Fetch the first of ``urls`` that answers (a mirror first, then the origin) and return its SHA-256"""
+        name = os.path.basename(dest)
+        remote = None
+        errors = []
+        for url in urls:
+            try:
+                remote = probe(url, self.timeout)
+                break
+            except (OSError, RuntimeError) as e:
+                errors.append(f"{url}: {e}")
+        if remote is None:
+            raise RuntimeError(f"Cannot download {name}: " + "; ".join(errors))
+
+        part_path = f"{dest}.part"
+        state_path = f"{part_path}.json"
+        state = self._load_state(state_path, remote)
+        if state is None or not os.path.exists(part_path):
+            state = {"size": remote.size, "chunk_bytes": self.chunk_bytes, "sha256": remote.sha256, "done": []}
+            with open(part_path, "wb") as f:
+                f.truncate(remote.size)
+
+        report = (lambda done: on_progress(name, done, remote.size)) if on_progress else (lambda done: None)
+        if remote.ranges and remote.size > 0:
+            self._fetch_chunks(remote, part_path, state, state_path, report)
+        else:
+            self._fetch_whole(remote, part_path, report)
+
+        sha256 = sha256_file(part_path)
+        if remote.sha256 is not None and sha256 != remote.sha256:
+            os.remove(part_path)
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            raise RuntimeError(f"{name} failed verification: SHA-256 {sha256}, expected {remote.sha256}")
+        os.replace(part_path, dest)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        if manifest is not None:
+            manifest.record(name, dest, sha256)
+        return sha256
+
+    def _load_state(self, state_path, remote):
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # 远端文件变化或分块大小不同时从头下载
+        if (state.get("size") != remote.size or state.get("chunk_bytes") != self.chunk_bytes
+                or state.get("sha256") != remote.sha256):
+            return None
+        return state
+
+    def _fetch_chunks(self, remote, part_path, state, state_path, report):
+        chunk_count = (remote.size + self.chunk_bytes - 1) // self.chunk_bytes
+        done_chunks = set(state["done"])
+        todo = [i for i in range(chunk_count) if i not in done_chunks]
+        lock = threading.Lock()
+        progress = {"bytes": sum(min(self.chunk_bytes, remote.size - i * self.chunk_bytes) for i in done_chunks)}
+
+        def add_progress(n):
+            with lock:
+                progress["bytes"] += n
+
+        def finish_chunk(index):
+            with lock:
+                state["done"].append(index)
+                tmp_path = f"{state_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, state_path)
+
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self._fetch_chunk, remote, fd, i, add_progress): i for i in todo}
+                pending = set(futures)
+                while pending:
+                    finished, pending = wait(pending, timeout=0.5, return_when=FIRST_EXCEPTION)
+                    # 先记录同一批中成功的分块, 再报告失败, 以免续传时重复下载
+                    failed = [future for future in finished if future.exception() is not None]
+                    for future in finished:
+                        if future.exception() is None:
+                            finish_chunk(futures[future])
+                    if failed:
+                        for other in pending:
+                            other.cancel()
+                        # 等待仍在下载的分块, 成功的也记录下来, 续传时不再重复下载
+                        for future in wait(pending).done:
+                            if not future.cancelled() and future.exception() is None:
+                                finish_chunk(futures[future])
+                        raise failed[0].exception()
+                    report(progress["bytes"])
+        finally:
+            os.close(fd)
+
+    def _fetch_chunk(self, remote, fd, index, add_progress):
+        start = index * self.chunk_bytes
+        end = min(start + self.chunk_bytes, remote.size) - 1
+        for attempt in range(self.retries + 1):
+            offset = start
+            try:
+                request = urllib.request.Request(remote.url, headers={"Range": f"bytes={start}-{end}"})
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    if response.status != 206:
+                        raise RuntimeError(f"Server ignored the range request (HTTP {response.status})")
+                    while offset <= end:
+                        data = response.read(min(1024 * 1024, end + 1 - offset))
+                        if not data:
+                            raise OSError(f"Connection closed at byte {offset} of chunk {index}")
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        add_progress(len(data))
+                return
+            except (OSError, RuntimeError) as e:
+                # 本块已写入的部分会重新下载, 先从进度中扣除
+                add_progress(start - offset)
+                if attempt == self.retries:
+                    raise
+                print(f"Chunk {index} failed ({e}), retrying")
+                time.sleep(min(2 ** attempt, 10))
+
+    def _fetch_whole(self, remote, part_path, report):
+        """Servers without range support: one sequential stream, restarted from the beginning"""
+        done = 0
+        last_report = 0.0
+        with urllib.request.urlopen(remote.url, timeout=self.timeout) as response, open(part_path, "wb") as f:
+            while True:
+                data = response.read(1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+                done += len(data)
+                if time.monotonic() - last_report >= 0.5:
+                    last_report = time.monotonic()
+                    report(done)
+        if done != remote.size:
+            raise RuntimeError(f"Download of {remote.url} ended after {done} of {remote.size} bytes")
+        report(done)
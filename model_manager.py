@@ -1,13 +1,22 @@
 import os
+import time
 from pathlib import Path
-from huggingface_hub import snapshot_download
 import streamlit as st
+from image_store import ImageStore
+from model_download import ChunkedDownloader, Manifest
 
 # Configuration
 MODEL_DIR = "model"
 HF_REPO = "thanhtantran/MiniCPM-V-2_6-rkllm"
 REQUIRED_FILES = ["qwen.rkllm", "vision_transformer.rknn"]
+HF_ENDPOINT = os.environ.get("HF_ENDPOINT", "https://huggingface.co")
+# Optional local mirror tried before Hugging Face, serving the files as <MODEL_MIRROR_URL>/<file>
+MODEL_MIRROR_URL = os.environ.get("MODEL_MIRROR_URL", "")
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
 TEMP_DIR = "temp_images"
+# Uploaded images unused for this long, or beyond this total size, are removed
+TEMP_IMAGES_MAX_AGE = float(os.environ.get("TEMP_IMAGES_MAX_AGE", 24 * 3600))
+TEMP_IMAGES_MAX_BYTES = int(os.environ.get("TEMP_IMAGES_MAX_BYTES", 512 * 1024 * 1024))
 
 class ModelManager:
     def __init__(self):
@@ -15,47 +24,68 @@ class ModelManager:
         # Fix: Create temp_dir relative to current working directory
         self.temp_dir = Path.cwd() / TEMP_DIR
         self.temp_dir.mkdir(exist_ok=True)
+        self.image_store = ImageStore(str(self.temp_dir), max_bytes=TEMP_IMAGES_MAX_BYTES,
+                                      max_age=TEMP_IMAGES_MAX_AGE)
         
     def check_model_files(self):
-        """Check if required model files exist"""
+        """Check if required model files exist and are intact.
+        
+        Files recorded in the download manifest are trusted while their size and
+        mtime are unchanged, and re-hashed otherwise; a file that fails the check
+        counts as missing so it is downloaded again. Files from before the
+        manifest existed cannot be verified and are accepted as they are.
+        """
         if not self.model_dir.exists():
             return False, []
         
         existing_files = []
         missing_files = []
+        manifest = Manifest(str(self.model_dir))
         
         for file in REQUIRED_FILES:
             file_path = self.model_dir / file
-            if file_path.exists():
+            if file_path.exists() and manifest.verify(file, str(file_path)) is not False:
                 existing_files.append(file)
             else:
                 missing_files.append(file)
         
         return len(missing_files) == 0, existing_files
     
+    def model_urls(self, file):
+        """Where a model file can be downloaded from, the mirror first"""
+        urls = [f"{HF_ENDPOINT}/{HF_REPO}/resolve/main/model/{file}"]
+        if MODEL_MIRROR_URL:
+            urls.insert(0, f"{MODEL_MIRROR_URL.rstrip('/')}/{file}")
+        return urls
+    
     def download_models(self, progress_callback=None):
-        """Download model files from Hugging Face"""
+        """Download model files in parallel chunks, resuming an interrupted download.
+        
+        Files that check_model_files accepts are kept, including those from before
+        the manifest existed.
+        """
         try:
             if progress_callback:
                 progress_callback("Starting download...")
             
-            snapshot_download(
-                repo_id=HF_REPO,
-                local_dir=self.model_dir,
-                allow_patterns=[f"model/{file}" for file in REQUIRED_FILES]
-            )
+            self.model_dir.mkdir(exist_ok=True)
+            manifest = Manifest(str(self.model_dir))
+            downloader = ChunkedDownloader(workers=DOWNLOAD_WORKERS)
+            start_time = time.monotonic()
             
-            # Move files from model/model/ to model/ (since snapshot_download preserves repo structure)
-            import shutil
-            model_subfolder = self.model_dir / "model"
-            if model_subfolder.exists():
-                for file in REQUIRED_FILES:
-                    src = model_subfolder / file
-                    dst = self.model_dir / file
-                    if src.exists():
-                        shutil.move(str(src), str(dst))
-                # Remove the empty model subfolder
-                model_subfolder.rmdir()            
+            def report(name, done, total):
+                if progress_callback:
+                    speed = done / max(time.monotonic() - start_time, 1e-6) / 1024 / 1024
+                    progress_callback(f"Downloading {name}: {done / 1024 / 1024:.0f} / {total / 1024 / 1024:.0f} MB "
+                                      f"({100 * done / max(total, 1):.1f}%, {speed:.1f} MB/s)")
+            
+            for file in REQUIRED_FILES:
+                file_path = self.model_dir / file
+                # 与check_model_files一致: 清单之前已有的文件 (verify返回None) 不重新下载
+                if file_path.exists() and manifest.verify(file, str(file_path)) is not False:
+                    continue
+                start_time = time.monotonic()
+                downloader.download(self.model_urls(file), str(file_path), report, manifest)
             
             if progress_callback:
                 progress_callback("Download completed!")
@@ -67,17 +97,10 @@ class ModelManager:
             return False
     
     def save_uploaded_image(self, uploaded_file):
-        """Save uploaded image to temp directory"""
+        """Save uploaded image to temp directory, named by its content hash"""
         try:
-            # Create a temporary file with the original extension
-            file_extension = Path(uploaded_file.name).suffix
-            temp_file = self.temp_dir / f"image{file_extension}"
-            
-            # Save the uploaded file
-            with open(temp_file, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            
-            return str(temp_file)
+            # Same content, same file: reruns skip the write and sessions never overwrite each other
+            return self.image_store.save(uploaded_file.getvalue(), Path(uploaded_file.name).suffix)
         except Exception as e:
             st.error(f"Failed to save image: {e}")
             return None
\ No newline at end of file
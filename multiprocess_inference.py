@@ -1,67 +1,336 @@
 import faulthandler
 faulthandler.enable()
 import os
+import hashlib
 import time
 import signal
+import ctypes
+import re
+import sys
+import queue
+import argparse
+import threading
+import collections
 from multiprocessing import Process, Queue, Event
-import cv2
 import numpy as np
 from rkllm_binding import *
 from rknnlite.api.rknn_lite import RKNNLite
+from embedding_cache import EmbeddingCache, hash_image_bytes
+from shm_transport import EmbeddingRing
+from prompt_cache import PromptCacheManager
+from session_manager import SessionStore, estimate_tokens, trim_history
+from preprocess import ImagePreprocessor
+from image_slicing import slice_image
+from image_decode import decode_image
+from image_store import image_content_key
+from vision_pool import VisionEncoderPool
+from metrics import pipeline_metrics, start_metrics_server
+from token_sink import TokenSink
+from startup import StartupTimeline, prefetch_files, timed_phase
+from memory_planner import MemoryPlanner, format_plan, load_model_config, read_meminfo, MiB
+from prompt_tokens import PromptCounter, over_length_error
+import ipc_protocol
 
-# 视觉编码器进程
-def vision_encoder_process(load_ready_queue, embedding_queue, img_path_queue, start_event):
-    
-    VISION_ENCODER_PATH = "model/vision_transformer.rknn"
-    img_size = 448
-    
-    # 初始化视觉编码器
+VISION_ENCODER_PATH = os.environ.get("VISION_ENCODER_PATH", "model/vision_transformer.rknn")
+LLM_MODEL_PATH = os.environ.get("LLM_MODEL_PATH", "model/qwen.rkllm")
+# 语言模型的config.json, 用于计算每个token的KV缓存大小
+LLM_CONFIG_PATH = os.environ.get("LLM_CONFIG_PATH", "config.json")
+# 分词器文件 (added_tokens.json, vocab.json, merges.txt) 所在目录, 用于在发送前统计提示词token数
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR", ".")
+IMG_SIZE = 448
+# 视觉模型接受uint8 NHWC输入时设为1, 避免float32输入带来的4倍内存开销
+VISION_INPUT_UINT8 = os.environ.get("VISION_INPUT_UINT8", "0") == "1"
+# 高分辨率模式: 按MiniCPM-V的切片方案最多切成多少块 (1表示关闭, 官方默认9); 每块增加一次视觉编码和64个图像token
+VISION_MAX_SLICES = int(os.environ.get("VISION_MAX_SLICES", 1))
+# 视觉编码器部署方式: latency (一个实例占用全部NPU核心), throughput (每个核心一个实例), auto (按队列深度选择)
+# 每个实例都会加载一份模型, throughput需要3倍、auto需要4倍的视觉模型内存
+VISION_POOL_MODE = os.environ.get("VISION_POOL_MODE", "latency")
+# 视觉进程一次最多合并处理的排队请求数
+VISION_BATCH_MAX = int(os.environ.get("VISION_BATCH_MAX", 3))
+# 视觉编码器空闲多少秒后释放, 以及可用内存低于多少MB时在空闲时提前释放; 默认都关闭 (0), 编码器常驻
+# 释放后下一张未缓存的图片会重新加载模型; 缓存命中不需要编码器
+VISION_IDLE_TIMEOUT = float(os.environ.get("VISION_IDLE_TIMEOUT", 0))
+VISION_RELEASE_MIN_AVAILABLE_MB = int(os.environ.get("VISION_RELEASE_MIN_AVAILABLE_MB", 0))
+VISION_IDLE_POLL = 5
+# 图像嵌入缓存: 内存LRU字节上限, 以及可选的磁盘缓存目录 (按视觉模型和预处理方式分子目录)
+EMBEDDING_CACHE_BYTES = int(os.environ.get("EMBEDDING_CACHE_BYTES", 256 * 1024 * 1024))
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR") or None
+# 进程间共享内存环形缓冲区: 槽位数量和每个槽位的字节数
+EMBEDDING_RING_SLOTS = 4
+EMBEDDING_RING_SLOT_BYTES = 16 * 1024 * 1024
+# 流水线深度: 同时处于视觉编码/排队/解码阶段的最大请求数
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 2))
+# 提示词缓存目录 (设为空字符串可关闭); 每个请求共享的模板前缀会预先计算并保存KV缓存
+PROMPT_CACHE_DIR = os.environ.get("PROMPT_CACHE_DIR", "cache/prompt")
+PROMPT_PREFIX = """<|im_start|>system
+You are a helpful assistant.<|im_end|>
+<|im_start|>user
+"""
+PROMPT_CACHE_PREFIXES = [PROMPT_PREFIX]
+# 多轮对话会话: 内存上限, 空闲超时(秒), 以及是否为每个会话保存提示词缓存以便只预填充新消息
+SESSION_MAX_BYTES = int(os.environ.get("SESSION_MAX_BYTES", 64 * 1024 * 1024))
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", 30 * 60))
+SESSION_PROMPT_CACHE = os.environ.get("SESSION_PROMPT_CACHE", "0") == "1"
+# 启动时并行把两个模型文件预读进页缓存, 加快从eMMC/SD卡冷启动
+STARTUP_PREFETCH = os.environ.get("STARTUP_PREFETCH", "1") == "1"
+# 宣布就绪前先用这张图片跑一次完整推理 (例如 man.jpg), 首个真实请求不再承担一次性初始化开销; 为空则跳过
+STARTUP_WARMUP_IMAGE = os.environ.get("STARTUP_WARMUP_IMAGE", "")
+STARTUP_WARMUP_PROMPT = "Answer in one word: what is in the image?"
+# 请求的默认截止时间(秒), 超时的请求与主动取消一样中止生成 (0表示不限制)
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 0))
+# 已取消请求ID最多记录多少个
+CANCELLED_IDS_MAX = 1024
+# 设置后在 http://127.0.0.1:<端口>/metrics 提供各阶段耗时的直方图 (Prometheus文本格式)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# 上下文长度: 0表示启动时按可用内存自动计算 (不超过MAX_CONTEXT_LEN_CAP), 否则使用给定值
+MAX_CONTEXT_LEN = int(os.environ.get("MAX_CONTEXT_LEN", 0))
+MAX_CONTEXT_LEN_CAP = int(os.environ.get("MAX_CONTEXT_LEN_CAP", 4096))
+MAX_NEW_TOKENS = int(os.environ.get("MAX_NEW_TOKENS", 1024))
+# 为操作系统和其他进程保留的内存(MB)
+MEMORY_OS_RESERVE_MB = int(os.environ.get("MEMORY_OS_RESERVE_MB", 1024))
+# 每个视觉编码块产生的图像token数
+IMAGE_TOKENS_PER_TILE = 64
+VISION_POOL_INSTANCES = {"latency": 1, "throughput": 3, "auto": 4}
+
+def plan_memory(meminfo=None):
+    """Size the LLM context from available memory, see memory_planner.MemoryPlanner"""
+    def file_size(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    try:
+        config = load_model_config(LLM_CONFIG_PATH)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read {LLM_CONFIG_PATH}, using the default context length: {e}")
+        return None
+    planner = MemoryPlanner(
+        meminfo if meminfo is not None else read_meminfo(), config,
+        llm_model_bytes=file_size(LLM_MODEL_PATH), vision_model_bytes=file_size(VISION_ENCODER_PATH),
+        vision_instances=VISION_POOL_INSTANCES.get(VISION_POOL_MODE, 1),
+        cache_bytes=(EMBEDDING_CACHE_BYTES + SESSION_MAX_BYTES
+                     + max(EMBEDDING_RING_SLOTS, PIPELINE_DEPTH) * EMBEDDING_RING_SLOT_BYTES),
+        os_reserve_bytes=MEMORY_OS_RESERVE_MB * MiB, max_context_len_cap=MAX_CONTEXT_LEN_CAP,
+        max_new_tokens_cap=MAX_NEW_TOKENS)
+    plan = planner.plan()
+    if MAX_CONTEXT_LEN:
+        plan["max_context_len"] = MAX_CONTEXT_LEN
+        plan["max_new_tokens"] = min(MAX_NEW_TOKENS, MAX_CONTEXT_LEN // 4)
+    return plan
+
+def request_image_tiles():
+    """Most tiles one image is encoded as (overview plus at most VISION_MAX_SLICES slices)"""
+    return 1 + VISION_MAX_SLICES if VISION_MAX_SLICES > 1 else 1
+
+def load_prompt_counter():
+    """A PromptCounter for the bundled tokenizer files, or None if they are missing"""
+    try:
+        counter = PromptCounter(TOKENIZER_DIR, IMAGE_TOKENS_PER_TILE)
+    except (OSError, ValueError) as e:
+        print(f"Prompt token counting disabled: {e}")
+        return None
+    if not counter.exact:
+        print("tokenizers is not installed, prompt token counts are estimates")
+    return counter
+
+def remember_cancelled(cancelled, request_id, reason):
+    """Record a cancelled request ID, forgetting the oldest beyond CANCELLED_IDS_MAX"""
+    cancelled[request_id] = reason
+    while len(cancelled) > CANCELLED_IDS_MAX:
+        cancelled.popitem(last=False)
+
+def load_vision_encoder(core_mask):
+    """Load the vision encoder model onto the given NPU cores"""
     vision_encoder = RKNNLite(verbose=False)
     model_size = os.path.getsize(VISION_ENCODER_PATH)
-    print(f"Start loading vision encoder model (size: {model_size / 1024 / 1024:.2f} MB)")
+    print(f"Start loading vision encoder model (size: {model_size / 1024 / 1024:.2f} MB, core mask {core_mask})")
     start_time = time.time()
     vision_encoder.load_rknn(VISION_ENCODER_PATH)
     end_time = time.time()
     print(f"Vision encoder loaded in {end_time - start_time:.2f} seconds")
-    vision_encoder.init_runtime(core_mask=RKNNLite.NPU_CORE_0_1_2)
+    vision_encoder.init_runtime(core_mask=core_mask)
+    return vision_encoder
+
+def image_tiles(img, max_slices=VISION_MAX_SLICES, image_size=None):
+    """Split a decoded BGR image into the tiles the vision encoder sees.
+
+    With ``max_slices`` > 1 these are the overview and the MiniCPM-V slices;
+    their embeddings are concatenated along the token axis (overview first,
+    then slices row by row), forming a single image region for
+    RKLLM_INPUT_MULTIMODAL. ``image_size`` is the original (width, height)
+    of an image decoded at reduced resolution.
+    """
+    return slice_image(img, max_slices, IMG_SIZE, image_size) if max_slices > 1 else [img]
+
+def describe_image(image):
+    return image if isinstance(image, str) else f"<{len(image)} bytes>"
+
+def read_image(image):
+    """Return (image bytes, embedding cache key) for an image file path or encoded bytes, or (None, None)"""
+    if isinstance(image, str):
+        try:
+            with open(image, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Failed to read image {image}: {e}")
+            return None, None
+    else:
+        # 主进程直接传来的编码后图像, 无需经过文件系统
+        data = image
+    # 切片数量不同, 嵌入也不同
+    key = hash_image_bytes(data) + (f"-s{VISION_MAX_SLICES}" if VISION_MAX_SLICES > 1 else "")
+    return data, key
+
+def embedding_cache_dir():
+    """EMBEDDING_CACHE_DIR subdirectory for the current vision model and preprocessing, or None"""
+    if not EMBEDDING_CACHE_DIR:
+        return None
+    # 更换视觉模型或输入格式后, 旧的磁盘嵌入不再适用, 放在不同的子目录中
+    stat = os.stat(VISION_ENCODER_PATH)
+    model_key = (f"{os.path.abspath(VISION_ENCODER_PATH)}:{stat.st_size}:{int(stat.st_mtime)}:"
+                 f"{IMG_SIZE}:{'uint8' if VISION_INPUT_UINT8 else 'float32'}")
+    return os.path.join(EMBEDDING_CACHE_DIR, hashlib.sha256(model_key.encode()).hexdigest()[:16])
+
+def encode_image_batch(images, pool, cache, queue_depth=1):
+    """Return (content key, embeddings, cache hit, decode seconds) for each image file path or bytes.
+
+    Cache hits never reach the NPU. The misses of the whole batch are encoded
+    together, so in throughput mode the pool can spread them across cores.
+    Embeddings are None for images that cannot be read or decoded; decode
+    seconds is None for images that were not decoded.
+    """
+    results = [(None, None, False, None)] * len(images)
+    misses = {}
+    for i, image in enumerate(images):
+        data, key = read_image(image)
+        if data is None:
+            continue
+        embeddings = cache.get(key)
+        if embeddings is not None:
+            results[i] = (key, embeddings, True, None)
+        elif key in misses:
+            misses[key][0].append(i)
+        else:
+            start_time = time.perf_counter()
+            # 大尺寸JPEG按需要的分辨率缩小解码
+            img, image_size = decode_image(data, IMG_SIZE, VISION_MAX_SLICES)
+            decode_seconds = time.perf_counter() - start_time
+            if img is None:
+                results[i] = (key, None, False, decode_seconds)
+                continue
+            misses[key] = ([i], image_tiles(img, image_size=image_size), decode_seconds)
     
-    # 通知主进程加载完成
-    load_ready_queue.put("vision_ready")
+    if misses:
+        print("Start vision inference...")
+        encoded = pool.encode([tiles for _, tiles, _ in misses.values()], queue_depth)
+        for (key, (indices, _, decode_seconds)), embeddings in zip(misses.items(), encoded):
+            cache.put(key, embeddings)
+            for i in indices:
+                results[i] = (key, embeddings, False, decode_seconds)
+    return results
+
+# 视觉编码器进程
+def vision_encoder_process(load_ready_queue, embedding_queue, img_path_queue, event_queue, start_event, embedding_ring,
+                           cancel_queue):
+    
+    # 初始化视觉编码器
+    phases = []
+    input_dtype = np.uint8 if VISION_INPUT_UINT8 else np.float32
+    pool = VisionEncoderPool(
+        core_masks={"all": RKNNLite.NPU_CORE_0_1_2,
+                    "single": [RKNNLite.NPU_CORE_0, RKNNLite.NPU_CORE_1, RKNNLite.NPU_CORE_2]},
+        encoder_factory=load_vision_encoder,
+        preprocessor_factory=lambda: ImagePreprocessor(IMG_SIZE, input_dtype),
+        mode=VISION_POOL_MODE)
+    with timed_phase(phases, "vision: load encoder"):
+        pool.load()
+    
+    # 通知主进程加载完成, 并附上各启动阶段的耗时
+    load_ready_queue.put(("vision_ready", phases))
+    
+    embedding_cache = EmbeddingCache(max_bytes=EMBEDDING_CACHE_BYTES, disk_dir=embedding_cache_dir())
     
     # 等待开始信号
     start_event.wait()
+
+    def release_reason(idle_seconds):
+        if VISION_IDLE_TIMEOUT and idle_seconds >= VISION_IDLE_TIMEOUT:
+            return f"idle for {idle_seconds:.0f} seconds"
+        if VISION_RELEASE_MIN_AVAILABLE_MB:
+            available = read_meminfo().get("MemAvailable")
+            if available is not None and available < VISION_RELEASE_MIN_AVAILABLE_MB * MiB:
+                return f"only {available / MiB:.0f} MB memory available"
+        return None
     
-    def process_image(img_path, vision_encoder):
-        img = cv2.imread(img_path)
-        if img is None:
-            return None
-        print("Start vision inference...")
-        img = cv2.resize(img, (img_size, img_size))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = img.astype(np.float32)
-        img = img[np.newaxis, :, :, :]
+    # 已取消的请求ID; 排队中的图像在编码前丢弃
+    cancelled = collections.OrderedDict()
+    
+    watch_idle = VISION_IDLE_TIMEOUT > 0 or VISION_RELEASE_MIN_AVAILABLE_MB > 0
+    last_used = time.monotonic()
+    stopping = False
+    while not stopping:
+        try:
+            # 编码器已加载时定期醒来, 检查是否应该释放
+            items = [img_path_queue.get(timeout=VISION_IDLE_POLL if watch_idle and pool.loaded else None)]
+        except queue.Empty:
+            reason = release_reason(time.monotonic() - last_used)
+            if reason is not None:
+                pool.release()
+                print(f"Released vision encoder ({reason}), it is reloaded for the next uncached image")
+            continue
+        # 一并取出已在排队的请求, 吞吐模式下可以同时分配到多个NPU核心
+        while len(items) < VISION_BATCH_MAX:
+            try:
+                items.append(img_path_queue.get_nowait())
+            except queue.Empty:
+                break
+        if "STOP" in items:
+            stopping = True
+            items = [item for item in items if item != "STOP"]
+        while True:
+            try:
+                remember_cancelled(cancelled, cancel_queue.get_nowait(), True)
+            except queue.Empty:
+                break
+        for item in [item for item in items if item[0] in cancelled]:
+            # LLM进程仍在等待该请求的描述符, 发送取消标记代替嵌入
+            del cancelled[item[0]]
+            items.remove(item)
+            embedding_queue.put({"request_id": item[0], "error": "Cancelled", "cancelled": True})
+        if not items:
+            continue
+        try:
+            queue_depth = len(items) + img_path_queue.qsize()
+        except NotImplementedError:
+            queue_depth = len(items)
         
         start_time = time.time()
-        image_embeddings = vision_encoder.inference(inputs=[img], data_format="nhwc")[0].astype(np.float32)
-        end_time = time.time()
-        print(f"Vision encoder inference time: {end_time - start_time:.2f} seconds")
-        return image_embeddings
-
-    while True:
-        img_path = img_path_queue.get()
-        if img_path == "STOP":
-            break
-        embeddings = process_image(img_path, vision_encoder)
-        if embeddings is not None:
-            embedding_queue.put(embeddings)
-        else:
-            embedding_queue.put("ERROR")
+        pool.last_stage_seconds = {"resize": 0.0, "inference": 0.0}
+        results = encode_image_batch([image for _, image, _ in items], pool, embedding_cache, queue_depth)
+        elapsed = time.time() - start_time
+        last_used = time.monotonic()
+        stats = embedding_cache.stats()
+        print(f"Embedding cache: {stats['hits']} hits, {stats['disk_hits']} disk hits, {stats['misses']} misses")
+        
+        for (request_id, image, submitted), (image_key, embeddings, cache_hit, decode_seconds) in zip(items, results):
+            timing = {"stage": "vision", "seconds": elapsed, "cache_hit": cache_hit,
+                      "queue_wait": start_time - submitted, "decode": decode_seconds}
+            if not cache_hit:
+                timing.update(pool.last_stage_seconds)
+            if embeddings is not None:
+                # 嵌入写入共享内存槽位, 队列中只传递描述符
+                write_start = time.perf_counter()
+                descriptor = embedding_ring.write(embeddings, request_id=request_id, image_key=image_key)
+                timing["transfer"] = time.perf_counter() - write_start
+                descriptor["sent"] = time.time()
+            else:
+                descriptor = {"request_id": request_id, "error": f"Failed to process image {describe_image(image)}"}
+            event_queue.put((request_id, "timing", timing))
+            embedding_queue.put(descriptor)
 
 # LLM进程
-def llm_process(load_ready_queue, embedding_queue, prompt_queue, inference_done_queue, start_event):
+def llm_process(load_ready_queue, embedding_queue, prompt_queue, event_queue, start_event, embedding_ring,
+                cancel_queue, stream_tokens=False, memory_plan=None):
 
     
-    MODEL_PATH = "model/qwen.rkllm"
+    MODEL_PATH = LLM_MODEL_PATH
     handle = None
     
     def signal_handler(signal, frame):
@@ -75,22 +344,69 @@ def llm_process(load_ready_queue, embedding_queue, prompt_queue, inference_done_
     signal.signal(signal.SIGINT, signal_handler)
     os.environ["RKLLM_LOG_LEVEL"] = "1"
     
-    inference_count = 0
     inference_start_time = 0
+    current_request_id = None
+    prompt_cache_used = False
+    building_prompt_cache = False
+    run_failed = False
+    # 已取消请求ID -> 原因; running表示current_request_id正在NPU上运行
+    cancelled = collections.OrderedDict()
+    cancel_lock = threading.Lock()
+    running = False
+    run_finished = False
+    
+    # 回调中只把token写入预分配缓冲区, 按时间或数量合并后再解码发送
+    def emit_text(text, n_tokens):
+        if stream_tokens:
+            event_queue.put((current_request_id, "token", (text, n_tokens)))
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+    token_sink = TokenSink(emit_text)
+    # 记录相邻token的间隔, 请求结束时随耗时事件一起发送
+    last_token_time = None
+    token_gaps = []
+    queue_wait = None
     def result_callback(result, userdata, state):
-        nonlocal inference_start_time, inference_count
+        nonlocal inference_start_time, run_failed, last_token_time, run_finished
+        if building_prompt_cache:
+            # 构建提示词缓存时只做预填充, 不产生任何请求事件
+            if state == LLMCallState.RKLLM_RUN_ERROR:
+                print("\nError occurred while building prompt cache")
+            return
         if state == LLMCallState.RKLLM_RUN_NORMAL:
-            if inference_count == 0:
-                first_token_time = time.time()
-                print(f"Time to first token: {first_token_time - inference_start_time:.2f} seconds")
-            inference_count += 1
-            print(result.contents.text.decode(), end="", flush=True)
+            now = time.time()
+            if token_sink.count == 0:
+                print(f"Time to first token: {now - inference_start_time:.2f} seconds")
+                if prompt_cache is not None:
+                    prompt_cache.record_ttft(prompt_cache_used, now - inference_start_time)
+                event_queue.put((current_request_id, "timing",
+                                 {"stage": "first_token", "seconds": now - inference_start_time,
+                                  "prompt_cache": prompt_cache_used, "queue_wait": queue_wait}))
+            else:
+                token_gaps.append(now - last_token_time)
+            last_token_time = now
+            token_sink.add(result.contents.token_id, result.contents.text or b"")
         elif state == LLMCallState.RKLLM_RUN_FINISH:
+            token_sink.flush(final=True)
+            # 不加锁: 监听线程持锁调用abort时, 运行库可能等待本回调返回
+            if current_request_id in cancelled:
+                # 被中止的运行由主循环发送取消事件
+                print("\n\n(cancelled)")
+                return
+            run_finished = True
             print("\n\n(finished)")
-            inference_done_queue.put("DONE")
+            event_queue.put((current_request_id, "timing", {"stage": "total", "seconds": time.time() - inference_start_time,
+                                                            "tokens": token_sink.count,
+                                                            "inter_token": list(token_gaps)}))
+            event_queue.put((current_request_id, "DONE", None))
         elif state == LLMCallState.RKLLM_RUN_ERROR:
+            run_failed = True
+            token_sink.flush(final=True)
+            if current_request_id in cancelled:
+                return
             print("\nError occurred during LLM call")
-            inference_done_queue.put("ERROR")
+            event_queue.put((current_request_id, "ERROR", "Error occurred during LLM call"))
     
     # 初始化LLM
     param = create_default_param()
@@ -98,70 +414,716 @@ def llm_process(load_ready_queue, embedding_queue, prompt_queue, inference_done_
     param.img_start = "<image>".encode()
     param.img_end = "</image>".encode()
     param.img_content = "<unk>".encode()
+    if memory_plan is not None:
+        # KV缓存按上下文长度预先分配, 使用主进程按可用内存算出的长度
+        param.max_context_len = memory_plan["max_context_len"]
+        param.max_new_tokens = memory_plan["max_new_tokens"]
     extend_param = RKLLMExtendParam()
     extend_param.base_domain_id = 1
     param.extend_param = extend_param
     
+    phases = []
     model_size = os.path.getsize(MODEL_PATH)
     print(f"Start loading language model (size: {model_size / 1024 / 1024:.2f} MB)")
     start_time = time.time()
     handle = init(param, result_callback)
     end_time = time.time()
+    phases.append(("llm: load model", start_time, end_time))
     print(f"Language model loaded in {end_time - start_time:.2f} seconds")
     
-    # 通知主进程加载完成
-    load_ready_queue.put("llm_ready")
+    # 为固定的模板前缀构建/加载提示词缓存
+    prompt_cache = None
+    prompt_cache_start = time.time()
+    if PROMPT_CACHE_DIR:
+        def build_prompt_cache(prefix, cache_path):
+            nonlocal building_prompt_cache
+            cache_param = RKLLMPromptCacheParam()
+            cache_param.save_prompt_cache = 1
+            cache_param.prompt_cache_path = cache_path.encode()
+            build_param = RKLLMInferParam()
+            # 只需要预填充结果, 用获取隐藏层模式避免生成
+            build_param.mode = RKLLMInferMode.RKLLM_INFER_GET_LAST_HIDDEN_LAYER.value
+            build_param.prompt_cache_params = ctypes.pointer(cache_param)
+            building_prompt_cache = True
+            try:
+                run(handle, create_rkllm_input(RKLLMInputType.RKLLM_INPUT_PROMPT, prompt=prefix), build_param, None)
+            finally:
+                building_prompt_cache = False
+        
+        try:
+            prompt_cache = PromptCacheManager(handle, PROMPT_CACHE_DIR, MODEL_PATH, build_prompt_cache)
+            for prefix in PROMPT_CACHE_PREFIXES:
+                prompt_cache.ensure(prefix)
+            prompt_cache.select(PROMPT_CACHE_PREFIXES[0])
+        except (OSError, RuntimeError) as e:
+            print(f"Prompt cache disabled: {e}")
+            prompt_cache = None
+        phases.append(("llm: prompt cache", prompt_cache_start, time.time()))
+    
+    # 通知主进程加载完成, 并附上各启动阶段的耗时
+    load_ready_queue.put(("llm_ready", phases))
+    
+    def listen_for_cancellations():
+        while True:
+            item = cancel_queue.get()
+            if item == "STOP":
+                break
+            request_id, reason = item
+            with cancel_lock:
+                remember_cancelled(cancelled, request_id, reason)
+            # 中止正在运行的生成; 中止请求可能早于运行库真正开始运行, 因此重试几次.
+            # 检查和中止都在锁内进行, 以免中止紧随其后的下一个请求
+            for _ in range(10):
+                with cancel_lock:
+                    if not (running and current_request_id == request_id):
+                        break
+                    try:
+                        abort(handle)
+                    except RuntimeError as e:
+                        print(f"Abort of request {request_id} failed, retrying: {e}")
+                time.sleep(0.2)
+    
+    threading.Thread(target=listen_for_cancellations, daemon=True).start()
     
     # 创建推理参数
     infer_param = RKLLMInferParam()
     infer_param.mode = RKLLMInferMode.RKLLM_INFER_GENERATE.value
     
+    # 多轮对话会话; 被淘汰的会话通知主进程, 以便下次重新编码图像
+    sessions = SessionStore(max_bytes=SESSION_MAX_BYTES, idle_timeout=SESSION_IDLE_TIMEOUT,
+                            on_evict=lambda session: event_queue.put((None, "session_evicted", session.session_id)))
+    session_cache_dir = os.path.join(PROMPT_CACHE_DIR, "sessions") if PROMPT_CACHE_DIR else None
+    if SESSION_PROMPT_CACHE and session_cache_dir:
+        os.makedirs(session_cache_dir, exist_ok=True)
+    # 为回答预留的上下文长度
+    max_context_len = param.max_context_len
+    response_reserve = max_context_len // 4
+    if 0 < param.max_new_tokens < response_reserve:
+        response_reserve = param.max_new_tokens
+    # 裁剪会话历史时按分词器统计token; 每条消息另有角色标记等模板token
+    prompt_counter = load_prompt_counter()
+    if prompt_counter is not None:
+        empty_prompt_tokens = prompt_counter.count_prompt(build_conversation_prompt([], ""), 0)["total"]
+        turn_overhead = (prompt_counter.count_prompt(build_conversation_prompt([("", "")], ""), 0)["total"]
+                         - empty_prompt_tokens)
+        
+        def count_message(text):
+            return prompt_counter.count_text(text) + (turn_overhead + 1) // 2
+    else:
+        empty_prompt_tokens = estimate_tokens(build_conversation_prompt([], ""))
+        count_message = estimate_tokens
+    
+    # 按请求ID暂存提前到达的嵌入描述符
+    pending_embeddings = {}
+    
+    def wait_for_embedding(request_id):
+        while request_id not in pending_embeddings:
+            descriptor = embedding_queue.get()
+            pending_embeddings[descriptor["request_id"]] = descriptor
+        return pending_embeddings.pop(request_id)
+    
     while True:
-        prompt = prompt_queue.get()
-        # print(f"Received prompt: ====\n{prompt}\n====")
-        if prompt == "STOP":
+        item = prompt_queue.get()
+        if item == "STOP":
             break
-            
-        image_embeddings = embedding_queue.get()
-        if isinstance(image_embeddings, str) and image_embeddings == "ERROR":
-            print("Error processing image")
+        request_id, prompt, session_request = item
+        # print(f"Received prompt: ====\n{prompt}\n====")
+        
+        with cancel_lock:
+            reason = cancelled.pop(request_id, None)
+        if reason is not None:
+            # 开始前已取消: 取走视觉进程发来的描述符并归还槽位即可
+            if session_request is None or not session_request["reuse_image"]:
+                descriptor = wait_for_embedding(request_id)
+                if "error" not in descriptor:
+                    embedding_ring.release(descriptor)
+            event_queue.put((request_id, "CANCELLED", reason))
             continue
+        
+        session = None
+        if session_request is not None:
+            session = sessions.get(session_request["id"])
+            sessions.evict(keep=session.session_id)
+        
+        descriptor = None
+        if session is not None and session_request["reuse_image"]:
+            # 主进程判断图像未变化, 跳过了视觉编码
+            if session.embeddings is None:
+                event_queue.put((request_id, "ERROR", "Conversation expired, please ask again"))
+                continue
+            image_embeddings = session.embeddings
+        else:
+            descriptor = wait_for_embedding(request_id)
+            if descriptor.get("cancelled"):
+                # 视觉进程已丢弃该请求的图像
+                with cancel_lock:
+                    reason = cancelled.pop(request_id, descriptor["error"])
+                event_queue.put((request_id, "CANCELLED", reason))
+                continue
+            if "error" in descriptor:
+                print(f"Error processing image: {descriptor['error']}")
+                event_queue.put((request_id, "ERROR", descriptor["error"]))
+                continue
+            # 直接映射共享内存中的嵌入, 运行结束后再归还槽位
+            image_embeddings = embedding_ring.read(descriptor)
+            if session is not None:
+                session.set_image(descriptor.get("image_key"), image_embeddings)
+                embedding_ring.release(descriptor)
+                descriptor = None
+                image_embeddings = session.embeddings
+        
+        input_type = RKLLMInputType.RKLLM_INPUT_MULTIMODAL
+        save_cache_path = None
+        if session is None:
+            # 已缓存的前缀无需再次预填充
+            run_prompt = prompt_cache.select(prompt) if prompt_cache is not None else prompt
+            prompt_cache_used = run_prompt is not prompt
+        else:
+            text = session_request["text"]
+            budget = max_context_len - response_reserve - (image_embeddings.shape[1] + 2) - empty_prompt_tokens
+            history = trim_history(session.turns, text, budget, count_message)
+            if len(history) < len(session.turns):
+                print(f"Trimmed {len(session.turns) - len(history)} old turns to fit the context")
+                session.turns = history
+                session.drop_prompt_cache()
             
-        rkllm_input = create_rkllm_input(RKLLMInputType.RKLLM_INPUT_MULTIMODAL,
-                                        prompt=prompt,
-                                        image_embed=image_embeddings)
+            prompt_cache_used = False
+            if (prompt_cache is not None and history and session.prompt_cache_path
+                    and session.cached_turns == len(history)):
+                # 会话缓存已包含之前的全部上下文, 只预填充上一轮回答和新消息
+                try:
+                    prompt_cache.use(session.prompt_cache_path)
+                    run_prompt = build_followup_prompt(history[-1][1], text)
+                    input_type = RKLLMInputType.RKLLM_INPUT_PROMPT
+                    prompt_cache_used = True
+                except RuntimeError as e:
+                    print(f"Failed to load session prompt cache: {e}")
+                    session.drop_prompt_cache()
+            if not prompt_cache_used:
+                prompt = build_conversation_prompt(history, text)
+                run_prompt = prompt_cache.select(prompt) if prompt_cache is not None else prompt
+                prompt_cache_used = run_prompt is not prompt
+            if SESSION_PROMPT_CACHE and prompt_cache is not None:
+                safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", str(session.session_id))
+                save_cache_path = os.path.join(session_cache_dir, f"session_{safe_id}_{len(history) + 1}.bin")
+        
+        if input_type == RKLLMInputType.RKLLM_INPUT_PROMPT:
+            rkllm_input = create_rkllm_input(input_type, prompt=run_prompt)
+        else:
+            rkllm_input = create_rkllm_input(input_type, prompt=run_prompt, image_embed=image_embeddings)
         
+        run_param = infer_param
+        if save_cache_path is not None:
+            cache_param = RKLLMPromptCacheParam()
+            cache_param.save_prompt_cache = 1
+            cache_param.prompt_cache_path = save_cache_path.encode()
+            run_param = RKLLMInferParam()
+            run_param.mode = RKLLMInferMode.RKLLM_INFER_GENERATE.value
+            run_param.prompt_cache_params = ctypes.pointer(cache_param)
+        
+        token_sink.reset()
+        run_failed = False
+        run_finished = False
+        token_gaps.clear()
         inference_start_time = time.time()
-        run(handle, rkllm_input, infer_param, None)
+        # 嵌入在队列中等待LLM空闲的时间
+        queue_wait = inference_start_time - descriptor["sent"] if descriptor is not None and "sent" in descriptor else None
+        with cancel_lock:
+            # 与取消监听线程同步: 要么在这里发现取消而不运行, 要么由监听线程中止运行
+            current_request_id = request_id
+            running = request_id not in cancelled
+        run_error = None
+        try:
+            if running:
+                run(handle, rkllm_input, run_param, None)
+        except RuntimeError as e:
+            run_failed = True
+            run_error = str(e)
+            print(f"\n{e}")
+        finally:
+            with cancel_lock:
+                running = False
+                reason = cancelled.pop(request_id, None)
+            del rkllm_input, image_embeddings
+            if descriptor is not None:
+                embedding_ring.release(descriptor)
+        if reason is not None and not run_finished:
+            run_failed = True
+            print(f"Request {request_id} cancelled: {reason}")
+            event_queue.put((request_id, "CANCELLED", reason))
+        elif run_error is not None:
+            event_queue.put((request_id, "ERROR", run_error))
+        
+        if session is not None and not run_failed:
+            session.turns.append((session_request["text"], token_sink.text()))
+            if save_cache_path is not None and os.path.exists(save_cache_path):
+                if session.prompt_cache_path and session.prompt_cache_path != save_cache_path:
+                    os.remove(session.prompt_cache_path)
+                session.prompt_cache_path = save_cache_path
+                session.cached_turns = len(session.turns)
+        if prompt_cache is not None:
+            stats = prompt_cache.stats()
+            if stats["mean_ttft_cached"] is not None and stats["mean_ttft_uncached"] is not None:
+                print(f"Prompt cache saves {stats['mean_ttft_uncached'] - stats['mean_ttft_cached']:.2f} seconds "
+                      f"of time to first token on average")
     
     # 清理
     destroy(handle)
 
+IMAGE_PLACEHOLDER = '<image_id>0</image_id><image>\n'
+
+def format_prompt(user_text):
+    """Wrap user text that already contains the image placeholder in the chat template"""
+    return f"""{PROMPT_PREFIX}{user_text}<|im_end|>
+<|im_start|>assistant
+"""
+
+def build_prompt(full_input):
+    """Turn console input with an ``{{image path}}`` marker into (img_path, prompt)"""
+    img_match = re.search(r'\{\{(.+?)\}\}', full_input)
+    if not img_match:
+        return None, None
+    img_path = img_match.group(1)
+    # 将图片标记替换为<image>标记
+    return img_path, format_prompt(full_input.replace(img_match.group(0), IMAGE_PLACEHOLDER))
+
+def render_user_text(text, with_image=True):
+    """Put the image placeholder where a request's text has IMAGE_MARKER (or in front)"""
+    if not with_image:
+        return text.replace(ipc_protocol.IMAGE_MARKER, "the image")
+    if ipc_protocol.IMAGE_MARKER in text:
+        return text.replace(ipc_protocol.IMAGE_MARKER, IMAGE_PLACEHOLDER)
+    return IMAGE_PLACEHOLDER + text
+
+def build_request_prompt(text):
+    """Build the prompt for a protocol request's text"""
+    return format_prompt(render_user_text(text))
+
+def build_conversation_prompt(turns, text):
+    """Build the prompt for a new message after earlier (user, assistant) turns.
+
+    The image goes into the oldest turn that is still part of the history.
+    """
+    parts = [PROMPT_PREFIX]
+    for i, (user, assistant) in enumerate(turns):
+        parts.append(f"{render_user_text(user, with_image=i == 0)}<|im_end|>\n<|im_start|>assistant\n"
+                     f"{assistant}<|im_end|>\n<|im_start|>user\n")
+    parts.append(f"{render_user_text(text, with_image=not turns)}<|im_end|>\n<|im_start|>assistant\n")
+    return "".join(parts)
+
+def build_followup_prompt(last_answer, text):
+    """The part of a conversation prompt not covered by the previous turn's saved context"""
+    return (f"{last_answer}<|im_end|>\n<|im_start|>user\n"
+            f"{render_user_text(text, with_image=False)}<|im_end|>\n<|im_start|>assistant\n")
+
+class InferencePipeline:
+    """Vision and LLM worker processes driven by request IDs.
+
+    ``submit`` returns immediately while fewer than ``max_pending`` requests
+    are in flight, so the vision process encodes request N+1 while the LLM
+    process decodes request N. Completions are matched back to their request
+    by ID, which keeps a failed image from shifting later responses.
+
+    With ``stream_tokens`` the LLM process forwards tokens and timings as
+    events instead of printing them; they are delivered to the ``on_event``
+    callback given to ``submit`` as ``on_event(request_id, kind, payload)``.
+    Token events carry ``(text, n_tokens)``: consecutive tokens are coalesced
+    into one event by the LLM process's TokenSink.
+
+    Requests that pass a ``session_id`` belong to a multi-turn conversation
+    kept by the LLM process. Follow-ups about the same image file skip the
+    vision process entirely and reuse the conversation's embeddings.
+
+    Stage timings of every request are recorded in ``metrics`` (see
+    ``stats``), whether or not anyone listens to the events.
+
+    ``cancel`` (or a request's deadline passing) drops its image if the
+    vision process has not encoded it yet and aborts its generation on the
+    NPU; the request then finishes with status "CANCELLED".
+    """
+
+    def __init__(self, max_pending=PIPELINE_DEPTH, stream_tokens=False):
+        self.max_pending = max_pending
+        self.stream_tokens = stream_tokens
+        self.load_ready_queue = Queue()
+        self.embedding_queue = Queue()
+        self.img_path_queue = Queue()
+        self.prompt_queue = Queue()
+        self.event_queue = Queue()
+        self.vision_cancel_queue = Queue()
+        self.llm_cancel_queue = Queue()
+        self.start_event = Event()
+        self.embedding_ring = EmbeddingRing(max(EMBEDDING_RING_SLOTS, max_pending), EMBEDDING_RING_SLOT_BYTES)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._results = {}
+        self._session_images = {}
+        self._cancelling = set()
+        self._next_request_id = 0
+        self.metrics = pipeline_metrics()
+        self.startup_timeline = None
+        self.memory_plan = None
+        self.prompt_counter = load_prompt_counter()
+        self.vision_process = None
+        self.lm_process = None
+        self._collector = None
+
+    def start(self):
+        """Start both worker processes and wait until their models are loaded.
+
+        The model files are read into the page cache on background threads
+        while the workers initialise, and with STARTUP_WARMUP_IMAGE set one
+        full request runs before this returns. The phases end up in
+        ``startup_timeline``. The context length is chosen from the memory
+        available before the models load (``memory_plan``).
+        """
+        self.startup_timeline = StartupTimeline()
+        self.memory_plan = plan_memory()
+        if self.memory_plan is not None:
+            print(format_plan(self.memory_plan))
+        if STARTUP_PREFETCH:
+            prefetch_files([VISION_ENCODER_PATH, LLM_MODEL_PATH], self.startup_timeline)
+        self.vision_process = Process(target=vision_encoder_process,
+                                      args=(self.load_ready_queue, self.embedding_queue, self.img_path_queue,
+                                            self.event_queue, self.start_event, self.embedding_ring,
+                                            self.vision_cancel_queue))
+        self.lm_process = Process(target=llm_process,
+                                  args=(self.load_ready_queue, self.embedding_queue, self.prompt_queue,
+                                        self.event_queue, self.start_event, self.embedding_ring,
+                                        self.llm_cancel_queue, self.stream_tokens, self.memory_plan))
+        self.vision_process.start()
+        self.lm_process.start()
+        
+        # 等待模型加载
+        with self.startup_timeline.phase("workers ready"):
+            ready_count = 0
+            while ready_count < 2:
+                status, phases = self.load_ready_queue.get()
+                print(f"Received ready signal: {status}")
+                self.startup_timeline.extend(phases)
+                ready_count += 1
+        
+        self._collector = threading.Thread(target=self._collect_results, daemon=True)
+        self._collector.start()
+        self.start_event.set()
+        if STARTUP_WARMUP_IMAGE:
+            self._warm_up(STARTUP_WARMUP_IMAGE)
+        print(self.startup_timeline.summary())
+
+    def _warm_up(self, img_path):
+        """Run one request so one-time runtime costs are paid before the first real request"""
+        if not os.path.exists(img_path):
+            print(f"Warm-up image {img_path} not found, skipping warm-up")
+            return
+        with self.startup_timeline.phase(f"warm-up on {os.path.basename(img_path)}"):
+            status = self.wait(self.submit(img_path, build_request_prompt(STARTUP_WARMUP_PROMPT)))
+        if status != "DONE":
+            print("Warm-up inference failed")
+        # 预热请求不计入服务指标
+        self.metrics.reset()
+
+    def _record_timing(self, payload):
+        stage = payload["stage"]
+        if stage == "vision":
+            self.metrics.inc("vision_cache_total", result="hit" if payload["cache_hit"] else "miss")
+            for key, name in (("queue_wait", "vision_queue_wait"), ("decode", "image_decode"), ("resize", "resize"),
+                              ("inference", "vision_inference"), ("reload", "vision_reload"),
+                              ("transfer", "embedding_transfer"),
+                              ("seconds", "vision")):
+                if payload.get(key) is not None:
+                    self.metrics.observe("stage_seconds", payload[key], stage=name)
+        elif stage == "first_token":
+            self.metrics.observe("stage_seconds", payload["seconds"], stage="ttft")
+            if payload.get("queue_wait") is not None:
+                self.metrics.observe("stage_seconds", payload["queue_wait"], stage="llm_queue_wait")
+        elif stage == "total":
+            self.metrics.observe("stage_seconds", payload["seconds"], stage="generation")
+            self.metrics.observe("response_tokens", payload["tokens"])
+            # 逐token间隔只进直方图, 不再转发给事件监听者
+            for gap in payload.pop("inter_token", ()):
+                self.metrics.observe("inter_token_seconds", gap)
+
+    def stats(self):
+        """p50/p90/p99 per stage and request counters, see metrics.MetricsRegistry.stats"""
+        return self.metrics.stats()
+
+    def _expire_deadlines(self):
+        now = time.time()
+        with self._lock:
+            expired = [request_id for request_id, entry in self._pending.items()
+                       if entry[5] is not None and entry[5] < now and request_id not in self._cancelling]
+        for request_id in expired:
+            self.cancel(request_id, ipc_protocol.DEADLINE_EXCEEDED)
+
+    def _collect_results(self):
+        while True:
+            try:
+                # 定期醒来检查请求截止时间
+                item = self.event_queue.get(timeout=0.5)
+            except queue.Empty:
+                self._expire_deadlines()
+                continue
+            if item == "STOP":
+                break
+            self._expire_deadlines()
+            request_id, status, payload = item
+            if status == "session_evicted":
+                with self._lock:
+                    self._session_images.pop(payload, None)
+                continue
+            if status == "timing":
+                self._record_timing(payload)
+            if status not in ("DONE", "ERROR", "CANCELLED"):
+                with self._lock:
+                    entry = self._pending.get(request_id)
+                if entry is not None and entry[2] is not None:
+                    entry[2](request_id, status, payload)
+                continue
+            with self._lock:
+                entry = self._pending.pop(request_id, None)
+                if entry is None:
+                    continue
+                done_event, on_done, on_event, session_id, submitted, _ = entry
+                self._cancelling.discard(request_id)
+                # 有回调的请求不保留结果, 避免无人调用wait时结果堆积
+                if on_done is None:
+                    self._results[request_id] = status
+                # 出错或取消的会话下次重新编码图像
+                if status != "DONE" and session_id is not None:
+                    self._session_images.pop(session_id, None)
+            self._slots.release()
+            self.metrics.observe("stage_seconds", time.time() - submitted, stage="request")
+            self.metrics.inc("requests_total", status=status)
+            done_event.set()
+            if on_event is not None and status != "DONE":
+                on_event(request_id, "error", payload)
+            if on_done is not None:
+                on_done(request_id, status)
+
+    def submit(self, img_path, prompt, request_id=None, on_done=None, on_event=None,
+               session_id=None, text=None, image_data=None, timeout=None):
+        """Queue a request, blocking while the pipeline is full, and return its ID.
+        
+        The request is cancelled if it has not finished ``timeout`` seconds
+        after submission (REQUEST_TIMEOUT by default, 0 or None for no limit).
+        
+        ``image_data`` passes the encoded image itself instead of a file path;
+        the vision process decodes it without touching the filesystem and
+        ``img_path`` may then be None.
+
+        Session requests pass the raw user ``text`` (see ``build_request_prompt``);
+        the LLM process builds the prompt from the conversation history instead
+        of using ``prompt``.
+        
+        Prompts are counted with ``prompt_counter`` first; one whose template,
+        text and image tokens leave no room for the answer in the planned
+        context is rejected here without reaching the workers: it finishes at
+        once with an "error" event and status "ERROR". Session history is
+        trimmed to fit by the LLM process instead.
+        """
+        error = self.prompt_length_error(prompt, text, session=session_id is not None)
+        if error is not None:
+            return self._reject(request_id, error, on_done, on_event)
+        if session_id is not None and image_data is not None:
+            image_key = hash_image_bytes(image_data)
+        elif session_id is not None:
+            # 按内容而非路径和修改时间识别图像, 重新保存的同一上传仍能复用会话中的嵌入
+            image_key = image_content_key(img_path)
+        self._slots.acquire()
+        session_request = None
+        with self._lock:
+            if request_id is None:
+                self._next_request_id += 1
+                request_id = self._next_request_id
+            if timeout is None:
+                timeout = REQUEST_TIMEOUT
+            submitted = time.time()
+            self._pending[request_id] = (threading.Event(), on_done, on_event, session_id, submitted,
+                                         submitted + timeout if timeout else None)
+            if session_id is not None:
+                reuse_image = self._session_images.get(session_id) == image_key
+                self._session_images[session_id] = image_key
+                session_request = {"id": session_id, "text": text, "reuse_image": reuse_image}
+        if session_request is None or not session_request["reuse_image"]:
+            self.img_path_queue.put((request_id, img_path if image_data is None else bytes(image_data), time.time()))
+        self.prompt_queue.put((request_id, prompt, session_request))
+        return request_id
+
+    def prompt_length_error(self, prompt, text=None, session=False):
+        """Why a request leaves no room for the answer in the planned context, or None"""
+        if self.memory_plan is None or self.prompt_counter is None:
+            return None
+        # 会话的历史会在LLM进程中按需裁剪, 只需检查新消息本身
+        new_prompt = build_request_prompt(text) if session else prompt
+        counts = self.prompt_counter.count_prompt(new_prompt, request_image_tiles(), [text] if text else ())
+        return over_length_error(counts, self.memory_plan["max_context_len"], self.memory_plan["max_new_tokens"])
+
+    def _reject(self, request_id, error, on_done, on_event):
+        print(f"Rejected request: {error}")
+        with self._lock:
+            if request_id is None:
+                self._next_request_id += 1
+                request_id = self._next_request_id
+            if on_done is None:
+                self._results[request_id] = "ERROR"
+        self.metrics.inc("requests_total", status="REJECTED")
+        if on_event is not None:
+            on_event(request_id, "error", error)
+        if on_done is not None:
+            on_done(request_id, "ERROR")
+        return request_id
+
+    def cancel(self, request_id, reason="Cancelled"):
+        """Stop a request wherever it is; returns False if it is not in flight"""
+        with self._lock:
+            if request_id not in self._pending or request_id in self._cancelling:
+                return False
+            self._cancelling.add(request_id)
+        print(f"Cancelling request {request_id}: {reason}")
+        self.vision_cancel_queue.put(request_id)
+        self.llm_cancel_queue.put((request_id, reason))
+        return True
+
+    def wait(self, request_id, timeout=None):
+        """Block until a request submitted without ``on_done`` finishes.
+
+        Returns "DONE", "ERROR" or "CANCELLED", or None on timeout.
+        """
+        with self._lock:
+            if request_id in self._results:
+                return self._results.pop(request_id)
+            entry = self._pending.get(request_id)
+        if entry is None or not entry[0].wait(timeout):
+            return None
+        with self._lock:
+            return self._results.pop(request_id, None)
+
+    def stop(self):
+        self.img_path_queue.put("STOP")
+        self.prompt_queue.put("STOP")
+        self.llm_cancel_queue.put("STOP")
+        if self.vision_process is not None:
+            self.vision_process.join()
+        if self.lm_process is not None:
+            self.lm_process.join()
+        self.event_queue.put("STOP")
+        if self._collector is not None:
+            # 等收集线程退出后再释放资源, 否则它可能在解释器退出时读取已关闭的队列
+            self._collector.join()
+        self.embedding_ring.close()
+        self.embedding_ring.unlink()
+
+def serve_protocol(pipeline, in_fd, out_fd):
+    """Serve framed requests from ``in_fd`` and write response frames to ``out_fd``"""
+    writer = ipc_protocol.FrameWriter(os.fdopen(out_fd, "wb"))
+    
+    def on_event(request_id, kind, payload):
+        if kind == "token":
+            text, n_tokens = payload
+            writer.send({"type": ipc_protocol.TOKEN, "id": request_id, "text": text, "tokens": n_tokens})
+        elif kind == "timing":
+            writer.send({"type": ipc_protocol.TIMING, "id": request_id, **payload})
+        elif kind == "error":
+            writer.send({"type": ipc_protocol.ERROR, "id": request_id, "message": payload})
+    
+    def on_done(request_id, status):
+        if status == "DONE":
+            writer.send({"type": ipc_protocol.DONE, "id": request_id})
+    
+    # submit会在流水线满时阻塞, 放到单独线程中, 读取线程随时可以处理取消帧.
+    # queued是已读取但submit尚未返回的请求; 只有它们的取消需要记在cancelled_early中
+    submissions = queue.Queue()
+    cancel_lock = threading.Lock()
+    queued = set()
+    cancelled_early = set()
+    
+    def take_cancelled(request_id, done=False):
+        """Whether the reader cancelled a queued request; a cancelled or ``done`` request is no longer tracked"""
+        with cancel_lock:
+            cancelled = request_id in cancelled_early
+            cancelled_early.discard(request_id)
+            if cancelled or done:
+                queued.discard(request_id)
+        return cancelled
+    
+    def submit_requests():
+        while True:
+            frame = submissions.get()
+            if frame is None:
+                break
+            request_id = frame.get("id")
+            if take_cancelled(request_id):
+                writer.send({"type": ipc_protocol.ERROR, "id": request_id, "message": "Cancelled"})
+                continue
+            try:
+                pipeline.submit(frame["image"], build_request_prompt(frame.get("text", "")),
+                                request_id=request_id, on_done=on_done, on_event=on_event,
+                                session_id=frame.get("session"), text=frame.get("text", ""),
+                                timeout=frame.get("timeout"))
+            except Exception as e:
+                # 例如上传的图像在排队期间被清理; 只让这个请求失败, 线程继续处理后续请求
+                print(f"Failed to submit request {request_id}: {e}")
+                take_cancelled(request_id, done=True)
+                writer.send({"type": ipc_protocol.ERROR, "id": request_id, "message": f"Failed to submit request: {e}"})
+                continue
+            # 在submit阻塞期间到达的取消
+            if take_cancelled(request_id, done=True):
+                pipeline.cancel(request_id)
+    
+    submitter = threading.Thread(target=submit_requests, daemon=True)
+    submitter.start()
+    writer.send({"type": ipc_protocol.READY})
+    with os.fdopen(in_fd, "rb") as reader:
+        for frame in ipc_protocol.read_frames(reader):
+            if frame.get("type") == ipc_protocol.CANCEL:
+                with cancel_lock:
+                    # 已结束或未知的请求不需要记录
+                    if not pipeline.cancel(frame.get("id")) and frame.get("id") in queued:
+                        cancelled_early.add(frame.get("id"))
+                continue
+            if frame.get("type") != ipc_protocol.REQUEST:
+                print(f"Ignoring unexpected frame type: {frame.get('type')}")
+                continue
+            request_id = frame.get("id")
+            if not frame.get("image") or not os.path.exists(frame["image"]):
+                writer.send({"type": ipc_protocol.ERROR, "id": request_id,
+                             "message": f"Image not found: {frame.get('image')}"})
+                continue
+            with cancel_lock:
+                queued.add(request_id)
+            submissions.put(frame)
+    submissions.put(None)
+    submitter.join()
+
 def main():
-    load_ready_queue = Queue()
-    embedding_queue = Queue()
-    img_path_queue = Queue()
-    prompt_queue = Queue()
-    inference_done_queue = Queue()
-    start_event = Event()
-    
-    vision_process = Process(target=vision_encoder_process,
-                           args=(load_ready_queue, embedding_queue, img_path_queue, start_event))
-    lm_process = Process(target=llm_process,
-                        args=(load_ready_queue, embedding_queue, prompt_queue, inference_done_queue, start_event))
-    
-    vision_process.start()
-    lm_process.start()
-    
-    # 等待模型加载
-    ready_count = 0
-    while ready_count < 2:
-        status = load_ready_queue.get()
-        print(f"Received ready signal: {status}")
-        ready_count += 1
+    parser = argparse.ArgumentParser(description="MiniCPM-V-2.6 multiprocess inference")
+    parser.add_argument("--ipc-fds", help="IN,OUT pipe file descriptors for the framed JSON-lines protocol; "
+                                          "without it an interactive console is started")
+    args = parser.parse_args()
     
+    if args.ipc_fds:
+        in_fd, out_fd = (int(fd) for fd in args.ipc_fds.split(","))
+        # 协议模式下stdout只用于日志, 统一重定向到stderr (包括运行库的输出)
+        sys.stdout.flush()
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        pipeline = InferencePipeline(stream_tokens=True)
+        if METRICS_PORT:
+            start_metrics_server(pipeline.metrics, METRICS_PORT)
+        pipeline.start()
+        print("All models loaded, serving framed requests...")
+        try:
+            serve_protocol(pipeline, in_fd, out_fd)
+        except KeyboardInterrupt:
+            pass
+        pipeline.stop()
+        return
+    
+    pipeline = InferencePipeline()
+    if METRICS_PORT:
+        start_metrics_server(pipeline.metrics, METRICS_PORT)
+    pipeline.start()
     print("All models loaded, starting interactive mode...")
-    start_event.set()
     
     # 交互循环
     try:
@@ -182,36 +1144,22 @@ Enter your input :
             
             # 解析输入
             full_input = "\n".join(user_input[:-3])  # 去掉最后3个空行
-            import re
-            img_match = re.search(r'\{\{(.+?)\}\}', full_input)
-            if not img_match:
+            img_path, prompt = build_prompt(full_input)
+            if img_path is None:
                 print("No image path found in input")
                 continue
-                
-            img_path = img_match.group(1)
-            # 将图片标记替换为<image>标记
-            image_placeholder = '<image_id>0</image_id><image>\n'  # 先定义替换文本
-            prompt = f"""<|im_start|>system
-You are a helpful assistant.<|im_end|>
-<|im_start|>user
-{full_input.replace(img_match.group(0), image_placeholder)}<|im_end|>
-<|im_start|>assistant
-"""
-            img_path_queue.put(img_path)
-            prompt_queue.put(prompt)
+            
+            request_id = pipeline.submit(img_path, prompt)
             
             # 等待推理完成
-            status = inference_done_queue.get()
+            status = pipeline.wait(request_id)
             if status == "ERROR":
                 print("Inference failed")
             
     except KeyboardInterrupt:
         print("\nExiting...")
-        img_path_queue.put("STOP")
-        prompt_queue.put("STOP")
     
-    vision_process.join()
-    lm_process.join()
+    pipeline.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
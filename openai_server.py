@@ -0,0 +1,518 @@
+"""OpenAI-compatible HTTP server for MiniCPM-V-2.6.
+
+Serves POST /v1/chat/completions, with or without server-sent event
+streaming, plus GET /v1/models, /health and /metrics, on top of the vision
+and LLM worker processes of multiprocess_inference.py. Requests wait in a
+bounded queue in front of the pipeline; when it is full the server answers
+429, and 503 while the models are loading or a worker has died.
+
+Each request needs exactly one image, given as an "image_url" content part
+holding a base64 data: URL or a file: URL (or plain path) under --image-root.
+Earlier user/assistant messages become conversation history; system
+messages are ignored because the system prompt is part of the cached prompt
+prefix.
+
+Usage:
+    python openai_server.py --port 8000
+    python openai_server.py --fake     # fake NPU runtimes, no board needed
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import os
+import sys
+import time
+import uuid
+
+import ipc_protocol
+from session_manager import estimate_tokens
+
+MODEL_NAME = "minicpm-v-2.6"
+MAX_BODY_BYTES = 32 * 1024 * 1024
+MAX_HEADER_LINES = 100
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    499: "Client Closed Request",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+
+class HTTPError(Exception):
+    """An error answered with an OpenAI-style error body"""
+
+    def __init__(self, status, message, error_type="invalid_request_error", headers=None, code=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.error_type = error_type
+        self.headers = headers or {}
+        self.code = code if code is not None else status
+
+
+def job_error(status, message):
+    """The error for a job that finished with pipeline ``status`` "ERROR" or "CANCELLED".
+
+    Cancelled jobs get their own statuses so clients can tell them from server
+    faults: 504 once the request deadline passed, 499 otherwise.
+    """
+    if status == "CANCELLED" and message == ipc_protocol.DEADLINE_EXCEEDED:
+        return HTTPError(504, message, "timeout")
+    if status == "CANCELLED":
+        return HTTPError(499, message, "cancelled")
+    return HTTPError(500, message, "server_error")
+
+
+async def read_request(reader):
+    """Read one HTTP/1.1 request; returns (method, path, headers, body) or None at EOF"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise HTTPError(400, "Too many headers")
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        # 无法得知请求体在哪里结束, 回复后关闭连接
+        raise HTTPError(400, f"Invalid Content-Length header: {headers.get('content-length')}",
+                        headers={"Connection": "close"})
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, f"Request body exceeds {MAX_BODY_BYTES} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+def _content_parts(content):
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    if isinstance(content, list):
+        return content
+    raise HTTPError(400, "Message content must be a string or a list of content parts")
+
+
+def parse_messages(messages, image_marker):
+    """Split OpenAI chat messages into (image url, earlier turns, new user text).
+
+    The image part is replaced by ``image_marker`` in its message's text, so it
+    keeps its position; turns are (user, assistant) pairs.
+    """
+    if not isinstance(messages, list) or not messages:
+        raise HTTPError(400, "'messages' must be a non-empty list")
+    image_url = None
+    conversation = []
+    for message in messages:
+        role = message.get("role") if isinstance(message, dict) else None
+        if role == "system":
+            continue
+        if role not in ("user", "assistant"):
+            raise HTTPError(400, f"Unsupported message role: {role}")
+        texts = []
+        for part in _content_parts(message.get("content")):
+            if part.get("type") == "text":
+                texts.append(part.get("text", ""))
+            elif part.get("type") == "image_url" and role == "user":
+                if image_url is not None:
+                    raise HTTPError(400, "Only one image per conversation is supported")
+                url = part.get("image_url")
+                image_url = url.get("url") if isinstance(url, dict) else url
+                texts.append(image_marker)
+            else:
+                raise HTTPError(400, f"Unsupported content part: {part.get('type')}")
+        conversation.append((role, "\n".join(texts)))
+
+    if not conversation or conversation[-1][0] != "user":
+        raise HTTPError(400, "The last message must come from the user")
+    if not image_url:
+        raise HTTPError(400, "An image_url content part is required")
+    turns = []
+    pending_user = None
+    for role, text in conversation[:-1]:
+        if role == "user":
+            pending_user = text if pending_user is None else f"{pending_user}\n{text}"
+        else:
+            turns.append((pending_user or "", text))
+            pending_user = None
+    text = conversation[-1][1]
+    if pending_user is not None:
+        text = f"{pending_user}\n{text}"
+    return image_url, turns, text
+
+
+def resolve_image(url, image_root):
+    """Return (path, None) for a file: URL or path under ``image_root``, (None, bytes) for a data: URL"""
+    if url.startswith("data:"):
+        header, _, data = url.partition(",")
+        if ";base64" not in header:
+            raise HTTPError(400, "data: image URLs must be base64 encoded")
+        try:
+            image_bytes = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            raise HTTPError(400, "Invalid base64 image data")
+        # 图像数据直接交给视觉进程解码, 不写临时文件
+        return None, image_bytes
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    elif "://" in url:
+        raise HTTPError(400, "Only data: and file: image URLs are supported")
+    path = os.path.realpath(os.path.join(image_root, url))
+    if os.path.commonpath([path, image_root]) != image_root:
+        raise HTTPError(400, "Image path is outside the allowed image root")
+    if not os.path.isfile(path):
+        raise HTTPError(400, f"Image not found: {url}")
+    return path, None
+
+
+class Job:
+    """One chat completion request on its way through the pipeline"""
+
+    def __init__(self, image_path, image_data, prompt):
+        self.id = f"chatcmpl-{uuid.uuid4().hex}"
+        self.image_path = image_path
+        self.image_data = image_data
+        self.prompt = prompt
+        self.created = int(time.time())
+        self.events = asyncio.Queue()
+        self.cancelled = False
+
+
+class ChatCompletionServer:
+    """Routes HTTP requests to an InferencePipeline through a bounded job queue.
+
+    A single dispatcher submits queued jobs in order; ``pipeline.submit``
+    blocks while ``max_pending`` requests are in flight, so the queue only
+    grows while the pipeline is busy. Pipeline callbacks run on the
+    pipeline's collector thread and are handed to the event loop.
+
+    A job whose client disconnects is cancelled; one cancelled in the pipeline
+    is answered 504 when its deadline passed and 499 otherwise.
+    """
+
+    def __init__(self, pipeline, build_prompt, image_marker, queue_size=8, image_root="."):
+        self.pipeline = pipeline
+        self.build_prompt = build_prompt
+        self.image_marker = image_marker
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.image_root = os.path.realpath(image_root)
+        self.ready = False
+        self.failed = None
+        self.loop = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop.create_task(self._load())
+        self.loop.create_task(self._dispatch())
+
+    async def _load(self):
+        try:
+            await self.loop.run_in_executor(None, self.pipeline.start)
+            self.ready = True
+            print("Models loaded, accepting requests")
+        except Exception as e:
+            self.failed = str(e)
+            print(f"Failed to start the inference pipeline: {e}")
+
+    def available(self):
+        """None when requests can be served, otherwise the reason they cannot"""
+        if self.failed:
+            return f"Inference pipeline failed: {self.failed}"
+        if not self.ready:
+            return "Models are still loading"
+        for process in (self.pipeline.vision_process, self.pipeline.lm_process):
+            if process is None or not process.is_alive():
+                return "An inference worker has stopped"
+        return None
+
+    async def _dispatch(self):
+        while True:
+            job = await self.queue.get()
+            if job.cancelled:
+                job.events.put_nowait(("error", "Client disconnected"))
+                job.events.put_nowait(("done", "CANCELLED"))
+                continue
+            try:
+                await self.loop.run_in_executor(None, self._submit, job)
+            except Exception as e:
+                job.events.put_nowait(("error", f"Failed to submit request: {e}"))
+                job.events.put_nowait(("done", "ERROR"))
+                continue
+            if job.cancelled:
+                # 客户端在submit阻塞期间断开, 当时的取消没有找到请求
+                self.pipeline.cancel(job.id, "Client disconnected")
+
+    def _submit(self, job):
+        def on_event(request_id, kind, payload):
+            self.loop.call_soon_threadsafe(job.events.put_nowait, (kind, payload))
+
+        def on_done(request_id, status):
+            self.loop.call_soon_threadsafe(job.events.put_nowait, ("done", status))
+
+        self.pipeline.submit(job.image_path, job.prompt, request_id=job.id, on_done=on_done, on_event=on_event,
+                             image_data=job.image_data)
+
+    def _create_job(self, body):
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError as e:
+            raise HTTPError(400, f"Invalid JSON body: {e}")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        image_url, turns, text = parse_messages(request.get("messages"), self.image_marker)
+        reason = self.available()
+        if reason is not None:
+            raise HTTPError(503, reason, "server_error", {"Retry-After": "5"})
+        if self.queue.full():
+            raise HTTPError(429, "Too many queued requests, retry later", "rate_limit_error", {"Retry-After": "1"})
+        image_path, image_data = resolve_image(image_url, self.image_root)
+        prompt = self.build_prompt(turns, text)
+        # 提前检查长度, 超出上下文的请求按OpenAI的方式返回400而不是在流水线中失败
+        error = self.pipeline.prompt_length_error(prompt, text)
+        if error is not None:
+            raise HTTPError(400, error, code="context_length_exceeded")
+        job = Job(image_path, image_data, prompt)
+        self.queue.put_nowait(job)
+        return job, bool(request.get("stream"))
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                headers = {}
+                try:
+                    request = await read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = await self._route(method, path, headers, body, reader, writer)
+                except HTTPError as e:
+                    await self._send_error(writer, e)
+                    keep_alive = (e.status < 500 and e.status != 413
+                                  and e.headers.get("Connection", "").lower() != "close")
+                if not keep_alive or headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, headers, body, reader, writer):
+        """Answer one request; returns whether the connection can be reused"""
+        if path == "/v1/chat/completions":
+            if method != "POST":
+                raise HTTPError(405, "Use POST")
+            job, stream = self._create_job(body)
+            if stream:
+                await self._stream_completion(job, writer)
+                return False
+            completion = await self._collect_completion(job, reader)
+            if completion is None:
+                return False
+            payload, reusable = completion
+            await self._send_json(writer, 200, payload, None if reusable else {"Connection": "close"})
+            return reusable
+        if method != "GET":
+            raise HTTPError(405, "Use GET")
+        if path == "/v1/models":
+            await self._send_json(writer, 200, {"object": "list", "data": [
+                {"id": MODEL_NAME, "object": "model", "created": 0, "owned_by": "local"}]})
+        elif path == "/health":
+            reason = self.available()
+            await self._send_json(writer, 200 if reason is None else 503,
+                                  {"status": "ok" if reason is None else reason, "queued": self.queue.qsize()})
+        elif path == "/metrics":
+            await self._send(writer, 200, self.pipeline.metrics.render().encode(),
+                             "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            raise HTTPError(404, f"Unknown path: {path}")
+        return True
+
+    def _usage(self, job, completion_tokens):
+        counter = self.pipeline.prompt_counter
+        prompt_tokens = counter.count_prompt(job.prompt)["total"] if counter is not None else estimate_tokens(job.prompt)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    async def _collect_completion(self, job, reader):
+        """Wait for a job's answer; returns (completion, whether the connection can be reused).
+
+        Returns None when the client disconnects first, after cancelling the job.
+        """
+        parts = []
+        streamed_tokens = 0
+        tokens = None
+        error = None
+        # 等待期间监视连接: 读到EOF说明客户端已断开. 读到数据 (流水线化的下一个请求) 时
+        # 那个字节已被取走, 回复后关闭连接, 客户端会重新发送
+        watch = asyncio.ensure_future(reader.read(1))
+        reusable = True
+        try:
+            while True:
+                next_event = asyncio.ensure_future(job.events.get())
+                if watch is not None:
+                    await asyncio.wait({next_event, watch}, return_when=asyncio.FIRST_COMPLETED)
+                if watch is not None and watch.done():
+                    if watch.exception() is not None or not watch.result():
+                        next_event.cancel()
+                        job.cancelled = True
+                        self.pipeline.cancel(job.id, "Client disconnected")
+                        return None
+                    watch = None
+                    reusable = False
+                kind, payload = await next_event
+                if kind == "token":
+                    parts.append(payload[0])
+                    streamed_tokens += payload[1]
+                elif kind == "timing" and payload["stage"] == "total":
+                    tokens = payload.get("tokens")
+                elif kind == "error":
+                    error = payload
+                elif kind == "done":
+                    break
+        finally:
+            if watch is not None:
+                watch.cancel()
+        if payload != "DONE":
+            raise job_error(payload, error)
+        return {
+            "id": job.id,
+            "object": "chat.completion",
+            "created": job.created,
+            "model": MODEL_NAME,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(parts)},
+                         "finish_reason": "stop"}],
+            "usage": self._usage(job, tokens if tokens is not None else streamed_tokens),
+        }, reusable
+
+    async def _stream_completion(self, job, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+
+        def chunk(delta, finish_reason=None):
+            return {"id": job.id, "object": "chat.completion.chunk", "created": job.created, "model": MODEL_NAME,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+        async def send(data):
+            """False once the client has disconnected"""
+            try:
+                writer.write(data)
+                await writer.drain()
+                return True
+            except ConnectionError:
+                # 客户端已断开: 还在排队的请求不再提交, 正在运行的请求中止生成
+                job.cancelled = True
+                self.pipeline.cancel(job.id, "Client disconnected")
+                return False
+
+        def event(payload):
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode()
+
+        if not await send(event(chunk({"role": "assistant", "content": ""}))):
+            return
+        error = None
+        while True:
+            kind, payload = await job.events.get()
+            if kind == "token":
+                sent = await send(event(chunk({"content": payload[0]})))
+            elif kind == "error":
+                # 错误类型取决于随后的完成状态
+                error = payload
+                sent = True
+            elif kind == "done":
+                if payload == "DONE":
+                    sent = await send(event(chunk({}, "stop")))
+                else:
+                    error = job_error(payload, error)
+                    sent = await send(event({"error": {"message": error.message, "type": error.error_type,
+                                                       "code": error.code}}))
+                if not sent:
+                    return
+                break
+            else:
+                sent = True
+            if not sent:
+                return
+        await send(b"data: [DONE]\n\n")
+
+    async def _send(self, writer, status, body, content_type, headers=None):
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}"]
+        head += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_json(self, writer, status, payload, headers=None):
+        await self._send(writer, status, json.dumps(payload, ensure_ascii=False).encode(), "application/json",
+                         headers)
+
+    async def _send_error(self, writer, error):
+        await self._send_json(writer, error.status,
+                              {"error": {"message": error.message, "type": error.error_type, "code": error.code}},
+                              error.headers)
+
+
+async def serve(args):
+    from multiprocess_inference import InferencePipeline, build_conversation_prompt
+    import ipc_protocol
+
+    pipeline = InferencePipeline(max_pending=args.depth, stream_tokens=True)
+    server = ChatCompletionServer(pipeline, build_conversation_prompt, ipc_protocol.IMAGE_MARKER,
+                                  queue_size=args.queue_size, image_root=args.image_root)
+    await server.start()
+    http_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f"Serving OpenAI-compatible API on http://{args.host}:{args.port}/v1")
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        if server.ready:
+            pipeline.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible API for MiniCPM-V-2.6")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="requests waiting for the pipeline before answering 429")
+    parser.add_argument("--depth", type=int, default=None, help="requests in flight inside the pipeline")
+    parser.add_argument("--image-root", default=".", help="directory file: image URLs must be under")
+    parser.add_argument("--fake", action="store_true",
+                        help="replace the NPU runtimes with benchmarks/fakes.py, for testing without a board")
+    args = parser.parse_args()
+
+    if args.fake:
+        from benchmarks import fakes
+        fakes.install()
+    if args.depth is None:
+        from multiprocess_inference import PIPELINE_DEPTH
+        args.depth = PIPELINE_DEPTH
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+
+
+class ImagePreprocessor:
+    """Vision encoder preprocessing into preallocated buffers.
+
+    Resize and BGR->RGB conversion write into buffers owned by the
+    preprocessor, so a request allocates no full-size temporaries. In the
+    default float32 mode the RGB pixels are widened straight into the NHWC
+    input tensor. With ``input_dtype=np.uint8`` the colour conversion writes
+    directly into the input tensor, for ``.rknn`` models that take uint8
+    input; this skips the 4x float32 blow-up entirely.
+
+    The returned tensor is reused by the next call: pass it to the encoder
+    before preprocessing another image.
+    """
+
+    def __init__(self, img_size: int = 448, input_dtype=np.float32):
+        self.img_size = img_size
+        self.input_dtype = np.dtype(input_dtype)
+        self._resized = np.empty((img_size, img_size, 3), dtype=np.uint8)
+        self._input = np.empty((1, img_size, img_size, 3), dtype=self.input_dtype)
+        self._direct = self.input_dtype == np.uint8
+        if self._direct:
+            self._rgb = self._input[0]
+        else:
+            self._rgb = np.empty((img_size, img_size, 3), dtype=np.uint8)
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        """Turn a decoded BGR image into the encoder's NHWC input tensor"""
+        if img.shape[:2] == (self.img_size, self.img_size):
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        else:
+            cv2.resize(img, (self.img_size, self.img_size), dst=self._resized)
+            cv2.cvtColor(self._resized, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        if not self._direct:
+            np.copyto(self._input[0], self._rgb, casting="unsafe")
+        return self._input
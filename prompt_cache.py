@@ -0,0 +1,95 @@
+import os
+import time
+import hashlib
+from typing import Callable, Optional
+
+from rkllm_binding import load_prompt_cache, release_prompt_cache
+
+
+class PromptCacheManager:
+    """Keeps RKLLM prompt caches for fixed prompt prefixes such as the system prompt.
+
+    Every registered prefix gets a cache file in ``cache_dir`` named after a hash
+    of the prefix and the model file, so replacing the model invalidates it.
+    Missing files are produced with ``build_fn(prefix, cache_path)``, which is
+    expected to run the prefix once with ``save_prompt_cache`` enabled. The
+    runtime holds one prompt cache at a time; ``select`` swaps in the cache
+    that matches a prompt and returns the part of the prompt still to prefill,
+    and ``use`` loads any other cache file, such as a conversation's.
+    """
+
+    def __init__(self, handle, cache_dir: str, model_path: str,
+                 build_fn: Callable[[str, str], None]):
+        self.handle = handle
+        self.cache_dir = cache_dir
+        self.build_fn = build_fn
+        self.prefixes = {}
+        self.loaded_path = None
+        stat = os.stat(model_path)
+        self._model_key = f"{os.path.abspath(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+        self.builds = 0
+        self.loads = 0
+        self.ttft = {True: [0, 0.0], False: [0, 0.0]}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_path(self, prefix: str) -> str:
+        digest = hashlib.sha256(f"{self._model_key}\n{prefix}".encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"prefix_{digest}.bin")
+
+    def ensure(self, prefix: str) -> str:
+        """Register a prefix, building its cache file if it does not exist yet"""
+        path = self.cache_path(prefix)
+        if not os.path.exists(path):
+            print(f"Building prompt cache {path} ({len(prefix)} chars)")
+            start_time = time.time()
+            self.build_fn(prefix, path)
+            self.builds += 1
+            print(f"Prompt cache built in {time.time() - start_time:.2f} seconds")
+        self.prefixes[prefix] = path
+        return path
+
+    def use(self, path: Optional[str]) -> None:
+        """Make ``path`` the loaded prompt cache, or release the current one for None"""
+        if path == self.loaded_path:
+            return
+        if self.loaded_path is not None:
+            self.loaded_path = None
+            release_prompt_cache(self.handle)
+        if path is not None:
+            load_prompt_cache(self.handle, path)
+            self.loads += 1
+            self.loaded_path = path
+
+    def select(self, prompt: str) -> str:
+        """Load the cache for the longest registered prefix of ``prompt``.
+
+        Returns the remainder of the prompt, or the whole prompt (with any
+        loaded cache released) when no registered prefix matches.
+        """
+        matches = [prefix for prefix in self.prefixes if prompt.startswith(prefix)]
+        prefix = max(matches, key=len) if matches else None
+        try:
+            self.use(self.prefixes[prefix] if prefix is not None else None)
+        except RuntimeError as e:
+            print(f"Falling back to full prefill: {e}")
+            self.loaded_path = None
+            return prompt
+        return prompt[len(prefix):] if prefix is not None else prompt
+
+    def record_ttft(self, cached: bool, seconds: float) -> None:
+        """Record a time to first token, split by whether a prompt cache was used"""
+        self.ttft[cached][0] += 1
+        self.ttft[cached][1] += seconds
+
+    def stats(self) -> dict:
+        def mean(cached):
+            count, total = self.ttft[cached]
+            return total / count if count else None
+        return {
+            "builds": self.builds,
+            "loads": self.loads,
+            "cached_requests": self.ttft[True][0],
+            "uncached_requests": self.ttft[False][0],
+            "mean_ttft_cached": mean(True),
+            "mean_ttft_uncached": mean(False),
+        }
@@ -0,0 +1,105 @@
+import functools
+import json
+import os
+import re
+from typing import Dict, Iterable, Optional
+
+from session_manager import estimate_tokens
+
+try:
+    from tokenizers import Regex, Tokenizer, models, normalizers, pre_tokenizers
+except ImportError:  # 没有安装tokenizers时按字节数估算
+    Tokenizer = None
+
+# Qwen2's pre-tokenization split, as in transformers' Qwen2 tokenizer converter
+QWEN2_PRETOKENIZE_REGEX = (r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}| ?[^\s\p{L}\p{N}]+[\r\n]*"""
+                           r"""|\s*[\r\n]+|\s+(?!\S)|\s+""")
+# The image placeholder the runtime expands to img_start, the image tokens and img_end
+IMAGE_PLACEHOLDER_TOKEN = "<image>"
+
+
+@functools.lru_cache(maxsize=None)
+def load_special_token_ids(tokenizer_dir: str = ".") -> Dict[str, int]:
+    """Special token -> ID from added_tokens.json, read once per directory"""
+    with open(os.path.join(tokenizer_dir, "added_tokens.json"), "r", encoding="utf-8") as f:
+        return dict(json.load(f))
+
+
+def load_bpe_tokenizer(tokenizer_dir: str = "."):
+    """Qwen2's byte-level BPE from vocab.json and merges.txt, or None without the tokenizers package"""
+    if Tokenizer is None:
+        return None
+    tokenizer = Tokenizer(models.BPE.from_file(os.path.join(tokenizer_dir, "vocab.json"),
+                                               os.path.join(tokenizer_dir, "merges.txt")))
+    tokenizer.normalizer = normalizers.NFC()
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([
+        pre_tokenizers.Split(Regex(QWEN2_PRETOKENIZE_REGEX), behavior="isolated", invert=False),
+        pre_tokenizers.ByteLevel(add_prefix_space=False, use_regex=False),
+    ])
+    return tokenizer
+
+
+class PromptCounter:
+    """Counts the tokens of a rendered prompt before it is sent to the NPU.
+
+    Special tokens are found with one regular expression built from the
+    precomputed ID table and count as one token each; the text between them
+    goes through Qwen2's BPE when the ``tokenizers`` package is installed
+    and through ``estimate_tokens`` otherwise. Segment counts are memoized,
+    so the fixed parts of the chat template are tokenized once.
+
+    The image placeholder stands for ``tokens_per_tile`` tokens per encoded
+    tile plus the img_start and img_end markers around them.
+    """
+
+    def __init__(self, tokenizer_dir: str = ".", tokens_per_tile: int = 64, cache_size: int = 4096):
+        self.special_ids = load_special_token_ids(tokenizer_dir)
+        self.tokens_per_tile = tokens_per_tile
+        self._special_re = re.compile("|".join(re.escape(token)
+                                               for token in sorted(self.special_ids, key=len, reverse=True)))
+        self._tokenizer = load_bpe_tokenizer(tokenizer_dir)
+        self.exact = self._tokenizer is not None
+        self.count_text = functools.lru_cache(maxsize=cache_size)(self._count_text)
+
+    def _count_text(self, text: str) -> int:
+        """Tokens of plain text that contains no special tokens"""
+        if not text:
+            return 0
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+        return estimate_tokens(text)
+
+    def image_tokens(self, tiles: int = 1) -> int:
+        """Tokens of an image encoded as ``tiles`` tiles; text-only prompts (0 tiles) have none"""
+        return self.tokens_per_tile * tiles + 2 if tiles > 0 else 0
+
+    def count_prompt(self, prompt: str, image_tiles: int = 1, user_texts: Iterable[str] = ()) -> dict:
+        """Split a rendered prompt's tokens into "template", "text" (``user_texts``) and "image".
+
+        ``user_texts`` are the user and assistant messages rendered into the
+        prompt; everything else apart from the image is template.
+        """
+        tokens = 0
+        images = 0
+        pos = 0
+        for match in self._special_re.finditer(prompt):
+            tokens += self.count_text(prompt[pos:match.start()])
+            if match.group() == IMAGE_PLACEHOLDER_TOKEN:
+                images += 1
+            else:
+                tokens += 1
+            pos = match.end()
+        tokens += self.count_text(prompt[pos:])
+        text = min(tokens, sum(self.count_text(t) for t in user_texts))
+        image = self.image_tokens(image_tiles) if images else 0
+        return {"template": tokens - text, "text": text, "image": image, "total": tokens + image}
+
+
+def over_length_error(counts: dict, max_context_len: int, max_new_tokens: int) -> Optional[str]:
+    """Why a prompt with these counts cannot be answered within the context, or None"""
+    limit = max_context_len - max_new_tokens
+    if counts["total"] > limit:
+        return (f"Prompt is {counts['total']} tokens ({counts['text']} text, {counts['image']} image, "
+                f"{counts['template']} template) but only {limit} of the {max_context_len}-token context "
+                f"are available with {max_new_tokens} reserved for the answer")
+    return None
@@ -1,10 +1,28 @@
+import os
+import queue
+import codecs
 import ctypes
+import asyncio
+import threading
 import numpy as np
 from enum import IntEnum
-from typing import Callable, Any
+from typing import AsyncIterator, Callable, Any, Iterator, Optional, Union
 
-# Load the shared library
-_lib = ctypes.CDLL("/usr/lib/librkllmrt.so")  # Adjust the library name if necessary
+class _MissingLibrary:
+    """Stands in for librkllmrt when it cannot be loaded, failing on first use"""
+
+    def __init__(self, error: OSError):
+        self.error = error
+
+    def __getattr__(self, name):
+        raise OSError(f"librkllmrt is not available: {self.error}")
+
+
+# Load the shared library (RKLLM_LIB_PATH can point at another build or a test shim)
+try:
+    _lib = ctypes.CDLL(os.environ.get("RKLLM_LIB_PATH", "/usr/lib/librkllmrt.so"))
+except OSError as e:
+    _lib = _MissingLibrary(e)
 
 # Define enums
 class LLMCallState(IntEnum):
@@ -128,36 +146,56 @@ class RKLLMResult(ctypes.Structure):
 LLMResultCallback = ctypes.CFUNCTYPE(None, ctypes.POINTER(RKLLMResult), ctypes.c_void_p, ctypes.c_int)
 
 # Define function prototypes
-_lib.rkllm_createDefaultParam.restype = RKLLMParam
-_lib.rkllm_init.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(RKLLMParam), LLMResultCallback]
-_lib.rkllm_init.restype = ctypes.c_int
-_lib.rkllm_load_lora.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMLoraAdapter)]
-_lib.rkllm_load_lora.restype = ctypes.c_int
-_lib.rkllm_load_prompt_cache.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-_lib.rkllm_load_prompt_cache.restype = ctypes.c_int
-_lib.rkllm_release_prompt_cache.argtypes = [ctypes.c_void_p]
-_lib.rkllm_release_prompt_cache.restype = ctypes.c_int
-_lib.rkllm_destroy.argtypes = [ctypes.c_void_p]
-_lib.rkllm_destroy.restype = ctypes.c_int
-_lib.rkllm_run.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
-_lib.rkllm_run.restype = ctypes.c_int
-_lib.rkllm_run_async.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
-_lib.rkllm_run_async.restype = ctypes.c_int
-_lib.rkllm_abort.argtypes = [ctypes.c_void_p]
-_lib.rkllm_abort.restype = ctypes.c_int
-_lib.rkllm_is_running.argtypes = [ctypes.c_void_p]
-_lib.rkllm_is_running.restype = ctypes.c_int
+def _declare_prototypes(lib) -> None:
+    lib.rkllm_createDefaultParam.restype = RKLLMParam
+    lib.rkllm_init.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(RKLLMParam), LLMResultCallback]
+    lib.rkllm_init.restype = ctypes.c_int
+    lib.rkllm_load_lora.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMLoraAdapter)]
+    lib.rkllm_load_lora.restype = ctypes.c_int
+    lib.rkllm_load_prompt_cache.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    lib.rkllm_load_prompt_cache.restype = ctypes.c_int
+    lib.rkllm_release_prompt_cache.argtypes = [ctypes.c_void_p]
+    lib.rkllm_release_prompt_cache.restype = ctypes.c_int
+    lib.rkllm_destroy.argtypes = [ctypes.c_void_p]
+    lib.rkllm_destroy.restype = ctypes.c_int
+    lib.rkllm_run.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
+    lib.rkllm_run.restype = ctypes.c_int
+    lib.rkllm_run_async.argtypes = [ctypes.c_void_p, ctypes.POINTER(RKLLMInput), ctypes.POINTER(RKLLMInferParam), ctypes.c_void_p]
+    lib.rkllm_run_async.restype = ctypes.c_int
+    lib.rkllm_abort.argtypes = [ctypes.c_void_p]
+    lib.rkllm_abort.restype = ctypes.c_int
+    lib.rkllm_is_running.argtypes = [ctypes.c_void_p]
+    lib.rkllm_is_running.restype = ctypes.c_int
+
+def use_library(lib) -> None:
+    """Route every wrapper below through ``lib``.
+
+    ``lib`` is either a ``ctypes.CDLL`` of librkllmrt, whose prototypes are
+    declared here, or a Python object with the same ``rkllm_*`` functions,
+    e.g. the fake runtime used by the benchmarks.
+    """
+    global _lib
+    if isinstance(lib, ctypes.CDLL):
+        _declare_prototypes(lib)
+    _lib = lib
+
+if isinstance(_lib, ctypes.CDLL):
+    _declare_prototypes(_lib)
 
 # Python wrapper functions
 def create_default_param() -> RKLLMParam:
     return _lib.rkllm_createDefaultParam()
 
+# The runtime calls back into these thunks until the handle is destroyed, so they must stay alive
+_callbacks = {}
+
 def init(param: RKLLMParam, callback: Callable[[RKLLMResult, Any, LLMCallState], None]) -> ctypes.c_void_p:
     handle = ctypes.c_void_p()
     c_callback = LLMResultCallback(callback)
     status = _lib.rkllm_init(ctypes.byref(handle), ctypes.byref(param), c_callback)
     if status != 0:
         raise RuntimeError(f"Failed to initialize RKLLM: {status}")
+    _callbacks[handle.value] = c_callback
     return handle
 
 def load_lora(handle: ctypes.c_void_p, lora_adapter: RKLLMLoraAdapter) -> None:
@@ -177,6 +215,7 @@ def release_prompt_cache(handle: ctypes.c_void_p) -> None:
 
 def destroy(handle: ctypes.c_void_p) -> None:
     status = _lib.rkllm_destroy(handle)
+    _callbacks.pop(handle.value, None)
     if status != 0:
         raise RuntimeError(f"Failed to destroy RKLLM: {status}")
 
@@ -223,4 +262,193 @@ def create_rkllm_input(input_type: RKLLMInputType, **kwargs) -> RKLLMInput:
         rkllm_input._input.multimodal_input.image_embed = numpy_to_c_array(image_embed, ctypes.c_float)
         rkllm_input._input.multimodal_input.n_image_tokens = image_embed.shape[1]
 
-    return rkllm_input
\ No newline at end of file
+    return rkllm_input
+
+# High-level streaming API
+class RKLLMSession:
+    """An RKLLM handle whose output is consumed as a stream of text pieces.
+
+    ``generate`` is an async generator and ``generate_sync`` a plain one; both
+    start the run with ``rkllm_run_async`` and feed the tokens delivered to
+    the ctypes callback through a thread-safe queue, decoding them with an
+    incremental UTF-8 decoder so characters split across tokens come out
+    whole. The event loop keeps serving other I/O while the NPU decodes.
+    Cancelling the consuming task, or leaving the loop early, aborts the run.
+
+    The runtime handles one run at a time; further ``generate`` calls wait
+    for the current one to finish. A run only counts as finished once the
+    runtime has delivered its finish (or error) callback, also after an
+    abort, so a new run never starts while the NPU is still generating.
+    Embeddings referenced by an input must stay alive until its generation
+    ends.
+    """
+
+    def __init__(self, param: RKLLMParam, infer_param: Optional[RKLLMInferParam] = None,
+                 abort_timeout: float = 5.0):
+        if infer_param is None:
+            infer_param = RKLLMInferParam()
+            infer_param.mode = RKLLMInferMode.RKLLM_INFER_GENERATE.value
+        self.infer_param = infer_param
+        self.abort_timeout = abort_timeout
+        self.last_token_ids = []
+        # 当前运行的接收函数和结束事件; 结束事件由结束回调设置, 运行库的占用也只在回调 (或启动失败) 时释放
+        self._sink = None
+        self._run = None
+        self._state = threading.Condition()
+        self._busy = False
+        self._waiters = []
+        self.handle = init(param, self._on_result)
+
+    def _on_result(self, result, userdata, state):
+        if state == LLMCallState.RKLLM_RUN_NORMAL:
+            sink = self._sink
+            if sink is not None:
+                self.last_token_ids.append(result.contents.token_id)
+                sink(("token", result.contents.text or b""))
+        elif state in (LLMCallState.RKLLM_RUN_FINISH, LLMCallState.RKLLM_RUN_ERROR):
+            with self._state:
+                sink, self._sink = self._sink, None
+                run, self._run = self._run, None
+            if sink is not None:
+                sink(("finish" if state == LLMCallState.RKLLM_RUN_FINISH else "error", None))
+            if run is not None:
+                run.set()
+                self._release()
+
+    def _claim(self) -> None:
+        """Wait until no run is in progress and reserve the runtime"""
+        with self._state:
+            while self._busy:
+                self._state.wait()
+            self._busy = True
+
+    def _try_claim(self, waiter: Callable[[], None]) -> bool:
+        """Reserve the runtime if it is free, otherwise call ``waiter`` once it is released"""
+        with self._state:
+            if not self._busy:
+                self._busy = True
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def _release(self) -> None:
+        with self._state:
+            self._busy = False
+            waiters, self._waiters = self._waiters, []
+            self._state.notify_all()
+        for waiter in waiters:
+            try:
+                waiter()
+            except RuntimeError:
+                # 等待者的事件循环已关闭
+                pass
+
+    def _start(self, sink, rkllm_input: Union[str, RKLLMInput], infer_param: Optional[RKLLMInferParam]):
+        """Start a run on the claimed runtime; returns (input, run finished event).
+
+        Releases the claim if the run cannot start.
+        """
+        if isinstance(rkllm_input, str):
+            rkllm_input = create_rkllm_input(RKLLMInputType.RKLLM_INPUT_PROMPT, prompt=rkllm_input)
+        self.last_token_ids = []
+        run = threading.Event()
+        with self._state:
+            self._sink = sink
+            self._run = run
+        try:
+            run_async(self.handle, rkllm_input, infer_param or self.infer_param, None)
+        except RuntimeError:
+            with self._state:
+                self._sink = None
+                self._run = None
+            self._release()
+            raise
+        return rkllm_input, run
+
+    def _stop(self, run: threading.Event, finished: bool) -> None:
+        """Abort ``run`` if it is unfinished and wait for its finish callback"""
+        with self._state:
+            # 结束回调之后下一次运行可能已经开始, 只清除这次运行的接收函数
+            if self._run is run:
+                self._sink = None
+        if not finished and not run.is_set():
+            abort(self.handle)
+            if not run.wait(self.abort_timeout):
+                # 运行库仍在生成; 会话保持占用, 直到结束回调到达
+                print("RKLLM run did not stop after abort")
+
+    @staticmethod
+    def _decode(decoder, item):
+        kind, data = item
+        if kind == "token":
+            return decoder.decode(data), False
+        if kind == "error":
+            raise RuntimeError("RKLLM run failed")
+        return decoder.decode(b"", final=True), True
+
+    def generate_sync(self, rkllm_input: Union[str, RKLLMInput],
+                      infer_param: Optional[RKLLMInferParam] = None) -> Iterator[str]:
+        """Yield the response text piece by piece, blocking between tokens"""
+        self._claim()
+        items = queue.Queue()
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        rkllm_input, run = self._start(items.put, rkllm_input, infer_param)
+        finished = False
+        try:
+            while not finished:
+                text, finished = self._decode(decoder, items.get())
+                if text:
+                    yield text
+        finally:
+            self._stop(run, finished)
+            del rkllm_input
+
+    async def generate(self, rkllm_input: Union[str, RKLLMInput],
+                       infer_param: Optional[RKLLMInferParam] = None) -> AsyncIterator[str]:
+        """Yield the response text piece by piece without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            released = loop.create_future()
+
+            def wake(released=released):
+                loop.call_soon_threadsafe(lambda: released.done() or released.set_result(None))
+
+            if self._try_claim(wake):
+                break
+            await released
+        items = asyncio.Queue()
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        rkllm_input, run = self._start(lambda item: loop.call_soon_threadsafe(items.put_nowait, item),
+                                       rkllm_input, infer_param)
+        finished = False
+        try:
+            while not finished:
+                text, finished = self._decode(decoder, await items.get())
+                if text:
+                    yield text
+        finally:
+            if finished or run.is_set():
+                self._stop(run, True)
+            else:
+                await loop.run_in_executor(None, self._stop, run, False)
+            del rkllm_input
+
+    def abort(self) -> None:
+        """Stop the current run from any thread; the consuming generator then ends"""
+        if self._run is not None:
+            abort(self.handle)
+
+    def close(self) -> None:
+        self._claim()
+        try:
+            if self.handle is not None:
+                destroy(self.handle)
+                self.handle = None
+        finally:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for Qwen2's byte-level BPE (about 3 UTF-8 bytes per token)"""
+    return len(text.encode("utf-8")) // 3 + 1
+
+
+class Session:
+    """State of one multi-turn conversation about an image"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.image_key = None
+        self.embeddings = None
+        self.turns: List[Tuple[str, str]] = []
+        # Saved runtime context of the last rendered prompt and the number of turns it covers
+        self.prompt_cache_path = None
+        self.cached_turns = 0
+        self.last_used = time.time()
+
+    @property
+    def nbytes(self) -> int:
+        size = self.embeddings.nbytes if self.embeddings is not None else 0
+        return size + sum(len(user) + len(assistant) for user, assistant in self.turns)
+
+    def set_image(self, image_key, embeddings: np.ndarray) -> None:
+        """Attach an image; a different image starts a new conversation"""
+        if image_key != self.image_key:
+            self.turns = []
+            self.drop_prompt_cache()
+        self.image_key = image_key
+        # Own a copy: the source usually lives in a shared-memory slot that gets reused
+        self.embeddings = np.array(embeddings, dtype=np.float32, copy=True)
+
+    def drop_prompt_cache(self) -> None:
+        if self.prompt_cache_path and os.path.exists(self.prompt_cache_path):
+            os.remove(self.prompt_cache_path)
+        self.prompt_cache_path = None
+        self.cached_turns = 0
+
+
+class SessionStore:
+    """Sessions kept in LRU order, evicted by idle time and by a memory budget"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, idle_timeout: float = 30 * 60,
+                 on_evict: Optional[Callable[[Session], None]] = None):
+        self.max_bytes = max_bytes
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id, create: bool = True) -> Optional[Session]:
+        """Return a session and mark it as most recently used"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                if not create:
+                    return None
+                session = Session(session_id)
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.time()
+            return session
+
+    def evict(self, keep=None) -> List[Session]:
+        """Drop idle sessions, then the least recently used ones over the budget.
+
+        The session ``keep`` (usually the one being served) is never evicted.
+        """
+        now = time.time()
+        evicted = []
+        with self._lock:
+            for session_id, session in list(self._sessions.items()):
+                if session_id != keep and now - session.last_used > self.idle_timeout:
+                    evicted.append(self._sessions.pop(session_id))
+            total = sum(session.nbytes for session in self._sessions.values())
+            for session_id, session in list(self._sessions.items()):
+                if total <= self.max_bytes:
+                    break
+                if session_id == keep:
+                    continue
+                total -= session.nbytes
+                evicted.append(self._sessions.pop(session_id))
+        for session in evicted:
+            session.drop_prompt_cache()
+            if self.on_evict is not None:
+                self.on_evict(session)
+        return evicted
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def trim_history(turns: List[Tuple[str, str]], new_text: str, token_budget: int,
+                 count_tokens: Callable[[str], int] = estimate_tokens) -> List[Tuple[str, str]]:
+    """Return the most recent turns that fit in ``token_budget`` together with ``new_text``.
+
+    Whole turns are dropped oldest first; the new message is always kept.
+    """
+    remaining = token_budget - count_tokens(new_text)
+    kept = []
+    for user, assistant in reversed(turns):
+        cost = count_tokens(user) + count_tokens(assistant)
+        if cost > remaining:
+            break
+        remaining -= cost
+        kept.append((user, assistant))
+    kept.reverse()
+    return kept
@@ -0,0 +1,66 @@
+from multiprocessing import Queue
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+
+class EmbeddingRing:
+    """Fixed-slot shared-memory ring for passing embeddings between processes.
+
+    The creating process allocates one shared memory block split into
+    ``num_slots`` slots of ``slot_bytes`` each, plus a queue of free slot
+    indices. The producer copies an embedding into a free slot and sends only a
+    small descriptor through its regular queue; the consumer maps the slot as a
+    numpy view and releases it once the runtime is done with the memory. When
+    every slot is in use the producer blocks, which bounds the backlog.
+    """
+
+    def __init__(self, num_slots: int = 4, slot_bytes: int = 16 * 1024 * 1024):
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.shm = shared_memory.SharedMemory(create=True, size=num_slots * slot_bytes)
+        self.free_slots = Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def slot_view(self, slot: int, shape, dtype=np.float32) -> np.ndarray:
+        """Map a slot as an array of the given shape without copying"""
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=slot * self.slot_bytes)
+
+    def write(self, array: np.ndarray, request_id=None, timeout: Optional[float] = None, **meta) -> dict:
+        """Copy ``array`` into a free slot and return its descriptor.
+
+        Extra keyword arguments are added to the descriptor as is. Arrays that
+        do not fit in a slot are carried inline in the descriptor, i.e. pickled
+        through the queue as before.
+        """
+        if array.nbytes > self.slot_bytes:
+            print(f"Embedding of {array.nbytes} bytes exceeds slot size {self.slot_bytes}, sending inline")
+            return {"request_id": request_id, "array": np.ascontiguousarray(array), **meta}
+        slot = self.free_slots.get(timeout=timeout)
+        np.copyto(self.slot_view(slot, array.shape, array.dtype), array)
+        return {
+            "request_id": request_id,
+            "slot": slot,
+            "shape": tuple(array.shape),
+            "dtype": array.dtype.str,
+            **meta,
+        }
+
+    def read(self, descriptor: dict) -> np.ndarray:
+        """Return the embedding a descriptor points to"""
+        if "array" in descriptor:
+            return descriptor["array"]
+        return self.slot_view(descriptor["slot"], descriptor["shape"], np.dtype(descriptor["dtype"]))
+
+    def release(self, descriptor: dict) -> None:
+        """Hand a descriptor's slot back to the producer"""
+        if "slot" in descriptor:
+            self.free_slots.put(descriptor["slot"])
+
+    def close(self) -> None:
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
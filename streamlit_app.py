@@ -2,6 +2,7 @@ import streamlit as st
 from PIL import Image
 import atexit
 import os
+import uuid
 
 # Import the extracted modules
 from model_manager import ModelManager
@@ -110,6 +111,36 @@ def add_footer():
         unsafe_allow_html=True
     )
 
+@st.cache_resource
+def get_inference_manager():
+    """The inference worker shared by every browser session of this Streamlit server.
+
+    Each worker loads about 10 GB of models, so sessions must never start their own.
+    """
+    manager = StreamlitSubprocessManager()
+    atexit.register(manager.stop_process)
+    return manager
+
+def start_new_conversation():
+    """Forget the chat history and start a new worker-side session"""
+    st.session_state.chat_session_id = uuid.uuid4().hex
+    st.session_state.chat_history = []
+
+def format_live_stats(stats):
+    """Format live generation statistics as a one-line Markdown summary"""
+    parts = []
+    if stats.get("queue_position"):
+        return f"⏳ Waiting for other users' requests (position {stats['queue_position']} in queue)"
+    if stats["vision_seconds"] is not None:
+        cached = " (cached)" if stats["vision_cached"] else ""
+        parts.append(f"👁️ Vision: {stats['vision_seconds']:.2f} s{cached}")
+    if stats["ttft_seconds"] is not None:
+        parts.append(f"⏱️ First token: {stats['ttft_seconds']:.2f} s")
+    parts.append(f"🔤 Tokens: {stats['tokens']}")
+    if stats["tokens_per_second"] is not None:
+        parts.append(f"⚡ {stats['tokens_per_second']:.2f} tokens/s")
+    return " | ".join(parts)
+
 def main():
     st.set_page_config(
         page_title="MiniCPM-V-2.6 RKLLM Chat",
@@ -129,8 +160,13 @@ def main():
     if 'model_manager' not in st.session_state:
         st.session_state.model_manager = ModelManager()
     
-    if 'inference_manager' not in st.session_state:
-        st.session_state.inference_manager = StreamlitSubprocessManager()
+    inference_manager = get_inference_manager()
+    
+    if 'client_id' not in st.session_state:
+        st.session_state.client_id = uuid.uuid4().hex
+    
+    if 'chat_session_id' not in st.session_state:
+        start_new_conversation()
     
     # Model status section
     with st.expander("📁 Model Status", expanded=True):
@@ -161,10 +197,10 @@ def main():
             col1, col2 = st.columns(2)
             
             with col1:
-                if not st.session_state.inference_manager.is_ready:
+                if not inference_manager.is_ready:
                     if st.button("🔄 Start Inference Process"):
                         with st.spinner("Starting inference process..."):
-                            success = st.session_state.inference_manager.start_process()
+                            success = inference_manager.start_process()
                             
                         if success:
                             st.success("✅ Inference process started!")
@@ -175,14 +211,14 @@ def main():
                     st.success("✅ Inference process is ready")
             
             with col2:
-                if st.session_state.inference_manager.is_ready:
-                    if st.button("🛑 Stop Inference Process"):
-                        st.session_state.inference_manager.stop_process()
+                if inference_manager.is_ready:
+                    if st.button("🛑 Stop Inference Process", help="Stops the process for every connected user"):
+                        inference_manager.stop_process()
                         st.success("✅ Inference process stopped")
                         st.rerun()
         
         # Chat interface
-        if st.session_state.inference_manager.is_ready:
+        if inference_manager.is_ready:
             st.markdown("---")
             st.subheader("💬 Chat Interface")
             
@@ -194,6 +230,12 @@ def main():
             )
             
             if uploaded_file is not None:
+                # A different image starts a new conversation
+                image_id = (uploaded_file.name, uploaded_file.size)
+                if st.session_state.get('chat_image_id') != image_id:
+                    st.session_state.chat_image_id = image_id
+                    start_new_conversation()
+                
                 # Display the image
                 col1, col2 = st.columns([1, 2])
                 
@@ -202,10 +244,21 @@ def main():
                     st.image(image, caption="Uploaded Image", use_container_width=True)
                 
                 with col2:
-                    # Save the image
+                    # Save the image (named by content, so an unchanged upload is not rewritten)
                     image_path = st.session_state.model_manager.save_uploaded_image(uploaded_file)
                     
                     if image_path:
+                        # Earlier turns of this conversation
+                        for past_question, past_response in st.session_state.chat_history:
+                            with st.chat_message("user"):
+                                st.write(past_question)
+                            with st.chat_message("assistant"):
+                                st.write(past_response)
+                        
+                        if st.session_state.chat_history and st.button("🧹 New Conversation"):
+                            start_new_conversation()
+                            st.rerun()
+                        
                         # Question input
                         question = st.text_area(
                             "Ask a question about the image:",
@@ -213,20 +266,54 @@ def main():
                             height=100
                         )
                         
-                        if st.button("🔍 Analyze Image", type="primary"):
+                        stream_response = st.checkbox("Stream response", value=True,
+                                                      help="Show tokens as they are generated")
+                        
+                        analyze_col, stop_col = st.columns([3, 1])
+                        with stop_col:
+                            # 点击会请求重新运行脚本: 正在进行的请求在下一次刷新统计时被中断,
+                            # 关闭的流会在工作进程中取消请求
+                            if st.button("⏹ Stop", key="stop_inference"):
+                                inference_manager.cancel_client(st.session_state.client_id)
+                                st.info("Stopped the running request.")
+                        with analyze_col:
+                            analyze = st.button("🔍 Analyze Image", type="primary")
+                        
+                        if analyze:
                             if question.strip():
-                                with st.spinner("Analyzing image..."):
-                                    # Use the updated send_question method with separate parameters
-                                    response = st.session_state.inference_manager.send_question(question, image_path)
+                                # 统计回调在脚本线程中定期运行, Stop触发的重新运行在此中断请求
+                                stats_placeholder = st.empty()
+                                
+                                def show_stats(stats):
+                                    stats_placeholder.markdown(format_live_stats(stats))
                                 
-                                st.subheader("🤖 Response:")
-                                st.write(response)
+                                if stream_response:
+                                    st.subheader("🤖 Response:")
+                                    stream = inference_manager.stream_question(
+                                        question, image_path, on_stats=show_stats,
+                                        session_id=st.session_state.chat_session_id,
+                                        client_id=st.session_state.client_id)
+                                    try:
+                                        response = st.write_stream(stream)
+                                        st.session_state.chat_history.append((question, response))
+                                    except RuntimeError as e:
+                                        st.error(f"❌ Error during inference: {e}")
+                                    finally:
+                                        # 被中断时立即关闭流, 不等垃圾回收
+                                        stream.close()
+                                else:
+                                    with st.spinner("Analyzing image..."):
+                                        # Use the updated send_question method with separate parameters
+                                        response = inference_manager.send_question(
+                                            question, image_path, session_id=st.session_state.chat_session_id,
+                                            client_id=st.session_state.client_id, on_stats=show_stats)
+                                    
+                                    st.subheader("🤖 Response:")
+                                    st.write(response)
+                                    if not response.startswith("**Error"):
+                                        st.session_state.chat_history.append((question, response))
                             else:
                                 st.warning("Please enter a question about the image.")
-    
-    # Cleanup on app termination
-    if hasattr(st.session_state, 'inference_manager'):
-        atexit.register(st.session_state.inference_manager.stop_process)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
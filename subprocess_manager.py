@@ -3,280 +3,444 @@ import time
 import subprocess
 import threading
 import queue
+import itertools
+import collections
 import streamlit as st
 import sys
 
+import ipc_protocol
+
+# Seconds a request may take once the worker has it; the worker aborts the generation after that
+REQUEST_TIMEOUT = 180
+
 class StreamlitSubprocessManager:
-    def __init__(self):
+    """Owns the inference worker and multiplexes requests from many clients onto it.
+
+    One instance is meant to be shared by every browser session (see
+    ``get_inference_manager`` in streamlit_app.py), so the models are loaded
+    once. Requests wait in one queue per client and are sent to the worker
+    round-robin across clients, at most ``max_in_flight`` at a time, so a
+    client with a long backlog cannot starve the others. Responses are routed
+    back to the waiting request by ID.
+
+    A request that is cancelled (``cancel``/``cancel_client``), times out or
+    whose caller stops reading the stream is cancelled in the worker too, so
+    it stops occupying the NPU.
+    """
+
+    def __init__(self, worker_script="multiprocess_inference.py",
+                 max_in_flight=int(os.environ.get("PIPELINE_DEPTH", 2))):
+        self.worker_script = worker_script
+        self.max_in_flight = max_in_flight
         self.process = None
         self.is_ready = False
-        self.output_queue = queue.Queue()
-        self.error_queue = queue.Queue()
-        self.input_queue = queue.Queue()
-        
+        self.error_lines = collections.deque(maxlen=200)
+        self.ready_event = threading.Event()
+        self.request_writer = None
+        self.response_queues = {}
+        self.response_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        self.process_lock = threading.Lock()
+        # 每个客户端一个等待队列, 按客户端轮流发送
+        self.client_queues = collections.OrderedDict()
+        self.dispatched = {}
+        self.in_flight = 0
+        self.scheduler = threading.Condition()
+        self.dispatch_thread = None
+        # 请求ID -> 客户端ID, 以及已向工作进程发送过取消帧的请求
+        self.request_clients = {}
+        self.cancel_sent = set()
+
     def start_process(self):
-        """Start the inference subprocess"""
+        """Start the inference subprocess, or return the state of the running one"""
+        with self.process_lock:
+            return self._start_process()
+
+    def _start_process(self):
         if self.process is not None:
             print("Process already running")
-            return
-        
+            return self.is_ready
+
         try:
             print("=== STARTING SUBPROCESS ===")
             print(f"Working directory: {os.getcwd()}")
             print(f"Python executable: {sys.executable}")
-            print(f"Command: python multiprocess_inference.py")
-            
-            # Start subprocess with unbuffered output
+            print(f"Command: python {self.worker_script} --ipc-fds IN,OUT")
+
+            # Dedicated pipes for protocol frames; stdout/stderr of the worker only carry logs
+            request_read, request_write = os.pipe()
+            response_read, response_write = os.pipe()
+            self.ready_event.clear()
             self.process = subprocess.Popen(
-                [sys.executable, "-u", "multiprocess_inference.py"],  # -u for unbuffered
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
+                [sys.executable, "-u", self.worker_script,
+                 "--ipc-fds", f"{request_read},{response_write}"],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
                 stderr=subprocess.PIPE,
+                pass_fds=(request_read, response_write),
                 text=True,
-                bufsize=0,  # Unbuffered
-                universal_newlines=True
+                bufsize=1,
             )
-            
+            os.close(request_read)
+            os.close(response_write)
+            self.request_writer = ipc_protocol.FrameWriter(os.fdopen(request_write, "wb"))
+
             print(f"Process started with PID: {self.process.pid}")
-            
+
             # Start I/O threads
-            self.output_thread = threading.Thread(target=self._read_output, daemon=True)
+            self.response_thread = threading.Thread(target=self._read_responses,
+                                                    args=(os.fdopen(response_read, "rb"),), daemon=True)
             self.error_thread = threading.Thread(target=self._read_error, daemon=True)
-            self.input_thread = threading.Thread(target=self._write_input, daemon=True)
-            
-            self.output_thread.start()
+
+            self.response_thread.start()
             self.error_thread.start()
-            self.input_thread.start()
-            
+            if self.dispatch_thread is None:
+                self.dispatch_thread = threading.Thread(target=self._dispatch_requests, daemon=True)
+                self.dispatch_thread.start()
+
             print("I/O threads started")
-            
+
             # Wait for ready signals
-            self._wait_for_ready()
-            
+            return self._wait_for_ready()
+
         except Exception as e:
             print(f"Error starting process: {e}")
             self.process = None
+            return False
 
     def _wait_for_ready(self):
         """Wait for the subprocess to be ready for inference"""
         print("Waiting for subprocess to be ready...")
-        start_time = time.time()
         timeout = 180  # 180 seconds timeout
-        
-        while time.time() - start_time < timeout:
-            # Check if process is still running
-            if self.process.poll() is not None:
-                print(f"Process terminated during startup with return code: {self.process.returncode}")
-                self._print_all_errors()
-                return False
-            
-            # Check for ready signals in output
-            try:
-                output = self.output_queue.get(timeout=1)
-                print(f"STARTUP OUTPUT: {output}")
-                
-                # Look for indicators that the process is ready
-                if "Enter your input :" in output:
-                    print("Subprocess is ready!")
-                    self.is_ready = True
-                    return True
-                    
-            except queue.Empty:
-                # self._print_errors()
-                continue
-        
-        print("Timeout waiting 3 minutes for subprocess to be ready")
-        self._print_all_errors()
-        return False
-    
-    def _read_output(self):
-        """Read output from the subprocess"""
+
+        # The response reader sets the event on the ready frame or when the worker exits
+        if not self.ready_event.wait(timeout):
+            print("Timeout waiting 3 minutes for subprocess to be ready")
+            self._print_all_errors()
+            return False
+
+        if self.process.poll() is not None:
+            print(f"Process terminated during startup with return code: {self.process.returncode}")
+            self._print_all_errors()
+            return False
+
+        print("Subprocess is ready!")
+        self.is_ready = True
+        return True
+
+    def _read_responses(self, stream):
+        """Route response frames from the subprocess to the waiting requests"""
         try:
-            while self.process and self.process.poll() is None:
-                line = self.process.stdout.readline()
-                if line:
-                    self.output_queue.put(line.strip())
+            for frame in ipc_protocol.read_frames(stream):
+                if frame.get("type") == ipc_protocol.READY:
+                    self.ready_event.set()
+                    continue
+                with self.response_lock:
+                    response_queue = self.response_queues.get(frame.get("id"))
+                if response_queue is not None:
+                    response_queue.put(frame)
         except Exception as e:
-            print(f"Error reading output: {e}")
-    
+            print(f"Error reading responses: {e}")
+        finally:
+            # The worker is gone: wake up everyone who is still waiting
+            self.is_ready = False
+            self.ready_event.set()
+            with self.response_lock:
+                for request_id, response_queue in self.response_queues.items():
+                    response_queue.put({"type": ipc_protocol.ERROR, "id": request_id,
+                                        "message": "Inference process exited"})
+
     def _read_error(self):
-        """Read error output from the subprocess"""
+        """Read log output from the subprocess"""
         try:
-            while self.process and self.process.poll() is None:
-                line = self.process.stderr.readline()
+            for line in self.process.stderr:
+                line = line.rstrip()
                 if line:
-                    self.error_queue.put(line.strip())
+                    print(f"WORKER: {line}")
+                    self.error_lines.append(line)
         except Exception as e:
             print(f"Error reading stderr: {e}")
-    
-    def _print_errors(self):
-        """Print any available error messages"""
-        while not self.error_queue.empty():
-            try:
-                error = self.error_queue.get_nowait()
-                print(f"STDERR: {error}")
-            except queue.Empty:
-                break
-    
+
     def _print_all_errors(self):
-        """Print all remaining error messages"""
+        """Print the most recent log lines of the subprocess"""
         print("=== CHECKING FOR ERRORS ===")
-        self._print_errors()
-        
-        # Also try to read any remaining stderr directly
-        if self.process and self.process.stderr:
+        for line in self.error_lines:
+            print(f"STDERR: {line}")
+
+    def _dispatch_requests(self):
+        """Send queued requests to the worker, one client at a time in turn"""
+        while True:
+            with self.scheduler:
+                while self.in_flight >= self.max_in_flight or not self.client_queues:
+                    self.scheduler.wait()
+                client_id, requests = next(iter(self.client_queues.items()))
+                request, dispatched = requests.popleft()
+                # 该客户端移到队尾, 下一个请求先轮到其他客户端
+                del self.client_queues[client_id]
+                if requests:
+                    self.client_queues[client_id] = requests
+                self.in_flight += 1
+                self.dispatched[request["id"]] = True
             try:
-                remaining_stderr = self.process.stderr.read()
-                if remaining_stderr:
-                    print(f"REMAINING STDERR: {remaining_stderr}")
-            except:
-                pass
-    
-    def _write_input(self):
-        """Write input to the subprocess"""
+                self.request_writer.send(request)
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Failed to send request {request['id']}: {e}")
+                with self.response_lock:
+                    response_queue = self.response_queues.get(request["id"])
+                if response_queue is not None:
+                    response_queue.put({"type": ipc_protocol.ERROR, "id": request["id"],
+                                        "message": "Inference process is not running"})
+            dispatched.set()
+
+    def _enqueue(self, client_id, request):
+        """Queue a request behind the client's earlier ones; returns the event set once it is sent"""
+        dispatched = threading.Event()
+        with self.scheduler:
+            self.client_queues.setdefault(client_id, collections.deque()).append((request, dispatched))
+            self.scheduler.notify()
+        return dispatched
+
+    def _queue_position(self, request_id):
+        """1 if this request is sent next, 2 if after one other, ...; 0 once it has been sent"""
+        with self.scheduler:
+            client_queues = list(self.client_queues.values())
+            ahead = 0
+            # 按轮询顺序数出排在本请求之前的请求
+            for turn in range(max((len(requests) for requests in client_queues), default=0)):
+                for requests in client_queues:
+                    if turn < len(requests):
+                        if requests[turn][0]["id"] == request_id:
+                            return ahead + 1
+                        ahead += 1
+            return 0
+
+    def _finish_request(self, request_id):
+        with self.scheduler:
+            if self.dispatched.pop(request_id, False):
+                self.in_flight -= 1
+            else:
+                # 尚未发送就被放弃的请求直接从队列中移除
+                for client_id, requests in list(self.client_queues.items()):
+                    for item in list(requests):
+                        if item[0]["id"] == request_id:
+                            requests.remove(item)
+                    if not requests:
+                        del self.client_queues[client_id]
+            self.scheduler.notify()
+
+    def _send_cancel(self, request_id):
+        with self.response_lock:
+            if request_id in self.cancel_sent:
+                return
+            self.cancel_sent.add(request_id)
         try:
-            while self.process and self.process.poll() is None:
-                try:
-                    input_text = self.input_queue.get(timeout=1)
-                    if input_text is not None:  # Allow empty strings
-                        print(f"SENDING TO SUBPROCESS: '{input_text}'")
-                        self.process.stdin.write(input_text + '\n')
-                        self.process.stdin.flush()
-                except queue.Empty:
-                    continue
-        except Exception as e:
-            print(f"Error writing input: {e}")
-    
-    def send_question(self, question, image_path):
-        """Send a question to the inference process"""
+            self.request_writer.send({"type": ipc_protocol.CANCEL, "id": request_id})
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Failed to cancel request {request_id}: {e}")
+
+    def cancel(self, request_id):
+        """Stop a request: drop it from the queue or abort it in the worker"""
+        with self.scheduler:
+            dispatched = self.dispatched.get(request_id, False)
+        if dispatched:
+            self._send_cancel(request_id)
+        with self.response_lock:
+            response_queue = self.response_queues.get(request_id)
+        if response_queue is not None:
+            # 唤醒等待该请求的调用方
+            response_queue.put({"type": ipc_protocol.ERROR, "id": request_id, "message": "Cancelled"})
+
+    def cancel_client(self, client_id):
+        """Cancel every request of one client; returns how many there were"""
+        with self.response_lock:
+            request_ids = [request_id for request_id, client in self.request_clients.items() if client == client_id]
+        for request_id in request_ids:
+            self.cancel(request_id)
+        return len(request_ids)
+
+    def stream_question(self, question, image_path, timings=None, on_stats=None, stats_interval=0.25,
+                        session_id=None, client_id=None):
+        """Send a question and yield response tokens as the worker produces them.
+
+        Questions with the same ``session_id`` form one conversation: the worker
+        keeps the image embedding and earlier turns for follow-up questions.
+        ``client_id`` identifies the browser session for fair queueing; it
+        defaults to the conversation.
+
+        Timing frames are collected into ``timings`` (stage -> frame) when a dict
+        is given. ``on_stats`` is called with a dict of live statistics (queue
+        position, vision time, time to first token, token count and rate)
+        while the request waits for its turn, whenever a timing frame arrives,
+        at most every ``stats_interval`` seconds while tokens stream or the
+        worker is still busy, and once more at the end. Raises RuntimeError on worker errors, cancellation and
+        timeout. Closing the generator early cancels the request.
+        """
         if not self.is_ready or not self.process:
-            return "Error: Inference process not ready"
-        
+            raise RuntimeError("Inference process not ready")
+
+        if timings is None:
+            timings = {}
+        request_id = next(self.request_ids)
+        response_queue = queue.Queue()
+        if client_id is None:
+            client_id = session_id
+        with self.response_lock:
+            self.response_queues[request_id] = response_queue
+            self.request_clients[request_id] = client_id
+        finished = False
+
+        stats = {"queue_position": 0, "vision_seconds": None, "vision_cached": False, "ttft_seconds": None,
+                 "tokens": 0, "tokens_per_second": None}
+        first_token_time = None
+        last_stats_time = 0
+
+        def report(force=False):
+            nonlocal last_stats_time
+            now = time.time()
+            if on_stats is not None and (force or now - last_stats_time >= stats_interval):
+                last_stats_time = now
+                on_stats(dict(stats))
+
         try:
-            print(f"=== SENDING QUESTION ===")
+            print(f"=== SENDING QUESTION {request_id} ===")
             print(f"Question: {question}")
             print(f"Image Path: {image_path}")
-            
-            # Send first line: Read the image in {{...}} carefully.
-            image_check_line = f"Read the image in {{{{{image_path}}}}} carefully."
-            print(f"First Line: {image_check_line}")
-            self.input_queue.put(image_check_line)
-            
-            # Send second line: user question
-            print(f"Second Line: {question}")
-            self.input_queue.put(question)
-            
-            # Send three empty lines to signal end of input
-            for _ in range(3):
-                self.input_queue.put("")
-            
-            print("Image check line, question, and empty lines sent")
-            
-            # Collect ALL raw output until 'Enter your input :' marker
-            all_raw_lines = []
-            start_time = time.time()
-            
-            while time.time() - start_time < 180:  # 3 minute timeout
-                # Check if process is still running
-                if self.process.poll() is not None:
-                    print(f"Process terminated during inference with return code: {self.process.returncode}")
-                    self._print_all_errors()
+
+            request = {
+                "type": ipc_protocol.REQUEST,
+                "id": request_id,
+                "image": image_path,
+                "text": f"Read the image in {ipc_protocol.IMAGE_MARKER} carefully.\n{question}",
+                "timeout": REQUEST_TIMEOUT,
+            }
+            if session_id is not None:
+                request["session"] = session_id
+            dispatched = self._enqueue(client_id, request)
+            while not dispatched.wait(stats_interval):
+                if not self.is_ready:
+                    raise RuntimeError("Inference process exited")
+                if not response_queue.empty():
+                    # 排队期间被取消
                     break
-                
+                stats["queue_position"] = self._queue_position(request_id)
+                report(force=True)
+            stats["queue_position"] = 0
+
+            # The worker enforces REQUEST_TIMEOUT itself; this only covers a worker that stopped answering
+            deadline = time.time() + REQUEST_TIMEOUT + 10
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError(f"Timeout waiting for response to request {request_id}")
                 try:
-                    output = self.output_queue.get(timeout=2)
-                    print(f"RAW OUTPUT: {repr(output)}")
-                    
-                    # Check for end marker 'Enter your input :'
-                    if "Enter your input :" in output:
-                        print("Found 'Enter your input :' marker - response complete")
-                        break
-                    
-                    # Add to raw collection (exclude the end marker)
-                    all_raw_lines.append(output)
-                        
+                    frame = response_queue.get(timeout=min(remaining, stats_interval))
                 except queue.Empty:
-                    self._print_errors()
+                    # 没有新帧时也定期回调, 调用方可借此中断等待
+                    report()
                     continue
-            
-            if all_raw_lines:
-                # Convert complete raw response to Markdown format
-                raw_response = '\n'.join(all_raw_lines)
-                markdown_response = self._convert_to_markdown(raw_response)
-                return markdown_response
+
+                frame_type = frame.get("type")
+                if frame_type == ipc_protocol.TOKEN:
+                    now = time.time()
+                    if first_token_time is None:
+                        first_token_time = now
+                    stats["tokens"] += frame.get("tokens", 1)
+                    if now > first_token_time:
+                        stats["tokens_per_second"] = (stats["tokens"] - 1) / (now - first_token_time)
+                    report()
+                    yield frame["text"]
+                elif frame_type == ipc_protocol.TIMING:
+                    timings[frame["stage"]] = frame
+                    if frame["stage"] == "vision":
+                        stats["vision_seconds"] = frame["seconds"]
+                        stats["vision_cached"] = frame.get("cache_hit", False)
+                    elif frame["stage"] == "first_token":
+                        stats["ttft_seconds"] = frame["seconds"]
+                    elif frame["stage"] == "total":
+                        decode_seconds = frame["seconds"] - (stats["ttft_seconds"] or 0)
+                        if frame["tokens"] > 1 and decode_seconds > 0:
+                            stats["tokens_per_second"] = (frame["tokens"] - 1) / decode_seconds
+                    report(force=True)
+                elif frame_type == ipc_protocol.DONE:
+                    finished = True
+                    report(force=True)
+                    return
+                elif frame_type == ipc_protocol.ERROR:
+                    print(f"Inference error for request {request_id}: {frame.get('message')}")
+                    raise RuntimeError(frame.get("message"))
+        finally:
+            # 超时、取消或调用方不再读取时, 让工作进程停止生成
+            with self.scheduler:
+                dispatched_to_worker = self.dispatched.get(request_id, False)
+            if dispatched_to_worker and not finished:
+                self._send_cancel(request_id)
+            self._finish_request(request_id)
+            with self.response_lock:
+                self.response_queues.pop(request_id, None)
+                self.request_clients.pop(request_id, None)
+                self.cancel_sent.discard(request_id)
+
+    def send_question(self, question, image_path, session_id=None, client_id=None, on_stats=None):
+        """Send a question to the inference process and return the full response as Markdown.
+
+        ``on_stats`` is passed to ``stream_question``; raising from it cancels
+        the request.
+        """
+        if not self.is_ready or not self.process:
+            return "Error: Inference process not ready"
+
+        try:
+            timings = {}
+            tokens = list(self.stream_question(question, image_path, timings=timings, on_stats=on_stats,
+                                               session_id=session_id, client_id=client_id))
+            if tokens:
+                return self._format_markdown("".join(tokens), timings)
             else:
                 return "**Error:** No response received"
-                
+
         except Exception as e:
             print(f"Exception during inference: {e}")
             return f"**Error during inference:** {e}"
-    
-    def _convert_to_markdown(self, text):
-        """Convert plain text response to Markdown format with proper formatting"""
-        lines = text.split('\n')
+
+    def _format_markdown(self, text, timings):
+        """Format the response text and timing records as Markdown"""
         markdown_lines = []
-        dash_line_count = 0
-        
-        for line in lines:
-            line = line.strip()
-            
-            # Skip the "Start vision inference..." line
-            if "Start vision inference" in line:
-                continue
-                
-            if line:
-            # Check if this is a line of dashes (performance table border)
-                if line.startswith('--------------------------------------------------------------------------------------'):
-                    dash_line_count += 1
-                    if dash_line_count == 1:
-                        # First dash line - start code block
-                        markdown_lines.append('```')
-                        markdown_lines.append(line)
-                    elif dash_line_count == 2:
-                        # Second dash line - just add it
-                        markdown_lines.append(line)
-                    elif dash_line_count == 3:
-                        # Third dash line - add it and end code block
-                        markdown_lines.append(line)
-                        markdown_lines.append('```')
-                    else:
-                        # Any additional dash lines
-                        markdown_lines.append(line)
-                # Handle timing information - separate lines
-                elif "Vision encoder inference time:" in line: 
-                    markdown_lines.append("**Vision Encoder Timing:**") 
-                    markdown_lines.append(line) 
-                    markdown_lines.append("") 
-                elif "Time to first token:" in line: 
-                    markdown_lines.append("**Generation Timing:**") 
-                    markdown_lines.append(line) 
-                    markdown_lines.append("") 
-                # Handle the actual response content 
-                elif line.startswith('"') and line.endswith('"'): 
-                    markdown_lines.append("**Response:**") 
-                    markdown_lines.append(line.strip('"')) 
-                    markdown_lines.append("")
-                else:
-                    # Regular content
-                    markdown_lines.append(line)
-            else:
-                # Add empty line for spacing (but not inside performance table)
-                markdown_lines.append("")
-        
-        # Join lines and clean up formatting
-        result = '\n'.join(markdown_lines)
-        
-        # Clean up multiple consecutive empty lines
-        import re
-        result = re.sub(r'\n\s*\n\s*\n', '\n\n', result)
-        
-        return result.strip()
+
+        vision = timings.get("vision")
+        if vision:
+            cached = " (cached)" if vision.get("cache_hit") else ""
+            markdown_lines.append("**Vision Encoder Timing:**")
+            markdown_lines.append(f"Vision encoder inference time: {vision['seconds']:.2f} seconds{cached}")
+            markdown_lines.append("")
+
+        first_token = timings.get("first_token")
+        total = timings.get("total")
+        if first_token or total:
+            markdown_lines.append("**Generation Timing:**")
+            if first_token:
+                markdown_lines.append(f"Time to first token: {first_token['seconds']:.2f} seconds")
+            if total and total["seconds"] > 0:
+                markdown_lines.append(f"Generated {total['tokens']} tokens in {total['seconds']:.2f} seconds "
+                                      f"({total['tokens'] / total['seconds']:.2f} tokens/s)")
+            markdown_lines.append("")
+
+        markdown_lines.append("**Response:**")
+        markdown_lines.append(text.strip())
+
+        return "\n".join(markdown_lines)
 
     def stop_process(self):
         """Stop the inference process"""
+        with self.process_lock:
+            self._stop_process()
+
+    def _stop_process(self):
         print("=== STOPPING SUBPROCESS ===")
         if self.process:
             try:
+                if self.request_writer:
+                    self.request_writer.close()
                 self.process.terminate()
                 self.process.wait(timeout=5)
                 print(f"Process terminated with return code: {self.process.returncode}")
@@ -286,4 +450,5 @@ class StreamlitSubprocessManager:
             except Exception as e:
                 print(f"Error stopping process: {e}")
             self.process = None
-        self.is_ready = False
\ No newline at end of file
+            self.request_writer = None
+        self.is_ready = False
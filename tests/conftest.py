@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root, next to this directory
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(scope="session")
+def fake_npu():
+    """The fake NPU runtimes, installed once before multiprocess_inference is first imported.
+
+    Returns the fake LLM runtime; its latencies (and FakeRKNNLite's) are
+    inherited by worker processes forked after they are set.
+    """
+    pytest.importorskip("cv2")
+    from benchmarks import fakes
+    os.environ.setdefault("TOKENIZER_DIR", REPO_DIR)
+    os.environ.setdefault("LLM_CONFIG_PATH", os.path.join(REPO_DIR, "config.json"))
+    runtime = fakes.install(vision_seconds=0)
+    import multiprocess_inference  # noqa: F401
+    return runtime
+
+
+@pytest.fixture
+def inference(fake_npu):
+    """multiprocess_inference running on the fake NPU runtimes"""
+    import multiprocess_inference
+    return multiprocess_inference
+
+
+@pytest.fixture
+def make_pipeline(fake_npu, monkeypatch):
+    """Create InferencePipelines on the fake NPU runtimes; all of them are stopped at teardown.
+
+    Keyword arguments other than the pipeline's own set the fake LLM runtime's
+    latencies (``prefill_seconds``, ``tokens_per_second``, ``response_tokens``)
+    for workers started afterwards; pass ``start=False`` when something else,
+    such as ChatCompletionServer, starts the pipeline.
+    """
+    import multiprocess_inference
+    pipelines = []
+
+    def make(max_pending=2, stream_tokens=True, start=True, **latencies):
+        latencies = {"prefill_seconds": 0.02, "tokens_per_second": 0, "response_tokens": 8, **latencies}
+        for name, value in latencies.items():
+            monkeypatch.setattr(fake_npu, name, value)
+        pipeline = multiprocess_inference.InferencePipeline(max_pending=max_pending, stream_tokens=stream_tokens)
+        pipelines.append(pipeline)
+        if start:
+            pipeline.start()
+        return pipeline
+
+    yield make
+    for pipeline in pipelines:
+        if pipeline.vision_process is not None:
+            pipeline.stop()
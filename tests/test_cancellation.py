@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+
+from benchmarks.fakes import FakeRKNNLite
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES = [os.path.join(REPO_DIR, name) for name in ("bill.jpg", "man.jpg")]
+
+
+class Request:
+    """Records one pipeline request's events and final status"""
+
+    def __init__(self, pipeline, inference, image=IMAGES[0], text="What is in the image?"):
+        self.events = []
+        self.status = None
+        self.finished = threading.Event()
+        self.id = pipeline.submit(image, inference.build_request_prompt(text),
+                                  on_done=self._on_done, on_event=self._on_event)
+
+    def _on_event(self, request_id, kind, payload):
+        self.events.append((kind, payload))
+
+    def _on_done(self, request_id, status):
+        self.status = status
+        self.finished.set()
+
+    def stages(self):
+        return [payload["stage"] for kind, payload in self.events if kind == "timing"]
+
+    def tokens(self):
+        return sum(payload[1] for kind, payload in self.events if kind == "token")
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not predicate() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert predicate()
+
+
+def test_cancel_before_vision_skips_the_encoder(make_pipeline, inference, monkeypatch):
+    monkeypatch.setattr(FakeRKNNLite, "inference_seconds", 0.5)
+    pipeline = make_pipeline()
+    first = Request(pipeline, inference, IMAGES[0])
+    time.sleep(0.1)
+    # 第二个请求还在视觉进程的队列中时取消
+    second = Request(pipeline, inference, IMAGES[1])
+    assert pipeline.cancel(second.id)
+    assert not pipeline.cancel(second.id)
+
+    assert second.finished.wait(10) and first.finished.wait(10)
+    assert (first.status, second.status) == ("DONE", "CANCELLED")
+    assert "vision" not in second.stages() and second.tokens() == 0
+    assert ("error", "Cancelled") in second.events
+    assert not pipeline.cancel(first.id)
+
+
+def test_cancel_while_waiting_for_the_llm(make_pipeline, inference):
+    pipeline = make_pipeline(tokens_per_second=50, response_tokens=50)
+    first = Request(pipeline, inference)
+    second = Request(pipeline, inference)
+    # 第二个请求的图像已编码, 但LLM还在生成第一个回答
+    second.wait_for(lambda: "vision" in second.stages() and first.tokens() > 0)
+    pipeline.cancel(second.id, "Stopped by user")
+    assert second.finished.wait(10) and first.finished.wait(10)
+    assert (first.status, second.status) == ("DONE", "CANCELLED")
+    assert "first_token" not in second.stages() and ("error", "Stopped by user") in second.events
+    assert first.tokens() == 50
+
+
+def test_cancel_during_prefill(make_pipeline, inference):
+    pipeline = make_pipeline(prefill_seconds=1.0)
+    request = Request(pipeline, inference)
+    request.wait_for(lambda: "vision" in request.stages())
+    time.sleep(0.2)
+    pipeline.cancel(request.id)
+    assert request.finished.wait(10)
+    assert request.status == "CANCELLED" and request.tokens() == 0
+
+    # 中止不会影响紧接着的下一个请求
+    following = Request(pipeline, inference)
+    assert following.finished.wait(10)
+    assert following.status == "DONE" and following.tokens() == 8
+
+
+def test_cancel_during_decode_frees_the_npu(make_pipeline, inference):
+    pipeline = make_pipeline(max_pending=1, tokens_per_second=20, response_tokens=400)
+    request = Request(pipeline, inference)
+    request.wait_for(lambda: request.tokens() > 0)
+    start = time.monotonic()
+    pipeline.cancel(request.id)
+    assert request.finished.wait(10)
+    assert request.status == "CANCELLED" and request.tokens() < 400
+    # 400个token需要20秒, 中止后很快结束, 下一个请求得到流水线的位置
+    assert time.monotonic() - start < 2
+    following = Request(pipeline, inference)
+    following.wait_for(lambda: following.tokens() > 0)
+    pipeline.cancel(following.id)
+    assert following.finished.wait(10) and following.status == "CANCELLED"
+
+
+def test_failed_aborts_are_retried(make_pipeline, inference, fake_npu, monkeypatch):
+    # 前三次中止失败, 监听线程每0.2秒重试一次
+    monkeypatch.setattr(fake_npu, "abort_failures", 3)
+    pipeline = make_pipeline(tokens_per_second=20, response_tokens=400)
+    request = Request(pipeline, inference)
+    request.wait_for(lambda: request.tokens() > 0)
+    start = time.monotonic()
+    pipeline.cancel(request.id)
+    assert request.finished.wait(10)
+    elapsed = time.monotonic() - start
+    assert request.status == "CANCELLED" and request.tokens() < 400
+    assert 0.5 < elapsed < 3
+
+
+def test_expired_deadline_cancels_the_request(make_pipeline, inference, monkeypatch):
+    monkeypatch.setattr(inference, "REQUEST_TIMEOUT", 0.5)
+    pipeline = make_pipeline(tokens_per_second=20, response_tokens=400)
+    start = time.monotonic()
+    request = Request(pipeline, inference)
+    assert request.finished.wait(10)
+    assert request.status == "CANCELLED"
+    assert ("error", inference.ipc_protocol.DEADLINE_EXCEEDED) in request.events
+    assert time.monotonic() - start < 3
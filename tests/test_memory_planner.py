@@ -0,0 +1,81 @@
+import os
+
+from memory_planner import GiB, MiB, MemoryPlanner, format_plan, kv_cache_bytes_per_token, load_model_config, \
+    parse_meminfo
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = load_model_config(os.path.join(REPO_DIR, "config.json"))
+# Sizes of the shipped qwen.rkllm (w8a8) and vision_transformer.rknn, rounded up
+LLM_MODEL_BYTES = 8 * GiB
+VISION_MODEL_BYTES = 1 * GiB
+CACHE_BYTES = 256 * MiB + 64 * MiB + 4 * 16 * MiB
+
+
+def meminfo_text(total_kb, available_kb, free_kb=None):
+    lines = [f"MemTotal:       {total_kb} kB",
+             f"MemFree:        {free_kb if free_kb is not None else available_kb // 2} kB"]
+    if available_kb is not None:
+        lines.append(f"MemAvailable:   {available_kb} kB")
+    lines += [f"Buffers:        {64 * 1024} kB", f"Cached:         {available_kb // 2 if available_kb else 0} kB",
+              "HugePages_Total:       0"]
+    return "\n".join(lines) + "\n"
+
+
+def plan_for(meminfo, vision_instances=1):
+    return MemoryPlanner(meminfo, CONFIG, LLM_MODEL_BYTES, VISION_MODEL_BYTES, vision_instances=vision_instances,
+                         cache_bytes=CACHE_BYTES).plan()
+
+
+def test_parse_meminfo():
+    meminfo = parse_meminfo(meminfo_text(16 * 1024 * 1024, 15 * 1024 * 1024))
+    assert meminfo["MemTotal"] == 16 * GiB
+    assert meminfo["MemAvailable"] == 15 * GiB
+    # 没有单位的字段按原值保存
+    assert meminfo["HugePages_Total"] == 0
+
+
+def test_kv_cache_bytes_per_token_from_config():
+    # Qwen2-7B: 28 layers, 4 KV heads of 3584 / 28 = 128 dimensions, keys and values in fp16
+    assert kv_cache_bytes_per_token(CONFIG) == 2 * 28 * 4 * 128 * 2
+
+
+def test_16gib_board_gets_the_capped_context():
+    plan = plan_for(parse_meminfo(meminfo_text(16 * 1024 * 1024, 15 * 1024 * 1024)))
+    assert plan["fits"]
+    assert plan["max_context_len"] == 4096
+    assert plan["max_new_tokens"] == 1024
+    assert plan["kv_budget_bytes"] >= 4096 * plan["kv_bytes_per_token"]
+
+
+def test_busy_16gib_board_in_throughput_pool_mode_shrinks_the_context():
+    # Three vision encoder instances and other processes leave less room for the KV cache
+    plan = plan_for(parse_meminfo(meminfo_text(16 * 1024 * 1024, int(13.6 * 1024 * 1024))), vision_instances=3)
+    assert plan["fits"]
+    assert 1024 <= plan["max_context_len"] < 4096
+    assert plan["max_context_len"] % 256 == 0
+    assert plan["max_context_len"] * plan["kv_bytes_per_token"] <= plan["kv_budget_bytes"]
+
+
+def test_12gib_and_smaller_boards_fall_back_to_the_minimum_context():
+    for total_gib in (12, 8):
+        plan = plan_for(parse_meminfo(meminfo_text(total_gib * 1024 * 1024, (total_gib - 1) * 1024 * 1024)))
+        assert not plan["fits"]
+        assert plan["max_context_len"] == 1024
+        assert plan["max_new_tokens"] == 256
+        assert "not enough memory" in format_plan(plan)
+
+
+def test_kernel_without_memavailable_uses_free_and_cached_memory():
+    meminfo = parse_meminfo(meminfo_text(16 * 1024 * 1024, None, free_kb=10 * 1024 * 1024)
+                            .replace("Cached:         0 kB", f"Cached:         {5 * 1024 * 1024} kB"))
+    assert "MemAvailable" not in meminfo
+    plan = plan_for(meminfo)
+    assert plan["available_bytes"] == 15 * GiB + 64 * MiB
+    assert plan["max_context_len"] == 4096
+
+
+def test_missing_meminfo_uses_the_cap():
+    plan = plan_for({})
+    assert plan["available_bytes"] is None
+    assert plan["max_context_len"] == 4096
+    assert "available unknown" in format_plan(plan)
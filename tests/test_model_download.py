@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from benchmarks.fake_model_server import make_handler, serve
+from model_download import ChunkedDownloader, Manifest, probe, sha256_file
+
+CHUNK_BYTES = 64 * 1024
+FILE_BYTES = 8 * CHUNK_BYTES + 1000
+
+
+@pytest.fixture
+def remote_dir(tmp_path):
+    directory = tmp_path / "remote"
+    directory.mkdir()
+    (directory / "qwen.rkllm").write_bytes(os.urandom(FILE_BYTES))
+    return directory
+
+
+@pytest.fixture
+def local_dir(tmp_path):
+    directory = tmp_path / "model"
+    directory.mkdir()
+    return directory
+
+
+def start_server(handler_class):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url_of(server, name="qwen.rkllm"):
+    return f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+
+def recording_handler(directory, ranges_seen, truncate_from=None, truncate_chunks=(), delay=0.0):
+    """The stand-in server, recording requested range starts.
+
+    Ranges from ``truncate_from`` and the chunks in ``truncate_chunks`` are cut
+    off at once; every other range is answered after ``delay`` seconds.
+    """
+    base = make_handler(str(directory))
+
+    class Handler(base):
+        def do_GET(self):
+            match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+            start, end = (int(match.group(1)), int(match.group(2))) if match else (0, FILE_BYTES - 1)
+            ranges_seen.append(start)
+            if (truncate_from is not None and start >= truncate_from) or start // CHUNK_BYTES in truncate_chunks:
+                length = min(end, FILE_BYTES - 1) + 1 - start
+                self.send_response(206)
+                self.send_header("Content-Length", str(length))
+                self.end_headers()
+                self.wfile.write(b"\0" * (length // 2))
+                return
+            time.sleep(delay)
+            super().do_GET()
+
+    return Handler
+
+
+def test_probe_reads_size_and_linked_etag(remote_dir):
+    server = serve(str(remote_dir))
+    try:
+        remote = probe(url_of(server))
+    finally:
+        server.shutdown()
+    assert remote.size == FILE_BYTES
+    assert remote.sha256 == sha256_file(str(remote_dir / "qwen.rkllm"))
+    assert remote.ranges
+
+
+def test_download_resumes_after_truncated_chunks(remote_dir, local_dir):
+    dest = str(local_dir / "qwen.rkllm")
+    downloader = ChunkedDownloader(workers=2, chunk_bytes=CHUNK_BYTES, retries=0, timeout=5)
+
+    first_ranges = []
+    server = start_server(recording_handler(remote_dir, first_ranges, truncate_from=4 * CHUNK_BYTES))
+    try:
+        with pytest.raises((OSError, RuntimeError)):
+            downloader.download([url_of(server)], dest)
+    finally:
+        server.shutdown()
+    assert not os.path.exists(dest)
+    with open(f"{dest}.part.json", "r", encoding="utf-8") as f:
+        done = set(json.load(f)["done"])
+    assert done and done <= {0, 1, 2, 3}
+
+    second_ranges = []
+    progress = []
+    manifest = Manifest(str(local_dir))
+    server = start_server(recording_handler(remote_dir, second_ranges))
+    try:
+        sha256 = downloader.download([url_of(server)], dest, lambda name, done_bytes, total: progress.append(
+            (name, done_bytes, total)), manifest)
+    finally:
+        server.shutdown()
+
+    # 已完成的分块不会再次下载
+    assert not {start // CHUNK_BYTES for start in second_ranges} & done
+    assert sorted(second_ranges) == [i * CHUNK_BYTES for i in range(9) if i not in done]
+    assert sha256 == sha256_file(str(remote_dir / "qwen.rkllm"))
+    assert (local_dir / "qwen.rkllm").read_bytes() == (remote_dir / "qwen.rkllm").read_bytes()
+    assert not os.path.exists(f"{dest}.part") and not os.path.exists(f"{dest}.part.json")
+    assert progress[-1] == ("qwen.rkllm", FILE_BYTES, FILE_BYTES)
+    assert Manifest(str(local_dir)).verify("qwen.rkllm", dest) is True
+
+
+def test_chunks_in_flight_when_another_fails_are_recorded(remote_dir, local_dir):
+    dest = str(local_dir / "qwen.rkllm")
+    ranges = []
+    server = start_server(recording_handler(remote_dir, ranges, truncate_chunks={1}, delay=0.3))
+    try:
+        with pytest.raises((OSError, RuntimeError)):
+            ChunkedDownloader(workers=4, chunk_bytes=CHUNK_BYTES, retries=0, timeout=5).download(
+                [url_of(server)], dest)
+    finally:
+        server.shutdown()
+    with open(f"{dest}.part.json", "r", encoding="utf-8") as f:
+        done = set(json.load(f)["done"])
+    # 分块1失败时其他已开始的分块仍在下载; 它们完成后写入状态, 尚未开始的分块被取消
+    started = {start // CHUNK_BYTES for start in ranges}
+    assert {0, 2, 3} <= done == started - {1}
+    assert len(started) < 9
+
+
+def test_download_without_range_support(remote_dir, local_dir):
+    server = serve(str(remote_dir), ranges=False)
+    try:
+        ChunkedDownloader(chunk_bytes=CHUNK_BYTES).download([url_of(server)], str(local_dir / "qwen.rkllm"))
+    finally:
+        server.shutdown()
+    assert (local_dir / "qwen.rkllm").read_bytes() == (remote_dir / "qwen.rkllm").read_bytes()
+
+
+def test_download_falls_back_from_an_unreachable_mirror(remote_dir, local_dir):
+    server = serve(str(remote_dir))
+    try:
+        ChunkedDownloader(chunk_bytes=CHUNK_BYTES).download(
+            [url_of(server, "missing/qwen.rkllm"), url_of(server)], str(local_dir / "qwen.rkllm"))
+    finally:
+        server.shutdown()
+    assert (local_dir / "qwen.rkllm").read_bytes() == (remote_dir / "qwen.rkllm").read_bytes()
+
+
+def test_manifest_verification(local_dir):
+    path = local_dir / "qwen.rkllm"
+    path.write_bytes(b"weights" * 1000)
+    manifest = Manifest(str(local_dir))
+    assert manifest.verify("qwen.rkllm", str(path)) is None
+    manifest.record("qwen.rkllm", str(path), sha256_file(str(path)))
+
+    # 重新加载的清单按大小和修改时间信任文件
+    assert Manifest(str(local_dir)).verify("qwen.rkllm", str(path)) is True
+    # 只修改时间的文件重新计算哈希后仍然有效
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert Manifest(str(local_dir)).verify("qwen.rkllm", str(path)) is True
+    # 大小相同但内容损坏
+    path.write_bytes(b"WEIGHTS" * 1000)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+    assert Manifest(str(local_dir)).verify("qwen.rkllm", str(path)) is False
+    path.write_bytes(b"short")
+    assert Manifest(str(local_dir)).verify("qwen.rkllm", str(path)) is False
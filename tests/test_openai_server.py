@@ -0,0 +1,253 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+
+import ipc_protocol
+from openai_server import ChatCompletionServer, HTTPError, job_error
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def chat_request(text="What is in the image?", image="bill.jpg", **fields):
+    return {"model": "minicpm-v-2.6", **fields, "messages": [{"role": "user", "content": [
+        {"type": "image_url", "image_url": {"url": image}}, {"type": "text", "text": text}]}]}
+
+
+@contextlib.asynccontextmanager
+async def running_server(pipeline, queue_size=8):
+    """A ChatCompletionServer on an ephemeral port, once its pipeline has started"""
+    from multiprocess_inference import build_conversation_prompt
+    server = ChatCompletionServer(pipeline, build_conversation_prompt, ipc_protocol.IMAGE_MARKER,
+                                  queue_size=queue_size, image_root=REPO_DIR)
+    await server.start()
+    while not server.ready and not server.failed:
+        await asyncio.sleep(0.01)
+    http_server = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+    try:
+        yield server, http_server.sockets[0].getsockname()[1]
+    finally:
+        http_server.close()
+        await http_server.wait_closed()
+
+
+async def open_request(port, method, path, body=b"", headers=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = [f"{method} {path} HTTP/1.1", "Host: test", "Connection: close"]
+    headers = {"Content-Length": str(len(body)), **(headers or {})}
+    head += [f"{name}: {value}" for name, value in headers.items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    return reader, writer
+
+
+async def http_request(port, method, path, body=b"", headers=None):
+    """Send one request and read the answer until the server closes; returns (status, headers, body)"""
+    if isinstance(body, dict):
+        body = json.dumps(body).encode()
+    reader, writer = await open_request(port, method, path, body, headers)
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    response_headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        response_headers[name.strip().lower()] = value.strip()
+    return int(lines[0].split(" ")[1]), response_headers, payload
+
+
+def requests_with_status(pipeline, status):
+    return pipeline.stats()["requests_total"].get(f"status={status}", 0)
+
+
+def test_job_errors_tell_cancellations_from_server_faults():
+    assert (job_error("CANCELLED", ipc_protocol.DEADLINE_EXCEEDED).status,
+            job_error("CANCELLED", ipc_protocol.DEADLINE_EXCEEDED).error_type) == (504, "timeout")
+    assert (job_error("CANCELLED", "Cancelled").status, job_error("CANCELLED", "Cancelled").error_type) == (
+        499, "cancelled")
+    error = job_error("ERROR", "Vision encoder failed")
+    assert isinstance(error, HTTPError) and (error.status, error.error_type) == (500, "server_error")
+
+
+def test_non_streaming_client_disconnect_cancels_the_job(make_pipeline):
+    pipeline = make_pipeline(start=False, tokens_per_second=20, response_tokens=200)
+
+    async def scenario():
+        async with running_server(pipeline) as (server, port):
+            reader, writer = await open_request(port, "POST", "/v1/chat/completions",
+                                                json.dumps(chat_request()).encode())
+            # 等生成开始后断开
+            deadline = time.monotonic() + 5
+            while not pipeline.stats()["stage_seconds"] and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.3)
+            writer.close()
+            deadline = time.monotonic() + 5
+            while not requests_with_status(pipeline, "CANCELLED") and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+    start = time.monotonic()
+    asyncio.run(scenario())
+    assert requests_with_status(pipeline, "CANCELLED") == 1
+    # 200个token需要10秒; 取消后很快结束
+    assert time.monotonic() - start < 5
+
+
+def test_expired_request_answers_504(make_pipeline, monkeypatch):
+    import multiprocess_inference
+    monkeypatch.setattr(multiprocess_inference, "REQUEST_TIMEOUT", 0.5)
+    pipeline = make_pipeline(start=False, tokens_per_second=20, response_tokens=200)
+
+    async def scenario():
+        async with running_server(pipeline) as (server, port):
+            plain = await http_request(port, "POST", "/v1/chat/completions", chat_request())
+            streamed = await http_request(port, "POST", "/v1/chat/completions", chat_request(stream=True))
+            return plain, streamed
+
+    (status, _, body), (stream_status, _, stream_body) = asyncio.run(scenario())
+    assert status == 504
+    assert json.loads(body)["error"]["type"] == "timeout"
+    # 流式回复已经以200开始, 错误作为事件发送
+    assert stream_status == 200
+    errors = [json.loads(line[len(b"data: "):]) for line in stream_body.split(b"\n\n")
+              if line.startswith(b"data: {\"error\"")]
+    assert [error["error"]["type"] for error in errors] == ["timeout"]
+    assert requests_with_status(pipeline, "CANCELLED") == 2
+
+
+def sse_events(body):
+    return [json.loads(event[len(b"data: "):]) if event != b"data: [DONE]" else "[DONE]"
+            for event in body.split(b"\n\n") if event.startswith(b"data: ")]
+
+
+def test_completion_and_stream(make_pipeline):
+    pipeline = make_pipeline(start=False)
+
+    async def scenario():
+        async with running_server(pipeline) as (server, port):
+            plain = await http_request(port, "POST", "/v1/chat/completions", chat_request())
+            streamed = await http_request(port, "POST", "/v1/chat/completions", chat_request(stream=True))
+            metrics = await http_request(port, "GET", "/metrics")
+            return plain, streamed, metrics
+
+    (status, headers, body), (stream_status, stream_headers, stream_body), metrics = asyncio.run(scenario())
+    expected = "The image shows a receipt with several items"
+    assert status == 200 and headers["content-type"] == "application/json"
+    completion = json.loads(body)
+    assert completion["object"] == "chat.completion"
+    assert completion["choices"][0]["message"] == {"role": "assistant", "content": expected}
+    assert completion["choices"][0]["finish_reason"] == "stop"
+    assert completion["usage"]["completion_tokens"] == 8
+    assert completion["usage"]["total_tokens"] == completion["usage"]["prompt_tokens"] + 8
+
+    assert stream_status == 200 and stream_headers["content-type"] == "text/event-stream"
+    events = sse_events(stream_body)
+    assert events[-1] == "[DONE]"
+    chunks = events[:-1]
+    assert all(chunk["object"] == "chat.completion.chunk" for chunk in chunks)
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant", "content": ""}
+    assert "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks) == expected
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+    metrics_status, metrics_headers, metrics_body = metrics
+    assert metrics_status == 200 and metrics_headers["content-type"].startswith("text/plain")
+    text = metrics_body.decode()
+    assert "# TYPE" in text
+    assert any("requests_total" in line and 'status="DONE"' in line and line.endswith(" 2")
+               for line in text.splitlines())
+
+
+def test_invalid_requests_answer_400(make_pipeline):
+    pipeline = make_pipeline(start=False)
+    no_image = {"messages": [{"role": "user", "content": "What is in the image?"}]}
+
+    async def scenario():
+        async with running_server(pipeline) as (server, port):
+            return [
+                await http_request(port, "POST", "/v1/chat/completions", b"{}",
+                                   {"Content-Length": "not a number"}),
+                await http_request(port, "POST", "/v1/chat/completions", b"{not json"),
+                await http_request(port, "POST", "/v1/chat/completions", no_image),
+                await http_request(port, "POST", "/v1/chat/completions", chat_request(image="missing.jpg")),
+                await http_request(port, "POST", "/v1/chat/completions",
+                                   chat_request(image="data:image/jpeg;base64,???")),
+            ]
+
+    responses = asyncio.run(scenario())
+    assert [status for status, _, _ in responses] == [400] * 5
+    assert responses[0][1]["connection"] == "close"
+    messages = [json.loads(body)["error"]["message"] for _, _, body in responses]
+    assert "Content-Length" in messages[0]
+    assert "Invalid JSON" in messages[1]
+    assert "image_url" in messages[2]
+    assert "Image not found" in messages[3]
+    assert "base64" in messages[4]
+    assert all(json.loads(body)["error"]["type"] == "invalid_request_error" for _, _, body in responses)
+    # 无效请求不会进入流水线
+    assert not pipeline.stats()["requests_total"]
+
+
+def test_full_queue_answers_429(make_pipeline):
+    # 一个请求在流水线中, 一个阻塞在submit中, 一个在队列中, 第四个被拒绝
+    pipeline = make_pipeline(max_pending=1, start=False, prefill_seconds=0.5)
+
+    async def scenario():
+        async with running_server(pipeline, queue_size=1) as (server, port):
+            requests = []
+            for _ in range(4):
+                requests.append(asyncio.ensure_future(
+                    http_request(port, "POST", "/v1/chat/completions", chat_request())))
+                await asyncio.sleep(0.1)
+            return await asyncio.gather(*requests)
+
+    responses = asyncio.run(scenario())
+    assert [status for status, _, _ in responses] == [200, 200, 200, 429]
+    _, headers, body = responses[3]
+    assert headers["retry-after"] == "1"
+    assert json.loads(body)["error"]["type"] == "rate_limit_error"
+
+
+def test_unavailable_pipeline_answers_503(make_pipeline):
+    pipeline = make_pipeline(start=False)
+
+    async def scenario():
+        from multiprocess_inference import build_conversation_prompt
+        server = ChatCompletionServer(pipeline, build_conversation_prompt, ipc_protocol.IMAGE_MARKER)
+        http_server = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+        port = http_server.sockets[0].getsockname()[1]
+        # 模型尚未加载
+        loading = [await http_request(port, "POST", "/v1/chat/completions", chat_request()),
+                   await http_request(port, "GET", "/health")]
+        http_server.close()
+        await http_server.wait_closed()
+
+        async with running_server(pipeline) as (server, port):
+            pipeline.lm_process.terminate()
+            pipeline.lm_process.join()
+            stopped = [await http_request(port, "POST", "/v1/chat/completions", chat_request()),
+                       await http_request(port, "GET", "/health")]
+        return loading, stopped
+
+    loading, stopped = asyncio.run(scenario())
+    for responses, reason in ((loading, "still loading"), (stopped, "worker has stopped")):
+        (status, headers, body), (health_status, _, health_body) = responses
+        assert status == 503 and headers["retry-after"] == "5"
+        assert reason in json.loads(body)["error"]["message"]
+        assert health_status == 503 and reason in json.loads(health_body)["status"]
+
+
+def test_over_length_prompt_answers_400(make_pipeline):
+    pipeline = make_pipeline(start=False)
+
+    async def scenario():
+        async with running_server(pipeline) as (server, port):
+            limit = pipeline.memory_plan["max_context_len"] - pipeline.memory_plan["max_new_tokens"]
+            return await http_request(port, "POST", "/v1/chat/completions", chat_request("receipt " * limit))
+
+    status, _, body = asyncio.run(scenario())
+    assert status == 400
+    error = json.loads(body)["error"]
+    assert error["code"] == "context_length_exceeded" and error["type"] == "invalid_request_error"
+    assert not pipeline.stats()["requests_total"]
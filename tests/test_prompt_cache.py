@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+import rkllm_binding
+from benchmarks.fakes import FakeRKLLMRuntime
+from prompt_cache import PromptCacheManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYSTEM = "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n<|im_start|>user\n"
+OTHER_SYSTEM = "<|im_start|>system\nAnswer in Vietnamese.<|im_end|>\n<|im_start|>user\n"
+
+
+class CountingRuntime(FakeRKLLMRuntime):
+    """Records which prompt cache files are loaded and released"""
+
+    def __init__(self):
+        super().__init__(prefill_seconds=0, tokens_per_second=0, response_tokens=1, load_seconds=0)
+        self.loaded = []
+        self.releases = 0
+
+    def rkllm_load_prompt_cache(self, handle, prompt_cache_path):
+        status = super().rkllm_load_prompt_cache(handle, prompt_cache_path)
+        if status == 0:
+            self.loaded.append(prompt_cache_path.decode())
+        return status
+
+    def rkllm_release_prompt_cache(self, handle):
+        self.releases += 1
+        return super().rkllm_release_prompt_cache(handle)
+
+
+@pytest.fixture
+def runtime(monkeypatch):
+    runtime = CountingRuntime()
+    monkeypatch.setattr(rkllm_binding, "_lib", rkllm_binding._lib)
+    rkllm_binding.use_library(runtime)
+    return runtime
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "qwen.rkllm"
+    path.write_bytes(b"weights")
+    return str(path)
+
+
+def make_manager(cache_dir, model_path, built):
+    def build(prefix, cache_path):
+        # 与LLM进程一样, 只预填充前缀并保存缓存文件
+        built.append(prefix)
+        open(cache_path, "wb").close()
+
+    return PromptCacheManager(1, str(cache_dir), model_path, build)
+
+
+def test_caches_are_built_once_per_prefix_and_model(runtime, tmp_path, model_path):
+    built = []
+    manager = make_manager(tmp_path / "cache", model_path, built)
+    first = manager.ensure(SYSTEM)
+    assert manager.ensure(SYSTEM) == first
+    second = manager.ensure(OTHER_SYSTEM)
+    assert first != second and built == [SYSTEM, OTHER_SYSTEM]
+    assert sorted(os.listdir(tmp_path / "cache")) == sorted(os.path.basename(path) for path in (first, second))
+
+    # 重新启动时复用已有的缓存文件
+    restarted = make_manager(tmp_path / "cache", model_path, built)
+    assert restarted.ensure(SYSTEM) == first and restarted.builds == 0
+    # 替换模型后缓存失效
+    with open(model_path, "ab") as f:
+        f.write(b" updated")
+    replaced = make_manager(tmp_path / "cache", model_path, built)
+    assert replaced.ensure(SYSTEM) != first and built == [SYSTEM, OTHER_SYSTEM, SYSTEM]
+
+
+def test_select_loads_the_longest_matching_prefix(runtime, tmp_path, model_path):
+    manager = make_manager(tmp_path / "cache", model_path, [])
+    system_path = manager.ensure(SYSTEM)
+    longer = SYSTEM + "<image_id>0</image_id><image>\n"
+    longer_path = manager.ensure(longer)
+
+    assert manager.select(SYSTEM + "Hello<|im_end|>\n") == "Hello<|im_end|>\n"
+    assert manager.select(longer + "What is this?") == "What is this?"
+    assert manager.select(longer + "And this?") == "And this?"
+    assert runtime.loaded == [system_path, longer_path]
+    assert manager.loads == 2 and runtime.releases == 1
+
+    # 没有匹配的前缀时释放缓存, 整个提示词都要预填充
+    assert manager.select(OTHER_SYSTEM + "Hi") == OTHER_SYSTEM + "Hi"
+    assert manager.loaded_path is None and runtime.releases == 2
+
+
+def test_missing_cache_file_falls_back_to_full_prefill(runtime, tmp_path, model_path):
+    manager = make_manager(tmp_path / "cache", model_path, [])
+    os.remove(manager.ensure(SYSTEM))
+    prompt = SYSTEM + "Hello"
+    assert manager.select(prompt) == prompt
+    assert manager.loaded_path is None
+
+
+def test_ttft_stats(runtime, tmp_path, model_path):
+    manager = make_manager(tmp_path / "cache", model_path, [])
+    manager.ensure(SYSTEM)
+    for cached, seconds in ((False, 1.0), (True, 0.2), (True, 0.4)):
+        manager.record_ttft(cached, seconds)
+    stats = manager.stats()
+    assert (stats["builds"], stats["cached_requests"], stats["uncached_requests"]) == (1, 2, 1)
+    assert stats["mean_ttft_cached"] == pytest.approx(0.3) and stats["mean_ttft_uncached"] == 1.0
+
+
+def test_pipeline_requests_use_the_system_prompt_cache(make_pipeline, inference):
+    pipeline = make_pipeline()
+    # 工作进程启动时为系统提示词建立了缓存文件
+    cache_files = os.listdir(os.environ["PROMPT_CACHE_DIR"])
+    assert any(name.startswith("prefix_") for name in cache_files)
+
+    first_tokens = []
+
+    def on_event(request_id, kind, payload):
+        if kind == "timing" and payload["stage"] == "first_token":
+            first_tokens.append(payload)
+
+    for text in ("What is in the image?", "Read the total."):
+        request_id = pipeline.submit(os.path.join(REPO_DIR, "bill.jpg"), inference.build_request_prompt(text),
+                                     on_event=on_event)
+        assert pipeline.wait(request_id, 10) == "DONE"
+    assert [payload["prompt_cache"] for payload in first_tokens] == [True, True]
@@ -0,0 +1,87 @@
+import os
+import threading
+
+import pytest
+
+from prompt_tokens import IMAGE_PLACEHOLDER_TOKEN, PromptCounter, load_special_token_ids, over_length_error
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXTS = ["What is in the image?", "Xin chào, hóa đơn này tổng cộng bao nhiêu tiền?", "图中的收据总共多少钱？ 🧾",
+         "  indented\n\nlines\twith  tabs and numbers 12345.678 "]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    """The model's own tokenizer, which PromptCounter's counts must agree with"""
+    pytest.importorskip("transformers")
+    from tokenization_minicpmv_fast import MiniCPMVTokenizerFast
+    return MiniCPMVTokenizerFast.from_pretrained(REPO_DIR)
+
+
+@pytest.fixture(scope="module")
+def counter():
+    counter = PromptCounter(REPO_DIR, tokens_per_tile=64)
+    if not counter.exact:
+        pytest.skip("tokenizers is not installed, counts are estimates")
+    return counter
+
+
+def test_special_token_table_matches_the_tokenizer(tokenizer):
+    for token, token_id in load_special_token_ids(REPO_DIR).items():
+        assert tokenizer.convert_tokens_to_ids(token) == token_id
+    special_ids = load_special_token_ids(REPO_DIR)
+    assert tokenizer.im_start_id == special_ids["<image>"]
+    assert tokenizer.slice_end_id == special_ids["</slice>"]
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_plain_prompt_count_matches_the_tokenizer(tokenizer, counter, inference, text):
+    prompt = inference.format_prompt(text)
+    counts = counter.count_prompt(prompt, image_tiles=1, user_texts=[text])
+    assert counts["total"] == len(tokenizer.encode(prompt, add_special_tokens=False))
+    assert counts["image"] == 0
+    assert counts["text"] == len(tokenizer.encode(text, add_special_tokens=False))
+
+
+@pytest.mark.parametrize("tiles", [1, 5])
+@pytest.mark.parametrize("text", TEXTS)
+def test_image_prompt_count_matches_the_tokenizer(tokenizer, counter, inference, text, tiles):
+    prompt = inference.build_request_prompt(text)
+    assert prompt.count(IMAGE_PLACEHOLDER_TOKEN) == 1
+    counts = counter.count_prompt(prompt, image_tiles=tiles, user_texts=[text])
+    # 分词器把占位符算作一个token, 运行库把它展开为每个图块64个token加上前后两个标记
+    assert counts["image"] == 64 * tiles + 2
+    assert counts["total"] == len(tokenizer.encode(prompt, add_special_tokens=False)) - 1 + counts["image"]
+
+
+def test_over_length_error():
+    counts = {"template": 20, "text": 2986, "image": 66, "total": 3072}
+    assert over_length_error(counts, 4096, 1024) is None
+    error = over_length_error({**counts, "text": 2987, "total": 3073}, 4096, 1024)
+    assert "3073 tokens" in error and "3072 of the 4096-token context" in error
+
+
+def test_over_length_prompt_is_rejected_before_queueing(make_pipeline, inference):
+    pipeline = make_pipeline()
+    limit = pipeline.memory_plan["max_context_len"] - pipeline.memory_plan["max_new_tokens"]
+    text = "receipt " * limit
+    events = []
+    done = threading.Event()
+    statuses = []
+
+    def on_done(request_id, status):
+        statuses.append(status)
+        done.set()
+
+    pipeline.submit(os.path.join(REPO_DIR, "bill.jpg"), inference.build_request_prompt(text),
+                    on_done=on_done, on_event=lambda request_id, kind, payload: events.append((kind, payload)))
+    # 在submit中同步拒绝, 没有任何内容进入工作进程的队列
+    assert done.is_set() and statuses == ["ERROR"]
+    assert [kind for kind, _ in events] == ["error"] and "Prompt is" in events[0][1]
+    assert pipeline.img_path_queue.empty() and pipeline.prompt_queue.empty()
+    assert pipeline.stats()["requests_total"] == {"status=REJECTED": 1}
+
+    # 被拒绝的请求不占用流水线的位置
+    for _ in range(pipeline.max_pending + 1):
+        request_id = pipeline.submit(os.path.join(REPO_DIR, "bill.jpg"), inference.build_request_prompt("Hi"))
+        assert pipeline.wait(request_id, 10) == "DONE"
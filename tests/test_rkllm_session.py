@@ -0,0 +1,152 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import rkllm_binding
+from benchmarks.fakes import FakeRKLLMRuntime
+from rkllm_binding import RKLLMSession
+
+RESPONSE = "The image shows a receipt with several items"
+
+
+class RecordingRuntime(FakeRKLLMRuntime):
+    """Records when each run starts and delivers its finish callback; aborts can be ignored, and async starts can fail"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.intervals = []
+        self.aborts = 0
+        self.ignore_aborts = False
+        self.fail_starts = 0
+        self._run_start = None
+        self._intervals_lock = threading.Lock()
+
+    def rkllm_run(self, handle, input_ref, infer_ref, userdata):
+        self._run_start = time.monotonic()
+        return super().rkllm_run(handle, input_ref, infer_ref, userdata)
+
+    def _emit(self, state, text=None, token_id=0):
+        if state == rkllm_binding.LLMCallState.RKLLM_RUN_FINISH:
+            # 运行在结束回调送达时结束, 会话随后就可以开始下一次运行
+            with self._intervals_lock:
+                self.intervals.append((self._run_start, time.monotonic()))
+        super()._emit(state, text, token_id)
+
+    def rkllm_run_async(self, handle, input_ref, infer_ref, userdata):
+        if self.fail_starts:
+            self.fail_starts -= 1
+            return -1
+        return super().rkllm_run_async(handle, input_ref, infer_ref, userdata)
+
+    def rkllm_abort(self, handle):
+        self.aborts += 1
+        if self.ignore_aborts:
+            return 0
+        return super().rkllm_abort(handle)
+
+    def overlapping_runs(self):
+        intervals = sorted(self.intervals)
+        return [(a, b) for a, b in zip(intervals, intervals[1:]) if b[0] < a[1]]
+
+
+@pytest.fixture
+def runtime(monkeypatch):
+    runtime = RecordingRuntime(prefill_seconds=0.02, tokens_per_second=100, response_tokens=8, load_seconds=0)
+    # 测试结束后恢复之前的运行库
+    monkeypatch.setattr(rkllm_binding, "_lib", rkllm_binding._lib)
+    rkllm_binding.use_library(runtime)
+    return runtime
+
+
+def make_session(abort_timeout=5.0):
+    return RKLLMSession(rkllm_binding.create_default_param(), abort_timeout=abort_timeout)
+
+
+def test_generate_sync_yields_the_response(runtime):
+    with make_session() as session:
+        assert "".join(session.generate_sync("Describe the image.")) == RESPONSE
+        assert session.last_token_ids == list(range(8))
+        assert "".join(session.generate_sync("Again.")) == RESPONSE
+    assert runtime.runs == 2
+
+
+def test_concurrent_runs_wait_for_the_finish_callback(runtime):
+    session = make_session()
+    results = []
+
+    def consume():
+        results.append("".join(session.generate_sync("Describe the image.")))
+
+    threads = [threading.Thread(target=consume) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert results == [RESPONSE] * 3
+    assert len(runtime.intervals) == 3 and not runtime.overlapping_runs()
+
+
+def test_leaving_early_aborts_and_frees_the_runtime(runtime):
+    runtime.response_tokens = 1000
+    session = make_session()
+    start = time.monotonic()
+    for _ in session.generate_sync("Describe the image."):
+        break
+    # 生成器关闭时中止运行, 并等待结束回调
+    assert runtime.aborts == 1
+    assert len(runtime.intervals) == 1 and time.monotonic() - start < 2
+    runtime.response_tokens = 8
+    assert "".join(session.generate_sync("Again.")) == RESPONSE
+    assert not runtime.overlapping_runs()
+
+
+def test_ignored_abort_keeps_the_session_busy(runtime):
+    runtime.response_tokens = 30
+    runtime.ignore_aborts = True
+    session = make_session(abort_timeout=0.05)
+    for _ in session.generate_sync("Describe the image."):
+        break
+    # 运行库没有停下: 下一次运行要等到第一次运行的结束回调之后才开始
+    assert not runtime.intervals
+    runtime.response_tokens = 8
+    assert "".join(session.generate_sync("Again.")) == RESPONSE
+    assert len(runtime.intervals) == 2 and not runtime.overlapping_runs()
+
+
+def test_failed_start_releases_the_session(runtime):
+    runtime.fail_starts = 1
+    session = make_session()
+    with pytest.raises(RuntimeError):
+        next(session.generate_sync("Describe the image."))
+    assert "".join(session.generate_sync("Again.")) == RESPONSE
+
+
+def test_async_generate_serialises_runs_and_cancels_on_task_cancellation(runtime):
+    session = make_session()
+
+    async def collect(prompt):
+        return "".join([piece async for piece in session.generate(prompt)])
+
+    async def scenario():
+        results = await asyncio.gather(*(collect(f"Question {i}") for i in range(3)))
+        runtime.response_tokens = 1000
+        started = asyncio.Event()
+
+        async def consume_forever():
+            async for _ in session.generate("Long answer"):
+                started.set()
+
+        task = asyncio.ensure_future(consume_forever())
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        runtime.response_tokens = 8
+        return results, await collect("After the cancellation")
+
+    results, after = asyncio.run(scenario())
+    assert results == [RESPONSE] * 3 and after == RESPONSE
+    assert runtime.aborts == 1
+    assert len(runtime.intervals) == 5 and not runtime.overlapping_runs()
@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+
+import ipc_protocol
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGE = os.path.join(REPO_DIR, "bill.jpg")
+
+
+class BlockingPipeline:
+    """Stands in for InferencePipeline; submit of the first request blocks until ``release`` is set"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.blocked = threading.Event()
+        self.submitted = []
+        self.cancelled = []
+
+    def submit(self, img_path, prompt, request_id=None, on_done=None, on_event=None, **kwargs):
+        if not self.submitted:
+            self.blocked.set()
+            self.release.wait(5)
+        self.submitted.append(request_id)
+        on_done(request_id, "DONE")
+
+    def cancel(self, request_id, reason="Cancelled"):
+        # 只有已提交 (在流水线中) 的请求可以直接取消
+        self.cancelled.append(request_id)
+        return False
+
+
+def test_cancels_are_only_remembered_for_queued_requests(inference):
+    pipeline = BlockingPipeline()
+    in_read, in_write = os.pipe()
+    out_read, out_write = os.pipe()
+    server = threading.Thread(target=inference.serve_protocol, args=(pipeline, in_read, out_write))
+    server.start()
+    requests = os.fdopen(in_write, "wb")
+    frames = ipc_protocol.read_frames(os.fdopen(out_read, "rb"))
+    assert next(frames)["type"] == ipc_protocol.READY
+
+    def send(frame):
+        requests.write(ipc_protocol.encode_frame(frame))
+        requests.flush()
+
+    send({"type": ipc_protocol.REQUEST, "id": "a", "image": IMAGE, "text": "first"})
+    assert pipeline.blocked.wait(5)
+    # b排在被阻塞的a之后时取消; 从未提交过的x的取消不应影响之后同名的请求
+    send({"type": ipc_protocol.REQUEST, "id": "b", "image": IMAGE, "text": "second"})
+    send({"type": ipc_protocol.CANCEL, "id": "b"})
+    send({"type": ipc_protocol.CANCEL, "id": "x"})
+    send({"type": ipc_protocol.REQUEST, "id": "x", "image": IMAGE, "text": "third"})
+    send({"type": ipc_protocol.CANCEL, "id": "a"})
+    # 读取线程按顺序处理帧, 等到它处理完最后一个取消帧再放行a
+    deadline = time.monotonic() + 5
+    while "a" not in pipeline.cancelled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.release.set()
+
+    responses = {(frame["id"], frame["type"]) for frame in (next(frames) for _ in range(3))}
+    requests.close()
+    server.join(5)
+    assert not server.is_alive()
+    assert pipeline.submitted == ["a", "x"]
+    assert responses == {("a", ipc_protocol.DONE), ("b", ipc_protocol.ERROR), ("x", ipc_protocol.DONE)}
+    # a的取消在submit阻塞期间到达, submit返回后再转给流水线
+    assert pipeline.cancelled.count("a") == 2
@@ -0,0 +1,67 @@
+import pytest
+
+from token_sink import TokenSink
+
+TEXT = "图中是一张收据 🧾, tổng cộng 12.000đ"
+
+
+def collect(**kwargs):
+    emitted = []
+    sink = TokenSink(lambda text, n_tokens: emitted.append((text, n_tokens)), **kwargs)
+    sink.reset()
+    return sink, emitted
+
+
+def test_characters_split_at_every_byte_boundary():
+    data = TEXT.encode("utf-8")
+    for split in range(1, len(data)):
+        # 每个token都触发发送, 被拆开的字符要等到后半部分到达
+        sink, emitted = collect(flush_interval=0, flush_tokens=1)
+        sink.add(1, data[:split])
+        sink.add(2, data[split:])
+        sink.flush(final=True)
+        assert "".join(text for text, _ in emitted) == TEXT
+        assert "\ufffd" not in "".join(text for text, _ in emitted)
+        assert sum(n_tokens for _, n_tokens in emitted) == 2
+        assert all(text for text, _ in emitted)
+
+
+def test_one_byte_per_token():
+    data = TEXT.encode("utf-8")
+    sink, emitted = collect(flush_interval=0, flush_tokens=1, capacity=4)
+    for i, byte in enumerate(data):
+        sink.add(i, bytes([byte]))
+    sink.flush(final=True)
+    assert "".join(text for text, _ in emitted) == TEXT
+    assert sum(n_tokens for _, n_tokens in emitted) == len(data)
+    # 缓冲区超过初始容量后扩展
+    assert sink.count == len(data) and list(sink.token_ids[:sink.count]) == list(range(len(data)))
+    assert sink.text() == TEXT
+
+
+@pytest.mark.parametrize("flush_tokens", [1, 4, 1000])
+def test_final_flush_emits_leftover_tokens(flush_tokens):
+    emoji = "🧾".encode("utf-8")
+    sink, emitted = collect(flush_interval=60, flush_tokens=flush_tokens)
+    sink.add(1, "收据".encode("utf-8"))
+    # 生成在表情符号中途结束
+    sink.add(2, emoji[:2])
+    sink.flush(final=True)
+    assert "".join(text for text, _ in emitted) == "收据\ufffd"
+    assert sum(n_tokens for _, n_tokens in emitted) == 2
+    sink.flush(final=True)
+    assert sum(n_tokens for _, n_tokens in emitted) == 2
+
+
+def test_batches_until_flush_tokens():
+    sink, emitted = collect(flush_interval=60, flush_tokens=3)
+    for i, word in enumerate(["图", "中", "是", "一张", "收据"]):
+        sink.add(i, word.encode("utf-8"))
+    assert emitted == [("图中是", 3)]
+    sink.flush(final=True)
+    assert emitted == [("图中是", 3), ("一张收据", 2)]
+
+    sink.reset()
+    sink.add(0, "新".encode("utf-8"))
+    sink.flush(final=True)
+    assert emitted[-1] == ("新", 1) and sink.text() == "新"
@@ -0,0 +1,156 @@
+import os
+import random
+import time
+
+import numpy as np
+import pytest
+
+from benchmarks.fakes import FakeRKNNLite
+from embedding_cache import EmbeddingCache
+from vision_pool import AUTO, LATENCY, THROUGHPUT, VisionEncoderPool
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORE_MASKS = {"all": FakeRKNNLite.NPU_CORE_0_1_2,
+              "single": [FakeRKNNLite.NPU_CORE_0, FakeRKNNLite.NPU_CORE_1, FakeRKNNLite.NPU_CORE_2]}
+
+
+class TaggingRKNNLite(FakeRKNNLite):
+    """Returns two embedding tokens filled with the tile's value, after a random delay"""
+
+    instances = []
+
+    def __init__(self, verbose=False):
+        super().__init__(verbose)
+        self.released = False
+        TaggingRKNNLite.instances.append(self)
+
+    def inference(self, inputs, data_format=None):
+        time.sleep(random.uniform(0, 0.01))
+        self.inferences += 1
+        return [np.full((1, 2, 4), float(np.ravel(inputs[0])[0]), dtype=np.float32)]
+
+    def release(self):
+        self.released = True
+
+
+def load_encoder(core_mask):
+    encoder = TaggingRKNNLite()
+    encoder.load_rknn("vision_transformer.rknn")
+    encoder.init_runtime(core_mask=core_mask)
+    return encoder
+
+
+def make_pool(mode, throughput_depth=2):
+    TaggingRKNNLite.instances = []
+    pool = VisionEncoderPool(CORE_MASKS, load_encoder, lambda: (lambda tile: np.array(tile, dtype=np.float32)),
+                             mode=mode, throughput_depth=throughput_depth)
+    pool.load()
+    return pool
+
+
+def tile_values(embeddings):
+    """The tile value of each pair of embedding tokens"""
+    return [float(embeddings[0, i, 0]) for i in range(0, embeddings.shape[1], 2)]
+
+
+@pytest.mark.parametrize("mode", [LATENCY, THROUGHPUT, AUTO])
+def test_results_follow_request_and_tile_order(mode):
+    pool = make_pool(mode)
+    tile_lists = [[[1]], [[2], [3], [4]], [[5]], [[6], [7]]]
+    results = pool.encode(tile_lists, queue_depth=len(tile_lists))
+    assert [tile_values(embeddings) for embeddings in results] == [[1], [2, 3, 4], [5], [6, 7]]
+    assert pool.last_stage_seconds["inference"] > 0
+
+
+def test_instances_per_mode():
+    make_pool(LATENCY)
+    assert [encoder.core_mask for encoder in TaggingRKNNLite.instances] == [7]
+    make_pool(THROUGHPUT)
+    assert [encoder.core_mask for encoder in TaggingRKNNLite.instances] == [1, 2, 4]
+    make_pool(AUTO)
+    assert len(TaggingRKNNLite.instances) == 4
+
+
+def test_auto_mode_switches_on_queue_depth():
+    pool = make_pool(AUTO, throughput_depth=3)
+    latency_encoder = pool.latency_encoder
+    pool.encode([[[1]]], queue_depth=1)
+    assert latency_encoder.inferences == 1
+    pool.encode([[[1]], [[2]], [[3]]], queue_depth=3)
+    assert latency_encoder.inferences == 1
+    assert sum(encoder.inferences for encoder, _ in pool.core_encoders) == 3
+
+
+def test_release_and_reload():
+    pool = make_pool(THROUGHPUT)
+    released = list(TaggingRKNNLite.instances)
+    pool.release()
+    assert not pool.loaded
+    assert all(encoder.released for encoder in released)
+    results = pool.encode([[[8]], [[9]]])
+    assert [tile_values(embeddings) for embeddings in results] == [[8], [9]]
+    assert pool.reloads == 1
+    assert "reload" in pool.last_stage_seconds
+
+
+def count_inferences():
+    return sum(encoder.inferences for encoder in TaggingRKNNLite.instances)
+
+
+def test_encode_image_batch_cache_hits_skip_the_npu(inference):
+    pool = make_pool(LATENCY)
+    cache = EmbeddingCache()
+    with open(os.path.join(REPO_DIR, "bill.jpg"), "rb") as f:
+        data = f.read()
+    path = os.path.join(REPO_DIR, "man.jpg")
+
+    first = inference.encode_image_batch([data, path, data], pool, cache)
+    assert count_inferences() == 2
+    assert [cache_hit for _, _, cache_hit, _ in first] == [False, False, False]
+    assert first[0][0] == first[2][0] != first[1][0]
+    assert first[0][1] is first[2][1]
+    assert all(decode_seconds is not None for _, _, _, decode_seconds in first)
+
+    second = inference.encode_image_batch([path, data], pool, cache)
+    assert count_inferences() == 2
+    assert [(key, cache_hit, decode_seconds) for key, _, cache_hit, decode_seconds in second] == [
+        (first[1][0], True, None), (first[0][0], True, None)]
+    np.testing.assert_array_equal(second[0][1], first[1][1])
+
+
+def test_encode_image_batch_failed_decodes(inference, tmp_path):
+    pool = make_pool(LATENCY)
+    cache = EmbeddingCache()
+    with open(os.path.join(REPO_DIR, "bill.jpg"), "rb") as f:
+        data = f.read()
+    results = inference.encode_image_batch(
+        [b"not an image", str(tmp_path / "missing.jpg"), data], pool, cache)
+
+    key, embeddings, cache_hit, decode_seconds = results[0]
+    assert key is not None and embeddings is None and not cache_hit and decode_seconds is not None
+    assert results[1] == (None, None, False, None)
+    assert results[2][1] is not None
+    assert count_inferences() == 1
+    assert cache.get(key) is None
+
+
+def test_embedding_disk_cache_is_per_vision_model(inference, tmp_path, monkeypatch):
+    model_path = tmp_path / "vision_transformer.rknn"
+    model_path.write_bytes(b"model")
+    monkeypatch.setattr(inference, "VISION_ENCODER_PATH", str(model_path))
+    monkeypatch.setattr(inference, "EMBEDDING_CACHE_DIR", str(tmp_path / "embeddings"))
+    first = inference.embedding_cache_dir()
+    assert os.path.dirname(first) == str(tmp_path / "embeddings")
+    assert inference.embedding_cache_dir() == first
+
+    # 换了输入格式或模型文件后使用新的目录, 不会读到旧模型的嵌入
+    monkeypatch.setattr(inference, "VISION_INPUT_UINT8", not inference.VISION_INPUT_UINT8)
+    assert inference.embedding_cache_dir() != first
+    monkeypatch.undo()
+    monkeypatch.setattr(inference, "VISION_ENCODER_PATH", str(model_path))
+    monkeypatch.setattr(inference, "EMBEDDING_CACHE_DIR", str(tmp_path / "embeddings"))
+    model_path.write_bytes(b"a replacement model")
+    assert inference.embedding_cache_dir() != first
+
+    monkeypatch.setattr(inference, "EMBEDDING_CACHE_DIR", None)
+    assert inference.embedding_cache_dir() is None
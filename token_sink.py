@@ -0,0 +1,70 @@
+import array
+import codecs
+import time
+from typing import Callable
+
+
+class TokenSink:
+    """Collects generated tokens inside the RKLLM callback and emits decoded text in batches.
+
+    ``add`` only appends the token id and the token's raw bytes to buffers
+    allocated up front, so the callback does no per-token decoding or I/O.
+    Pending bytes are decoded with an incremental UTF-8 decoder, which keeps
+    a multi-byte character split across tokens (common in Vietnamese and
+    Chinese) intact, and handed to ``emit(text, n_tokens)`` once
+    ``flush_tokens`` tokens are pending or ``flush_interval`` seconds have
+    passed since the last flush. Slow generation therefore still streams
+    token by token while fast generation is coalesced.
+    """
+
+    def __init__(self, emit: Callable[[str, int], None], flush_interval: float = 0.05,
+                 flush_tokens: int = 16, capacity: int = 4096):
+        self.emit = emit
+        self.flush_interval = flush_interval
+        self.flush_tokens = flush_tokens
+        self.token_ids = array.array("i", bytes(4 * capacity))
+        self.raw = bytearray(16 * capacity)
+        self.count = 0
+        self.nbytes = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._flushed_count = 0
+        self._flushed_bytes = 0
+        self._last_flush = 0.0
+
+    def reset(self) -> None:
+        """Start a new response, keeping the buffers"""
+        self.count = 0
+        self.nbytes = 0
+        self._decoder.reset()
+        self._flushed_count = 0
+        self._flushed_bytes = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, token_id: int, data: bytes) -> None:
+        if self.count == len(self.token_ids):
+            self.token_ids.extend(self.token_ids)
+        self.token_ids[self.count] = token_id
+        self.count += 1
+        end = self.nbytes + len(data)
+        if end > len(self.raw):
+            self.raw.extend(bytes(max(len(self.raw), len(data))))
+        self.raw[self.nbytes:end] = data
+        self.nbytes = end
+        if (self.count - self._flushed_count >= self.flush_tokens
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self, final: bool = False) -> None:
+        """Decode and emit everything added since the last flush"""
+        text = self._decoder.decode(self.raw[self._flushed_bytes:self.nbytes], final)
+        self._flushed_bytes = self.nbytes
+        self._last_flush = time.monotonic()
+        # 字符未完整时先不发送, 这些token计入下一次发送
+        pending_tokens = self.count - self._flushed_count
+        if text or (final and pending_tokens):
+            self._flushed_count = self.count
+            self.emit(text, pending_tokens)
+
+    def text(self) -> str:
+        """The whole response so far"""
+        return bytes(self.raw[:self.nbytes]).decode("utf-8", "replace")
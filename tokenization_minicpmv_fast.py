@@ -16,6 +16,12 @@ class MiniCPMVTokenizerFast(Qwen2TokenizerFast):
         self.slice_end = "</slice>"
         self.im_id_start = "<image_id>"
         self.im_id_end = "</image_id>"
+        # Looked up once; the *_id properties are read for every image and slice
+        self._token_ids = {
+            token: self.convert_tokens_to_ids(token)
+            for token in (self.im_start, self.im_end, self.slice_start, self.slice_end,
+                          self.im_id_start, self.im_id_end, "\n")
+        }
 
     @property
     def eos_id(self):
@@ -31,31 +37,31 @@ class MiniCPMVTokenizerFast(Qwen2TokenizerFast):
 
     @property
     def im_start_id(self):
-        return self.convert_tokens_to_ids(self.im_start)
+        return self._token_ids[self.im_start]
 
     @property
     def im_end_id(self):
-        return self.convert_tokens_to_ids(self.im_end)
+        return self._token_ids[self.im_end]
 
     @property
     def slice_start_id(self):
-        return self.convert_tokens_to_ids(self.slice_start)
+        return self._token_ids[self.slice_start]
     
     @property
     def slice_end_id(self):
-        return self.convert_tokens_to_ids(self.slice_end)
+        return self._token_ids[self.slice_end]
 
     @property
     def im_id_start_id(self):
-        return self.convert_tokens_to_ids(self.im_id_start)
+        return self._token_ids[self.im_id_start]
     
     @property
     def im_id_end_id(self):
-        return self.convert_tokens_to_ids(self.im_id_end)
+        return self._token_ids[self.im_id_end]
     
     @property
     def newline_id(self):
-        return self.convert_tokens_to_ids('\n')
+        return self._token_ids['\n']
 
     @staticmethod
     def escape(text: str) -> str:
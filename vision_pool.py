@@ -0,0 +1,159 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import numpy as np
+
+LATENCY = "latency"        # one instance on all NPU cores, one image at a time
+THROUGHPUT = "throughput"  # one instance per NPU core, one image per core
+AUTO = "auto"              # both, chosen per batch by queue depth
+
+
+def _timed(record, stage, fn, *args, **kwargs):
+    start_time = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        if record is not None:
+            record(stage, time.perf_counter() - start_time)
+
+
+def encode_tiles(tiles, vision_encoder, preprocessors, executor, record=None):
+    """Encode tiles in order, preprocessing the next tile on ``executor`` while the NPU runs.
+
+    ``preprocessors`` is a pair used alternately, so the tensor being encoded
+    is never overwritten by the next tile's preprocessing. ``record(stage,
+    seconds)`` is called for every "resize" and "inference" step.
+    """
+    outputs = []
+    future = executor.submit(_timed, record, "resize", preprocessors[0], tiles[0])
+    for i in range(len(tiles)):
+        input_tensor = future.result()
+        if i + 1 < len(tiles):
+            future = executor.submit(_timed, record, "resize", preprocessors[(i + 1) % 2], tiles[i + 1])
+        output = _timed(record, "inference", vision_encoder.inference, inputs=[input_tensor], data_format="nhwc")
+        outputs.append(np.asarray(output[0], dtype=np.float32))
+    return outputs[0] if len(outputs) == 1 else np.concatenate(outputs, axis=1)
+
+
+class VisionEncoderPool:
+    """Vision encoder instances on the RK3588's three NPU cores.
+
+    ``encoder_factory(core_mask)`` returns a loaded encoder with an
+    RKNNLite-compatible ``inference`` method, so a stand-in can replace the
+    NPU. In latency mode a single instance uses all cores and tiles are encoded
+    one after another; in throughput mode every core runs its own instance and
+    tiles from all queued requests are spread across them. Each instance holds
+    its own copy of the model, so throughput mode needs three times the
+    encoder memory, and auto mode four times.
+
+    After each ``encode`` call ``last_stage_seconds`` holds the time spent in
+    preprocessing ("resize") and on the NPU ("inference"), summed over tiles.
+
+    ``release`` frees every instance; the next ``encode`` loads them again
+    and adds the time it took as "reload" to ``last_stage_seconds``.
+    """
+
+    def __init__(self, core_masks: dict, encoder_factory: Callable, preprocessor_factory: Callable,
+                 mode: str = LATENCY, throughput_depth: int = 2):
+        if mode not in (LATENCY, THROUGHPUT, AUTO):
+            raise ValueError(f"Unknown vision pool mode: {mode}")
+        self.core_masks = core_masks
+        self.encoder_factory = encoder_factory
+        self.preprocessor_factory = preprocessor_factory
+        self.mode = mode
+        self.throughput_depth = throughput_depth
+        self.latency_encoder = None
+        self.core_encoders = []
+        self._free_cores = queue.Queue()
+        self._latency_preprocessors = None
+        self._prefetch = ThreadPoolExecutor(max_workers=1)
+        self._core_executor = None
+        self._stage_lock = threading.Lock()
+        self.last_stage_seconds = {"resize": 0.0, "inference": 0.0}
+        self.reloads = 0
+
+    @property
+    def loaded(self) -> bool:
+        return self.latency_encoder is not None or bool(self.core_encoders)
+
+    def load(self) -> None:
+        """Create the encoder instances required by the configured mode"""
+        if self.mode in (LATENCY, AUTO):
+            self.latency_encoder = self.encoder_factory(self.core_masks["all"])
+            self._latency_preprocessors = [self.preprocessor_factory(), self.preprocessor_factory()]
+        if self.mode in (THROUGHPUT, AUTO):
+            for core_mask in self.core_masks["single"]:
+                instance = (self.encoder_factory(core_mask), self.preprocessor_factory())
+                self.core_encoders.append(instance)
+                self._free_cores.put(instance)
+            self._core_executor = ThreadPoolExecutor(max_workers=len(self.core_encoders))
+
+    def choose_mode(self, queue_depth: int) -> str:
+        """Throughput mode once enough work is queued to keep several cores busy"""
+        if self.latency_encoder is None:
+            return THROUGHPUT
+        if not self.core_encoders or queue_depth < self.throughput_depth:
+            return LATENCY
+        return THROUGHPUT
+
+    def _record_stage(self, stage, seconds):
+        with self._stage_lock:
+            self.last_stage_seconds[stage] += seconds
+
+    def _encode_on_free_core(self, tile):
+        instance = self._free_cores.get()
+        try:
+            encoder, preprocessor = instance
+            input_tensor = _timed(self._record_stage, "resize", preprocessor, tile)
+            output = _timed(self._record_stage, "inference", encoder.inference,
+                            inputs=[input_tensor], data_format="nhwc")
+            return np.asarray(output[0], dtype=np.float32)
+        finally:
+            self._free_cores.put(instance)
+
+    def encode(self, tile_lists: List[list], queue_depth: int = 1) -> List[np.ndarray]:
+        """Encode several images, each given as its list of tiles.
+
+        Returns one embedding array per image, with the tiles' embeddings
+        concatenated along the token axis.
+        """
+        self.last_stage_seconds = {"resize": 0.0, "inference": 0.0}
+        if not self.loaded:
+            reload_start = time.perf_counter()
+            self.load()
+            self.last_stage_seconds["reload"] = time.perf_counter() - reload_start
+            self.reloads += 1
+            print(f"Vision encoder reloaded in {self.last_stage_seconds['reload']:.2f} seconds")
+        mode = self.choose_mode(max(queue_depth, sum(len(tiles) for tiles in tile_lists)))
+        start_time = time.time()
+        if mode == LATENCY:
+            results = [encode_tiles(tiles, self.latency_encoder, self._latency_preprocessors, self._prefetch,
+                                    self._record_stage)
+                       for tiles in tile_lists]
+        else:
+            futures = [[self._core_executor.submit(self._encode_on_free_core, tile) for tile in tiles]
+                       for tiles in tile_lists]
+            results = []
+            for tile_futures in futures:
+                outputs = [future.result() for future in tile_futures]
+                results.append(outputs[0] if len(outputs) == 1 else np.concatenate(outputs, axis=1))
+        print(f"Vision encoder inference time: {time.time() - start_time:.2f} seconds "
+              f"({sum(len(tiles) for tiles in tile_lists)} tiles, {mode} mode)")
+        return results
+
+    def release(self) -> None:
+        """Release every encoder instance"""
+        if self.latency_encoder is not None:
+            self.latency_encoder.release()
+            self.latency_encoder = None
+        for encoder, _ in self.core_encoders:
+            encoder.release()
+        self.core_encoders = []
+        self._free_cores = queue.Queue()
+        self._latency_preprocessors = None
+        if self._core_executor is not None:
+            self._core_executor.shutdown()
+            self._core_executor = None